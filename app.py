@@ -1,23 +1,41 @@
+import time
+
+# Taken before the other imports, so the startup timing includes them
+IMPORT_STARTED = time.perf_counter()
+
+import gc
+import importlib
 import logging
 import os
-import boto3
-import joblib
-import matplotlib
-import matplotlib.pyplot as plt
+import threading
 import numpy as np
 import pandas as pd
-import io
-import base64
+import json
 
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
-from io import BytesIO, StringIO
-from flask import (Flask, make_response, redirect, render_template, request,
-                   url_for)
-from scipy.stats import norm, percentileofscore
+from io import BytesIO
+from flask import (Flask, Response, g, make_response, redirect, render_template,
+                   request, url_for)
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-from env import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+from data_format import (csv_key, processed_data_extension,
+                         read_data_frame)
+from data_snapshot import DataSnapshot
+from feature_index import FEATURE_COLUMNS
+from flat_tree import FlatTree
+from metrics import load_phase, observe_request, predict_stage, render_metrics
+from prediction_cache import create_prediction_cache, prediction_key
+from request_profiler import RequestProfiler, collapsed_stacks, pstats_bytes
+from schema import processed_schema
+from score_chart import WARM_UP_MODULES, ScoreChart
+from storage import ObjectNotFound, bucket_names, create_storage
+from upload_ingest import UploadIngester, UploadRejected, upload_settings
+
+# Seconds spent importing this module and everything it imports at the top
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
 
 class EtlProjectApp(Flask):
@@ -26,82 +44,343 @@ class EtlProjectApp(Flask):
         self.setup()
 
     def setup(self):
-        self.load_env()
         self.initialise_constants()
+        # Import the chart libraries and build the chart while loading
+        self.start_warm_up()
+        with self.startup_phase('load_env'):
+            self.load_env()
         self.setup_routes()
         # self.setup_logging()
-        self.download_processed_data()
-        self.download_model_from_s3()
+        with self.startup_phase('snapshot'):
+            self.snapshot = self.load_snapshot()
+        if not self.WARM_UP_IN_BACKGROUND:
+            self.warm_up_thread.join()
+        self.freeze_shared_objects()
+        self.before_request(self.start_request_timer)
+        self.before_request(self.start_process)
+        self.after_request(self.record_request)
+
+        # Requests only pay for profiling when it is configured
+        if self.request_profiler:
+            self.before_request(self.start_request_profile)
+            self.after_request(self.finish_request_profile)
 
     def load_env(self):
-        self.aws_access_key_id = AWS_ACCESS_KEY_ID
-        self.aws_secret_access_key = AWS_SECRET_ACCESS_KEY
-        self.s3 = boto3.client('s3', aws_access_key_id=self.aws_access_key_id,
-                               aws_secret_access_key=self.aws_secret_access_key)
+        # S3 or a local directory, chosen by STORAGE_BACKEND
+        self.storage = create_storage(use_cache=True)
 
     def initialise_constants(self):
         # Define constants for S3 buckets and file names
-        self.PROCESSED_BUCKET = 'etl-project-data-processed'
-        self.UPLOADS_BUCKET = 'etl-project-uploads'
-        self.MODEL_BUCKET = 'etl-project-ml-model'
-        self.INPUT_DATA_FILE = 'input_data.csv'
-        self.UNIQUE_DIRECTORS_FILE = 'unique_directors.csv'
-        self.UNIQUE_GENRES_FILE = 'unique_genres.csv'
-        self.UNIQUE_LEADS_FILE = 'unique_leads.csv'
+        buckets = bucket_names()
+        self.PROCESSED_BUCKET = buckets['processed']
+        self.UPLOADS_BUCKET = buckets['uploads']
+        self.MODEL_BUCKET = buckets['model']
+        self.DATA_FILE_EXTENSION = processed_data_extension()
+        self.INPUT_DATA_FILE = 'input_data' + self.DATA_FILE_EXTENSION
+        self.UNIQUE_DIRECTORS_FILE = 'unique_directors' + self.DATA_FILE_EXTENSION
+        self.UNIQUE_GENRES_FILE = 'unique_genres' + self.DATA_FILE_EXTENSION
+        self.UNIQUE_LEADS_FILE = 'unique_leads' + self.DATA_FILE_EXTENSION
         self.CURRENT_DIR = os.path.dirname(__file__)
         self.MODEL_FILE = 'decision_tree_model.pkl'
+        self.MODEL_ARRAYS_FILE = 'decision_tree_model.npz'
         self.LOG_FILE = 'app.log'
         self.LOG_FILE_PATH = os.path.join(self.CURRENT_DIR, self.LOG_FILE)
         self.TEMPLATE_FILE_PATH = os.path.join(
             self.CURRENT_DIR, 'template.csv')
 
-        # Variables to keep .csv data in state
-        self.meta_data_frame = None
-        self.unique_leads_data_frame = None
-        self.unique_directors_data_frame = None
-        self.unique_genres_data_frame = None
-        self.decision_tree_model = None
+        # Model, data and derived indexes, replaced whole when S3 changes
+        self.snapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_refresher = None
+        self.snapshot_reloads = 0
+        self.snapshot_last_checked = None
+        self.snapshot_last_error = None
+
+        # Process that built the app and process serving requests, which
+        # differ when a preforking server such as gunicorn forks workers
+        self.setup_process_id = os.getpid()
+        self.process_id = None
+        self.process_lock = threading.Lock()
+
+        # Lay the snapshot out for sharing between forked workers
+        self.SHARED_SNAPSHOT = os.environ.get(
+            'SHARED_SNAPSHOT', '').lower() in ('1', 'true')
+
+        # Seconds between checks for new files in S3, 0 disables reloading
+        self.SNAPSHOT_REFRESH_SECONDS = float(
+            os.environ.get('SNAPSHOT_REFRESH_SECONDS', 300))
+
+        # Cached score chart shared by all predictions
+        self.score_chart = None
+
+        # Set once the warm-up has imported what the chart needs and built
+        # it. /ready answers 503 until then, so no traffic is routed here.
+        self.ready = threading.Event()
+        self.warm_up_thread = None
+        self.warm_up_error = None
+
+        # Finish the warm-up while serving, or before setup returns, which
+        # gunicorn wants when preloading so workers fork from a warm process
+        self.WARM_UP_IN_BACKGROUND = os.environ.get(
+            'WARM_UP_IN_BACKGROUND', '1').lower() in ('1', 'true')
+
+        # Seconds /predict waits for the warm-up before answering 503
+        self.WARM_UP_WAIT_SECONDS = float(
+            os.environ.get('WARM_UP_WAIT_SECONDS', 10))
+
+        # Seconds spent in each import and phase of startup
+        self.startup_timings = [
+            {'phase': 'import', 'name': 'app', 'seconds': IMPORT_SECONDS}]
+        self.ready_seconds = None
+
+        # Results of recent predictions, keyed by input and snapshot version
+        self.prediction_cache = create_prediction_cache()
+
+        # Sampled request profiling, None unless configured
+        self.request_profiler = RequestProfiler.from_settings()
+
+        # Search settings
+        self.SEARCH_DEFAULT_LIMIT = 20
+        self.SEARCH_MAX_LIMIT = 1000
+        self.SEARCH_SUBSTRING_INDEX = os.environ.get(
+            'SEARCH_SUBSTRING_INDEX', '').lower() in ('1', 'true')
+        self.SEARCH_SUBSTRING_UNAVAILABLE_ERROR = \
+            'Substring search is not enabled, set SEARCH_SUBSTRING_INDEX=1'
+
+        # Upload limits. Requests over the size limit are refused while
+        # the body is still arriving, the rest is checked as it is parsed.
+        self.UPLOAD_SETTINGS = upload_settings()
+        self.config['MAX_CONTENT_LENGTH'] = self.UPLOAD_SETTINGS['max_bytes'] + 64 * 1024
+
+        # Batch prediction settings
+        self.BATCH_COLUMNS = ['lead', 'director', 'genre', 'budget']
+        self.BATCH_STREAM_CHUNK_ROWS = 1000
+
+        # Answer for inputs the model cannot score, single or batch
+        self.UNSCORABLE_ERROR = 'Unknown lead, director, genre or invalid budget'
 
     def download_model_from_s3(self):
-        # Download the model file from S3
-        model_file_content = self.s3.get_object(
-            Bucket=self.MODEL_BUCKET, Key=self.MODEL_FILE)['Body'].read()
-
-        # Load the model from the downloaded content
-        self.decision_tree_model = joblib.load(BytesIO(model_file_content))
-
-        print(f"Model downloaded from S3: {self.MODEL_FILE}")
-
-    def download_csv_from_s3(self, bucket, key):
-        # Download and read CSV content from S3
-        file_content = self.s3.get_object(Bucket=bucket, Key=key)[
-            'Body'].read().decode('utf-8')
-        return pd.read_csv(StringIO(file_content))
-
-    def download_processed_data(self):
-        file_keys = [
+        # Prefer the flat arrays, which are scored without loading sklearn
+        try:
+            key = self.MODEL_ARRAYS_FILE
+            with load_phase('download', key):
+                model_file_content, etag = self.storage.get_object(
+                    self.MODEL_BUCKET, key)
+            with load_phase('model_load', key):
+                decision_tree_model = FlatTree.from_bytes(
+                    model_file_content, row_lists=not self.SHARED_SNAPSHOT)
+        except ObjectNotFound:
+            # Models trained before the arrays were exported only have the pickle
+            print(f"Info: {self.MODEL_ARRAYS_FILE} not found, reading {self.MODEL_FILE}")
+            key = self.MODEL_FILE
+            with load_phase('download', key):
+                model_file_content, etag = self.storage.get_object(
+                    self.MODEL_BUCKET, key)
+            # joblib is only needed for these, so it is imported here
+            import joblib
+            with load_phase('model_load', key):
+                decision_tree_model = joblib.load(BytesIO(model_file_content))
+
+        print(f"Model downloaded from S3: {key}")
+
+        if self.storage.cache:
+            print(f"S3 cache stats: {self.storage.cache.stats()}")
+
+        return decision_tree_model, key, etag
+
+    def download_data_frame_from_s3(self, bucket, key):
+        # Download processed data, falling back to the CSV copy if missing
+        try:
+            with load_phase('download', key):
+                file_content, etag = self.storage.get_object(bucket, key)
+        except ObjectNotFound:
+            if key == csv_key(key):
+                raise
+            print(f"Info: {key} not found, reading {csv_key(key)}")
+            key = csv_key(key)
+            with load_phase('download', key):
+                file_content, etag = self.storage.get_object(bucket, key)
+
+        # Parse straight from bytes in the format given by the extension
+        with load_phase('parse', key):
+            data_frame = read_data_frame(file_content, key, processed_schema(key))
+
+        return data_frame, key, etag
+
+    def processed_file_keys(self):
+        return [
             self.INPUT_DATA_FILE,
             self.UNIQUE_DIRECTORS_FILE,
             self.UNIQUE_GENRES_FILE,
             self.UNIQUE_LEADS_FILE,
         ]
 
-        # Download and read CSV files into DataFrames
-        for file_key in file_keys:
-            data_frame = self.download_csv_from_s3(
-                self.PROCESSED_BUCKET, file_key)
+    def download_processed_data(self):
+        file_keys = self.processed_file_keys()
+
+        # Download and read the files into DataFrames in parallel
+        downloads = self.storage.map(
+            lambda file_key: self.download_data_frame_from_s3(
+                self.PROCESSED_BUCKET, file_key),
+            file_keys)
+
+        data_frames = {}
+        files = {}
+        for file_key, (data_frame, key, etag) in zip(file_keys, downloads):
+            data_frames[file_key] = data_frame
+            files[f"{self.PROCESSED_BUCKET}/{key}"] = etag
+
+            print(f"Data frame created from s3: {key}")
+
+        return data_frames, files
+
+    def load_snapshot(self):
+        # Download everything and build the indexes before anything uses it
+        with load_phase('snapshot'):
+            snapshot = self.build_snapshot()
+
+        print(f"Snapshot loaded: {snapshot.version}")
+
+        return snapshot
+
+    def build_snapshot(self):
+        data_frames, files = self.download_processed_data()
+        decision_tree_model, model_key, model_etag = self.download_model_from_s3()
+        files[f"{self.MODEL_BUCKET}/{model_key}"] = model_etag
+
+        return DataSnapshot(
+            files,
+            data_frames[self.INPUT_DATA_FILE],
+            data_frames[self.UNIQUE_LEADS_FILE],
+            data_frames[self.UNIQUE_DIRECTORS_FILE],
+            data_frames[self.UNIQUE_GENRES_FILE],
+            decision_tree_model,
+            substring_search=self.SEARCH_SUBSTRING_INDEX,
+            shared=self.SHARED_SNAPSHOT)
+
+    def remote_files(self):
+        # Current ETags of the files a snapshot is built from
+        def head(file):
+            # The first of the file's keys that exists, as loading would pick
+            bucket, keys = file
+            for key in keys:
+                etag = self.storage.head_etag(bucket, key)
+                if etag is not None:
+                    break
+            return f"{bucket}/{key}", etag
+
+        files = [(self.PROCESSED_BUCKET, [key, csv_key(key)])
+                 for key in self.processed_file_keys()]
+        files.append((self.MODEL_BUCKET, [self.MODEL_ARRAYS_FILE, self.MODEL_FILE]))
+
+        return dict(self.storage.map(head, files))
+
+    def refresh_snapshot(self):
+        # Load a new snapshot if any file changed in S3, off the request path
+        with self.snapshot_lock:
+            self.snapshot_last_checked = datetime.now()
+
+            try:
+                if self.remote_files() == self.snapshot.files:
+                    return False
+                snapshot = self.load_snapshot()
+            except Exception as e:
+                self.snapshot_last_error = str(e)
+                print(f"Error refreshing snapshot: {e}")
+                return False
+
+            # Requests already running keep the snapshot they started with
+            self.snapshot = snapshot
+            self.snapshot_reloads += 1
+            self.snapshot_last_error = None
+
+            return True
+
+    def refresh_snapshot_forever(self):
+        while True:
+            time.sleep(self.SNAPSHOT_REFRESH_SECONDS)
+            self.refresh_snapshot()
+
+    def start_snapshot_refresher(self):
+        if self.SNAPSHOT_REFRESH_SECONDS <= 0:
+            return
+
+        self.snapshot_refresher = threading.Thread(
+            target=self.refresh_snapshot_forever, name='snapshot-refresher', daemon=True)
+        self.snapshot_refresher.start()
+
+    def freeze_shared_objects(self):
+        # Move everything loaded so far out of the garbage collector's reach,
+        # so collections in forked workers do not write to the shared pages
+        if self.SHARED_SNAPSHOT:
+            gc.collect()
+            gc.freeze()
+
+    def start_process(self):
+        # Runs before each request, setting up the serving process once.
+        # Clients and threads do not survive a fork, so a worker forked
+        # from the process that loaded the app makes its own.
+        if self.process_id == os.getpid():
+            return
+
+        with self.process_lock:
+            if self.process_id == os.getpid():
+                return
+
+            if os.getpid() != self.setup_process_id:
+                self.load_env()
+                self.snapshot_lock = threading.Lock()
+
+            self.process_id = os.getpid()
+            self.start_snapshot_refresher()
+
+            # A worker forked before the warm-up finished has no thread to
+            # finish it, so it runs its own
+            if not self.ready.is_set() and not self.warm_up_thread.is_alive():
+                self.start_warm_up()
+
+    @contextmanager
+    def startup_phase(self, phase, name=''):
+        start = time.perf_counter()
+        yield
+        self.startup_timings.append(
+            {'phase': phase, 'name': name, 'seconds': time.perf_counter() - start})
+
+    def start_warm_up(self):
+        self.warm_up_error = None
+        self.warm_up_thread = threading.Thread(
+            target=self.warm_up, name='warm-up', daemon=True)
+        self.warm_up_thread.start()
+
+    def warm_up(self):
+        # Import the libraries only the chart needs, one at a time so each
+        # is timed, then build the chart and render it once
+        try:
+            for module in WARM_UP_MODULES:
+                with self.startup_phase('import', module), load_phase('import', module):
+                    importlib.import_module(module)
 
-            # Assign DataFrames to state fields based on key
-            if "input_data" in file_key:
-                self.meta_data_frame = data_frame
-            elif "unique_leads" in file_key:
-                self.unique_leads_data_frame = data_frame
-            elif "unique_directors" in file_key:
-                self.unique_directors_data_frame = data_frame
-            elif "unique_genres" in file_key:
-                self.unique_genres_data_frame = data_frame
+            with self.startup_phase('score_chart'), load_phase('score_chart'):
+                self.setup_score_chart()
 
-            print(f"Data frame created from s3: {file_key}")
+            # The first render loads fonts and fills matplotlib's caches
+            with self.startup_phase('first_chart'):
+                self.score_chart.render_png(0)
+        except Exception as e:
+            self.warm_up_error = str(e)
+            print(f"Error warming up: {e}")
+            return
+
+        self.ready_seconds = time.perf_counter() - IMPORT_STARTED
+        self.ready.set()
+        print(f"Ready after {self.ready_seconds:.3f}s")
+
+    def startup(self):
+        # Seconds from the start of importing the app until it was ready
+        return {
+            'ready_seconds': self.ready_seconds,
+            'timings': list(self.startup_timings),
+        }
 
     def setup_logging(self):
         handler = RotatingFileHandler(
@@ -113,7 +392,14 @@ class EtlProjectApp(Flask):
         self.route('/template', methods=['GET'])(self.download_template)
         self.route('/upload', methods=['POST'])(self.upload_file)
         self.route('/search', methods=['GET'])(self.search)
+        self.route('/status', methods=['GET'])(self.status)
+        self.route('/ready', methods=['GET'])(self.readiness)
+        self.route('/metrics', methods=['GET'])(self.metrics)
+        self.route('/admin/profiles', methods=['GET'])(self.list_profiles)
+        self.route('/admin/profiles/<int:profile_id>.<profile_format>',
+                   methods=['GET'])(self.download_profile)
         self.route('/predict', methods=['POST'])(self.predict)
+        self.route('/predict/batch', methods=['POST'])(self.predict_batch)
         self.route('/')(self.index)
         self.route('/<path:catch_all>', methods=['GET'])(self.catch_all_route)
 
@@ -131,122 +417,172 @@ class EtlProjectApp(Flask):
 
     def upload_file(self):
         error = None
+        status = 200
 
         try:
             # Check if 'csv' is present in the request.files
             if 'csv' not in request.files:
-                raise Exception('Error: No CSV file in the request')
+                raise UploadRejected('Error: No CSV file in the request')
 
             file = request.files['csv']
 
-            # Generate a timestamp for the filename
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+            # Parse, validate and stage the file as typed shards while
+            # reading it, rejecting it at the first problem
+            UploadIngester(self.storage, self.UPLOADS_BUCKET, self.UPLOAD_SETTINGS).ingest(
+                file.stream, secure_filename(file.filename) or 'upload.csv')
 
-            # Append the timestamp to the original filename
-            filename = timestamp + '_' + secure_filename(file.filename)
+        except UploadRejected as e:
+            error = str(e)
+            status = 400
+            print(f"Upload rejected: {error}")
 
-            # Upload the file to S3 directly from the stream
-            self.s3.upload_fileobj(file, self.UPLOADS_BUCKET, filename)
+        except RequestEntityTooLarge:
+            error = f"Error: File is larger than {self.UPLOAD_SETTINGS['max_bytes']} bytes"
+            status = 413
+            print(f"Upload rejected: {error}")
 
         except Exception as e:
             error = str(e)
+            status = 500
             # Add debug statement to print the exception
             print(f"Error during file upload: {error}")
 
         # Return the rendered template with error information
-        return render_template('main.html', error=error)
+        return render_template('main.html', error=error), status
 
     def search(self):
         search_term = request.args.get('search_term')
         field_name = request.args.get('field_name')
+        mode = request.args.get('mode', 'prefix')
 
-        if (field_name and search_term):
-            # Initialize data_list as an empty list
-            data_list = []
+        # Clamp the number of results returned to the allowed range
+        try:
+            limit = int(request.args.get('limit', self.SEARCH_DEFAULT_LIMIT))
+        except ValueError:
+            limit = self.SEARCH_DEFAULT_LIMIT
+        limit = max(1, min(limit, self.SEARCH_MAX_LIMIT))
+
+        search_indexes = self.snapshot.search_indexes
 
-            # Retrieve the appropriate data list based on field_name
-            if field_name == 'lead':
-                data_list = self.unique_leads_data_frame.to_dict(
-                    orient='records')
-            elif field_name == 'director':
-                data_list = self.unique_directors_data_frame.to_dict(
-                    orient='records')
-            elif field_name == 'genre':
-                data_list = self.unique_genres_data_frame.to_dict(
-                    orient='records')
+        if (field_name in search_indexes and search_term):
+            search_index = search_indexes[field_name]
 
-            filtered_items = [item for item in data_list if item.get(
-                field_name, "").lower().startswith(search_term.lower()) if field_name in item]
+            if mode == 'substring':
+                # Rather than quietly answer with prefix matches
+                if not search_index.has_substring_index():
+                    return {'error': self.SEARCH_SUBSTRING_UNAVAILABLE_ERROR}, 400
+                filtered_items = search_index.substring_search(search_term, limit)
+            else:
+                filtered_items = search_index.prefix_search(search_term, limit)
 
             return {'results': filtered_items}
 
         return {'results': []}
 
-    def plot_score(self, score):
-        matplotlib.use('Agg')
-
-        # Set the mean and standard deviation for the normal distribution
-        mean = 0
-        std_dev = 1
-        data_points = 100
-
-        # Generate random numbers from a normal distribution
-        data = np.random.normal(mean, std_dev, data_points)
+    def status(self):
+        snapshot = self.snapshot
+        last_checked = self.snapshot_last_checked
 
-        # Fit a normal distribution to the data
-        fit_mean, fit_std = norm.fit(data)
-
-        bins = max(10, round(data_points / 20))
+        return {
+            'snapshot': snapshot.status(),
+            'reloads': self.snapshot_reloads,
+            'refresh_seconds': self.SNAPSHOT_REFRESH_SECONDS,
+            'last_checked': last_checked.isoformat() if last_checked else None,
+            'last_error': self.snapshot_last_error,
+            'process_id': self.process_id,
+            'ready': self.ready.is_set(),
+            'startup': self.startup(),
+            'prediction_cache': self.prediction_cache.stats() if self.prediction_cache else None,
+        }
 
-        # Plot the histogram of the random numbers
-        plt.hist(data, bins=bins, density=True, alpha=0.5, color='#007bff')
+    def readiness(self):
+        # For load balancer health checks: 200 only once warmed up
+        ready = self.ready.is_set()
+        result = {
+            'ready': ready,
+            'error': self.warm_up_error,
+            'startup': self.startup(),
+        }
+        return result, 200 if ready else 503
+
+    def metrics(self):
+        content, content_type = render_metrics()
+        return Response(content, content_type=content_type)
+
+    def start_request_timer(self):
+        g.request_start = time.perf_counter()
+
+    def record_request(self, response):
+        # Label by route pattern, so arbitrary paths do not add new series
+        start = g.get('request_start')
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            observe_request(route, request.method, response.status_code,
+                            time.perf_counter() - start)
+        return response
 
-        # Overlay a normal distribution curve
-        xmin, xmax = plt.xlim()
-        x = np.linspace(xmin, xmax, 100)
-        p = norm.pdf(x, fit_mean, fit_std)
-        plt.plot(x, p, 'k', linewidth=2)
+    def start_request_profile(self):
+        if request.path.startswith('/admin/'):
+            return
+        if self.request_profiler.should_profile(request.headers):
+            g.request_profile = self.request_profiler.start()
+
+    def finish_request_profile(self, response):
+        started = g.pop('request_profile', None)
+        if started is not None:
+            self.request_profiler.finish(started, {
+                'route': request.url_rule.rule if request.url_rule else 'unmatched',
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+            })
+        return response
 
-        # Add vertical lines to represent percentiles
-        percentiles = [25, 50, 75]
-        percentile_values = np.percentile(data, percentiles)
-        for percentile, value in zip(percentiles, percentile_values):
-            plt.axvline(value, color='black', linestyle='dashed', linewidth=1)
+    def profiles_authorized(self):
+        # Profiles show code and timings, so only hand them to the token holder
+        return self.request_profiler is not None and self.request_profiler.authorized(
+            request.headers.get(self.request_profiler.header))
 
-        # Add a vertical line to represent a specific value (e.g., x=2)
-        plt.axvline(score, color='#007bff', linestyle='solid',
-                    linewidth=2, label=f'Your score')
+    def list_profiles(self):
+        if not self.profiles_authorized():
+            return {'error': 'Not found'}, 404
 
-        # Calculate and display the percentile of the specific value
-        score_percentile = percentileofscore(data, score)
-        plt.title(f'Score Distribution')
+        return {
+            'profiled': self.request_profiler.profiled,
+            'profiles': self.request_profiler.profiles(),
+        }
 
-        # Add labels and title
-        plt.xlabel('Value')
-        plt.ylabel('Probability Density')
+    def download_profile(self, profile_id, profile_format):
+        # pstats for pstats.Stats or snakeviz, collapsed stacks for flamegraph.pl
+        if not self.profiles_authorized():
+            return {'error': 'Not found'}, 404
 
-        # Add legend
-        plt.legend()
+        stats = self.request_profiler.stats(profile_id)
+        if stats is None or profile_format not in ('pstats', 'collapsed'):
+            return {'error': 'Not found'}, 404
 
-        # Save the plot as a PNG in memory
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png')
-        buffer.seek(0)
+        if profile_format == 'pstats':
+            content, mimetype = pstats_bytes(stats), 'application/octet-stream'
+        else:
+            content, mimetype = collapsed_stacks(stats), 'text/plain'
 
-        # Convert the image data to a base64-encoded string
-        image_string = base64.b64encode(buffer.read()).decode('utf-8')
+        response = Response(content, mimetype=mimetype)
+        response.headers['Content-Disposition'] = \
+            f"attachment; filename=request_{profile_id}.{profile_format}"
+        return response
 
-        # Close the buffer to free up resources
-        buffer.close()
+    def setup_score_chart(self):
+        # Sample and fit the score distribution once for every request
+        self.score_chart = ScoreChart()
 
-        plt.clf()
+    def plot_score(self, score):
+        # Overlay the score on the cached chart background
+        image_string = self.score_chart.render_png(score)
+        score_percentile = self.score_chart.percentile(score)
 
         return image_string, score_percentile
 
     def predict(self):
-        # Shortened name for self.uploads_data_frames
-        meta_df = self.meta_data_frame
-
         # Extract input data from the POST request
         data = request.get_json()
         lead = float(data.get('lead'))
@@ -254,52 +590,153 @@ class EtlProjectApp(Flask):
         genre = float(data.get('genre'))
         budget = float(data.get('budget'))
 
-        # Calculate artificial features
-        matching_rows = meta_df[(meta_df['lead'] == lead)]
-        lead_average_profit_ratio = matching_rows['profit_ratio'].mean()
+        # Use one snapshot for the whole request, even if a reload happens
+        snapshot = self.snapshot
 
-        matching_rows = meta_df[(
-            meta_df['director'] == director)]
-        director_average_profit_ratio = matching_rows['profit_ratio'].mean()
+        # Repeated inputs reuse the result computed from the same snapshot
+        if self.prediction_cache:
+            with predict_stage('cache_lookup'):
+                cache_key = prediction_key(lead, director, genre, budget, data.get('chart'))
+                result = self.prediction_cache.get(snapshot.version, cache_key)
+            if result is not None:
+                with predict_stage('serialization'):
+                    return self.json.response(result)
 
-        lead_worked_in_genre_count = meta_df[
-            (meta_df['lead'] == lead) &
-            (meta_df['genre'] == genre)
-        ].shape[0]
-
-        director_worked_in_genre_count = meta_df[
-            (meta_df['director'] == director) &
-            (meta_df['genre'] == genre)
-        ].shape[0]
-
-        director_worked_with_lead_count = meta_df[
-            (meta_df['director'] == director) &
-            (meta_df['lead'] == lead)
-        ].shape[0]
+        # Look up artificial features from the precomputed aggregates
+        with predict_stage('feature_lookup'):
+            features = snapshot.feature_index.lookup(lead, director, genre)
 
         # Create an input array for prediction
         input = [[
             budget,
-            director_average_profit_ratio,
-            lead_average_profit_ratio,
-            lead_worked_in_genre_count,
-            director_worked_in_genre_count,
-            director_worked_with_lead_count,
+            features['director_average_profit_ratio'],
+            features['lead_average_profit_ratio'],
+            features['lead_worked_in_genre_count'],
+            features['director_worked_in_genre_count'],
+            features['director_worked_with_lead_count'],
         ]]
 
-        # Make predictions using the decision tree model
-        profit_ratio_prediction = self.decision_tree_model.predict(input)
-
-        image_string, score_percentile = self.plot_score(
-            profit_ratio_prediction)
-
-        profit = round((profit_ratio_prediction[0] * budget) - budget)
+        # Unknown leads or directors have no average, which the model refuses
+        if np.isnan(input).any():
+            return {'error': self.UNSCORABLE_ERROR}, 400
 
-        return {
-            'profit': "${:,.2f}".format(profit),
-            'score_percentile': tuple(score_percentile)[0],
-            'image_string': image_string
-        }
+        # Make predictions using the decision tree model
+        with predict_stage('model_inference'):
+            profit_ratio_prediction = snapshot.decision_tree_model.predict(input)
+
+        score = float(profit_ratio_prediction[0])
+        profit = round((score * budget) - budget)
+
+        result = {'profit': "${:,.2f}".format(profit)}
+
+        # The chart is built by the warm-up, which may not have finished
+        if not self.ready.wait(self.WARM_UP_WAIT_SECONDS):
+            return {'error': 'Error: Still warming up, try again shortly'}, 503
+
+        # Either send chart data for the browser or a rendered image
+        with predict_stage('chart'):
+            if data.get('chart') == 'json':
+                result['score_percentile'] = self.score_chart.percentile(score)
+                result['chart'] = self.score_chart.to_dict(score)
+            else:
+                image_string, score_percentile = self.plot_score(score)
+                result['score_percentile'] = score_percentile
+                result['image_string'] = image_string
+
+        if self.prediction_cache:
+            self.prediction_cache.put(snapshot.version, cache_key, result)
+
+        with predict_stage('serialization'):
+            return self.json.response(result)
+
+    def read_batch_request(self):
+        # Accept a CSV file upload, a raw CSV body or a JSON array of objects
+        if 'csv' in request.files:
+            batch_df = pd.read_csv(request.files['csv'])
+        elif request.mimetype == 'text/csv':
+            batch_df = pd.read_csv(BytesIO(request.get_data()))
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, list):
+                raise Exception('Error: Expected a JSON array or CSV file')
+            batch_df = pd.DataFrame(data)
+
+        missing_columns = [
+            column for column in self.BATCH_COLUMNS if column not in batch_df.columns]
+        if missing_columns:
+            raise Exception(
+                f"Error: Missing columns: {', '.join(missing_columns)}")
+
+        return batch_df.reset_index(drop=True)
+
+    def resolve_type_ids(self, snapshot, column, values):
+        # Numeric values are ids already, anything else is looked up by name
+        ids = pd.to_numeric(values, errors='coerce').astype(float)
+        names = values[ids.isna() & values.notna()]
+        if not names.empty:
+            ids.loc[names.index] = snapshot.type_id_lookups[column].reindex(
+                names.astype(str)).to_numpy(dtype=float)
+        return ids.to_numpy()
+
+    def predict_batch(self):
+        try:
+            batch_df = self.read_batch_request()
+        except Exception as e:
+            error = str(e)
+            print(f"Error during batch prediction: {error}")
+            return {'error': error}, 400
+
+        # Use one snapshot for the whole request, even if a reload happens
+        snapshot = self.snapshot
+
+        leads = self.resolve_type_ids(snapshot, 'lead', batch_df['lead'])
+        directors = self.resolve_type_ids(snapshot, 'director', batch_df['director'])
+        genres = self.resolve_type_ids(snapshot, 'genre', batch_df['genre'])
+        budgets = pd.to_numeric(
+            batch_df['budget'], errors='coerce').to_numpy(dtype=float)
+
+        # Look up artificial features for every row at once
+        features = snapshot.feature_index.lookup_batch(leads, directors, genres)
+        inputs = np.column_stack(
+            [budgets, features[FEATURE_COLUMNS].to_numpy(dtype=float)])
+
+        # Rows with unknown names or ids cannot be scored
+        valid = ~np.isnan(inputs).any(axis=1)
+        profit_ratio_predictions = np.full(len(batch_df), np.nan)
+        if valid.any():
+            # Make predictions for all valid rows in a single model call
+            profit_ratio_predictions[valid] = snapshot.decision_tree_model.predict(
+                inputs[valid])
+
+        # Echo titles back when the request provides them
+        titles = [None] * len(batch_df)
+        if 'title' in batch_df.columns:
+            titles = batch_df['title'].astype(object).where(
+                batch_df['title'].notna(), None).tolist()
+
+        def result(row):
+            item = {} if titles[row] is None else {'title': titles[row]}
+            if not valid[row]:
+                item['error'] = self.UNSCORABLE_ERROR
+                return item
+
+            profit_ratio = profit_ratio_predictions[row]
+            profit = round((profit_ratio * budgets[row]) - budgets[row])
+            item['profit'] = "${:,.2f}".format(profit)
+            item['profit_ratio'] = float(profit_ratio)
+            return item
+
+        if request.args.get('stream', '').lower() in ('1', 'true'):
+            def generate():
+                # Stream newline-delimited JSON in chunks of rows
+                for start in range(0, len(batch_df), self.BATCH_STREAM_CHUNK_ROWS):
+                    end = min(start + self.BATCH_STREAM_CHUNK_ROWS, len(batch_df))
+                    yield ''.join(
+                        json.dumps(result(row)) + '\n' for row in range(start, end))
+
+            return Response(generate(), mimetype='application/x-ndjson')
+
+        return {'results': [result(row) for row in range(len(batch_df))]}
 
     def catch_all_route(self, catch_all):
         return render_template('main.html')
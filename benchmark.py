@@ -0,0 +1,356 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+from queue import Empty
+
+import numpy as np
+
+from storage import LocalStorage
+from synthetic_data import parse_scale, write_raw_data, write_uploads
+
+try:
+    import resource
+except ImportError:
+    # Peak memory is not reported on Windows
+    resource = None
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SCALES = '10k,100k'
+DEFAULT_WORK_DIR = os.path.join(CURRENT_DIR, 'benchmark_data')
+DEFAULT_OUTPUT = os.path.join(CURRENT_DIR, 'benchmark_results.json')
+
+
+def peak_rss_bytes():
+    # Peak resident memory of this process so far
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=CURRENT_DIR, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def stage_environment(scale_dir):
+    # Run every stage against local storage in the scale's own directory
+    storage_dir = os.path.join(scale_dir, 'storage')
+    return {
+        'STORAGE_BACKEND': 'local',
+        'LOCAL_STORAGE_DIR': storage_dir,
+        'RAW_DATA_DIR': os.path.join(scale_dir, 'raw'),
+        'PROCESSED_DATA_DIR': os.path.join(storage_dir, 'etl-project-data-processed'),
+        'PROCESSED_BUCKET': 'etl-project-data-processed',
+        'UPLOADS_BUCKET': 'etl-project-uploads',
+        'MODEL_BUCKET': 'etl-project-ml-model',
+        'S3_CACHE_ENABLED': '0',
+        'SNAPSHOT_REFRESH_SECONDS': '0',
+    }
+
+
+def timed(function):
+    start = time.perf_counter()
+    value = function()
+    return value, time.perf_counter() - start
+
+
+def result(stage, seconds, items, unit, **extra):
+    return {
+        'stage': stage,
+        'wall_seconds': seconds,
+        'items': items,
+        'unit': unit,
+        'throughput_per_second': items / seconds if seconds else None,
+        **extra,
+    }
+
+
+def run_generate(options):
+    import generate_ml_datasets
+
+    os.makedirs(generate_ml_datasets.PROCESSED_DIR, exist_ok=True)
+    _, seconds = timed(generate_ml_datasets.main)
+    return [result('generate', seconds, options['movies'], 'movies')]
+
+
+def run_etl(options):
+    from update_ml_datasets import ETLProcessor
+
+    etl_processor = ETLProcessor()
+    _, seconds = timed(etl_processor.run_etl_process)
+    rows = options['uploads'] * options['upload_rows']
+    return [result('etl', seconds, rows, 'upload rows',
+                   output_rows=len(etl_processor.meta_data_frame))]
+
+
+def run_train(options):
+    from data_modeller import MLModelTrainer
+
+    ml_model_trainer = MLModelTrainer()
+    _, seconds = timed(ml_model_trainer.run_training_process)
+    return [result('train', seconds, len(ml_model_trainer.meta_data_frame), 'rows')]
+
+
+def run_model(options):
+    import joblib
+    from data_modeller import MLModelTrainer
+    from flat_tree import FlatTree, rejects_missing_features
+
+    # Score the trainer's held-out rows with sklearn and the flat arrays
+    ml_model_trainer = MLModelTrainer()
+    ml_model_trainer.load_data_from_s3()
+    ml_model_trainer.prepare_data()
+    storage = ml_model_trainer.storage
+    model = joblib.load(BytesIO(storage.get_object_bytes(
+        ml_model_trainer.MODEL_BUCKET, ml_model_trainer.MODEL_FILE)))
+    flat_tree = FlatTree.from_bytes(storage.get_object_bytes(
+        ml_model_trainer.MODEL_BUCKET, ml_model_trainer.MODEL_ARRAYS_FILE))
+
+    X_test = ml_model_trainer.X_test.to_numpy(dtype=float)
+    if not np.array_equal(model.predict(X_test), flat_tree.predict(X_test)):
+        raise Exception('Error: Flat tree predictions differ from the model')
+    if rejects_missing_features(flat_tree.predict, X_test) != \
+            rejects_missing_features(model.predict, X_test):
+        raise Exception('Error: Flat tree handles missing features differently from the model')
+
+    # Single rows as a list, the way /predict builds its input
+    rows = [[row.tolist()] for row in X_test[:options['requests']]]
+    results = []
+    for stage, predict in (('model_sklearn', model.predict),
+                           ('model_flat_tree', flat_tree.predict)):
+        seconds, latencies = time_calls(predict, rows)
+        batch_seconds = timed(lambda: predict(X_test))[1]
+        results.append(result(stage, seconds, len(rows), 'rows', **latency_stats(latencies),
+                              batch_rows=len(X_test), batch_seconds=batch_seconds))
+    return results
+
+
+def time_calls(function, arguments):
+    # Call function on each argument in turn, returning total and per-call seconds
+    latencies = []
+    start = time.perf_counter()
+    for argument in arguments:
+        call_start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - call_start)
+    return time.perf_counter() - start, latencies
+
+
+def latency_stats(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'latency_ms_p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def time_requests(send, payloads):
+    # Send each request in turn, returning total seconds and per-request latency
+    latencies = []
+    start = time.perf_counter()
+    for payload in payloads:
+        request_start = time.perf_counter()
+        response = send(payload)
+        latencies.append(time.perf_counter() - request_start)
+        if response.status_code != 200:
+            raise Exception(f"Error: Request failed with {response.status_code}")
+    return time.perf_counter() - start, latencies
+
+
+def run_serve(options):
+    rng = np.random.default_rng(options['seed'])
+
+    # Importing the app downloads the data and builds the indexes
+    app_module, startup_seconds = timed(lambda: __import__('app'))
+    client = app_module.app.test_client()
+    snapshot = app_module.app.snapshot
+    meta_data_frame = snapshot.meta_data_frame
+
+    # Predict for known combinations so every request does the full lookup
+    rows = meta_data_frame.iloc[rng.integers(0, len(meta_data_frame), options['requests'])]
+    predict_payloads = [
+        {'lead': int(row.lead), 'director': int(row.director),
+         'genre': int(row.genre), 'budget': float(row.budget)}
+        for row in rows.itertuples()]
+    predict_seconds, predict_latencies = time_requests(
+        lambda payload: client.post('/predict', json=payload), predict_payloads)
+
+    # Search with short prefixes of real names, as typed into the form
+    search_payloads = []
+    for column, type_df in snapshot.type_data_frames():
+        names = type_df[column].astype(str).to_numpy()
+        for name in names[rng.integers(0, len(names), options['requests'] // 3 + 1)]:
+            search_payloads.append(
+                {'field_name': column, 'search_term': name[:rng.integers(1, 4)]})
+    search_seconds, search_latencies = time_requests(
+        lambda payload: client.get('/search', query_string=payload), search_payloads)
+
+    return [
+        result('startup', startup_seconds, len(meta_data_frame), 'rows'),
+        result('predict', predict_seconds, len(predict_payloads), 'requests',
+               **latency_stats(predict_latencies)),
+        result('search', search_seconds, len(search_payloads), 'requests',
+               **latency_stats(search_latencies)),
+    ]
+
+
+STAGES = {
+    'generate': run_generate,
+    'etl': run_etl,
+    'train': run_train,
+    'model': run_model,
+    'serve': run_serve,
+}
+
+
+def stage_worker(stage, options, queue):
+    # Runs in a fresh process so peak memory belongs to this stage alone
+    try:
+        results = STAGES[stage](options)
+        peak = peak_rss_bytes()
+        for item in results:
+            item['peak_rss_bytes'] = peak
+        queue.put(('ok', results))
+    except Exception as e:
+        queue.put(('error', f"{type(e).__name__}: {e}"))
+
+
+def run_stage(stage, options, environment):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+
+    # Child processes read their configuration from the environment
+    previous = {key: os.environ.get(key) for key in environment}
+    os.environ.update(environment)
+    try:
+        process = context.Process(target=stage_worker, args=(stage, options, queue))
+        process.start()
+
+        # Stop waiting if the stage dies without reporting, e.g. out of memory
+        while True:
+            try:
+                status, value = queue.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    status, value = 'error', f"exited with code {process.exitcode}"
+                    break
+        process.join()
+    finally:
+        for key, value_before in previous.items():
+            if value_before is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value_before
+
+    if status != 'ok':
+        raise Exception(f"Error: Stage {stage} failed: {value}")
+    return value
+
+
+def prepare_scale(scale_dir, options, environment):
+    # Raw files are reused between runs, uploads are consumed by the ETL
+    raw_dir = environment['RAW_DATA_DIR']
+    marker = os.path.join(raw_dir, f"movies_{options['movies']}_seed_{options['seed']}")
+    if not os.path.exists(marker):
+        write_raw_data(raw_dir, options['movies'], seed=options['seed'])
+        open(marker, 'w').close()
+
+    storage = LocalStorage(environment['LOCAL_STORAGE_DIR'])
+    storage.delete_keys(environment['UPLOADS_BUCKET'],
+                        storage.list_keys(environment['UPLOADS_BUCKET']))
+    write_uploads(storage, environment['UPLOADS_BUCKET'], options['movies'],
+                  options['uploads'], options['upload_rows'], seed=options['seed'])
+
+
+def run_benchmarks(scales, stages, work_dir, options):
+    results = []
+    for scale in scales:
+        movies = parse_scale(scale)
+        scale_dir = os.path.join(work_dir, str(movies))
+        environment = stage_environment(scale_dir)
+        scale_options = dict(options, movies=movies)
+
+        prepare_scale(scale_dir, scale_options, environment)
+
+        for stage in stages:
+            print(f"Benchmarking {stage} at {movies} movies")
+            for item in run_stage(stage, scale_options, environment):
+                item['movies'] = movies
+                results.append(item)
+                print(f"{item['stage']}: {item['wall_seconds']:.3f}s, "
+                      f"{item['throughput_per_second'] or 0:.1f} {item['unit']}/s")
+
+    return results
+
+
+def save_results(path, run):
+    # Append to earlier runs so results can be compared between commits
+    runs = []
+    if os.path.exists(path):
+        with open(path) as file:
+            runs = json.load(file)
+    runs.append(run)
+
+    with open(path, 'w') as file:
+        json.dump(runs, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the ETL, training and serving stages on synthetic data')
+    parser.add_argument('--scales', default=DEFAULT_SCALES,
+                        help='comma separated movie counts, e.g. 10k,100k,1M,10M')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages to run, in order')
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--uploads', type=int, default=20,
+                        help='number of upload CSV files for the ETL')
+    parser.add_argument('--upload-rows', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='number of /predict and /search requests')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    options = {
+        'uploads': args.uploads,
+        'upload_rows': args.upload_rows,
+        'requests': args.requests,
+        'seed': args.seed,
+    }
+    stages = [stage for stage in args.stages.split(',') if stage]
+    for stage in stages:
+        if stage not in STAGES:
+            raise Exception(f"Error: Unknown stage {stage}")
+
+    run = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'results': run_benchmarks(args.scales.split(','), stages, args.work_dir, options),
+    }
+    save_results(args.output, run)
+
+    print(f"Benchmark results saved: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
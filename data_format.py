@@ -0,0 +1,44 @@
+import os
+from io import BytesIO
+
+import pandas as pd
+
+from schema import apply_schema
+
+CSV_EXTENSION = '.csv'
+PARQUET_EXTENSION = '.parquet'
+
+# Compression used for Parquet files in the processed bucket
+PARQUET_COMPRESSION = 'zstd'
+
+
+def processed_data_extension():
+    # File format for processed datasets, 'parquet' unless configured otherwise
+    data_format = os.environ.get('PROCESSED_DATA_FORMAT', 'parquet').lower()
+    return CSV_EXTENSION if data_format == 'csv' else PARQUET_EXTENSION
+
+
+def csv_key(key):
+    # Key of the CSV copy of a processed file, used as a fallback
+    return os.path.splitext(key)[0] + CSV_EXTENSION
+
+
+def read_data_frame(content, key, schema=None):
+    # Parse file content straight from bytes, choosing the format by extension,
+    # and cast to the schema, as files written before it have wider dtypes
+    if key.endswith(PARQUET_EXTENSION):
+        data_frame = pd.read_parquet(BytesIO(content))
+    else:
+        data_frame = pd.read_csv(BytesIO(content))
+    return apply_schema(data_frame, schema)
+
+
+def write_data_frame(data_frame, key, schema=None):
+    # Serialise a DataFrame to bytes, choosing the format by extension
+    data_frame = apply_schema(data_frame, schema)
+    if key.endswith(PARQUET_EXTENSION):
+        buffer = BytesIO()
+        data_frame.to_parquet(buffer, index=False,
+                              compression=PARQUET_COMPRESSION)
+        return buffer.getvalue()
+    return data_frame.to_csv(index=False).encode('utf-8')
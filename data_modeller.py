@@ -1,11 +1,18 @@
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeRegressor
 from sklearn.metrics import mean_squared_error, r2_score
 import joblib
-import boto3
+import json
+import os
 from io import BytesIO
-from env import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+from data_format import csv_key, processed_data_extension, read_data_frame
+from flat_tree import FlatTree, rejects_missing_features
+from job_profiler import JobProfiler, count_rows
+from model_search import ModelSearch
+from schema import processed_schema
+from storage import ObjectNotFound, bucket_names, create_storage
 
 
 class MLModelTrainer:
@@ -14,19 +21,28 @@ class MLModelTrainer:
         self.initialise_constants()
 
     def load_env(self):
-        # Load AWS credentials from environment
-        self.aws_access_key_id = AWS_ACCESS_KEY_ID
-        self.aws_secret_access_key = AWS_SECRET_ACCESS_KEY
-        self.s3 = boto3.client('s3', aws_access_key_id=self.aws_access_key_id,
-                               aws_secret_access_key=self.aws_secret_access_key)
+        # S3 or a local directory, chosen by STORAGE_BACKEND
+        self.storage = create_storage(use_cache=True)
 
     def initialise_constants(self):
         # Constants
         # S3 buckets and file names
-        self.DATASETS_BUCKET = 'etl-project-data-processed'
-        self.MODEL_BUCKET = 'etl-project-ml-model'
-        self.INPUT_DATA_FILE = 'input_data.csv'
+        buckets = bucket_names()
+        self.DATASETS_BUCKET = buckets['processed']
+        self.MODEL_BUCKET = buckets['model']
+        self.INPUT_DATA_FILE = 'input_data' + processed_data_extension()
         self.MODEL_FILE = 'decision_tree_model.pkl'
+        # The same tree as flat arrays, scored by the app without sklearn
+        self.MODEL_ARRAYS_FILE = 'decision_tree_model.npz'
+        # Candidate scores and timings from the last model search
+        self.MODEL_REPORT_FILE = 'decision_tree_model_report.json'
+        # 'single' fits one default tree, 'search' tunes candidates in parallel
+        self.TRAINING_MODE = os.environ.get('TRAINING_MODE', 'single').lower()
+        self.model_search_report = None
+        # Data in state, filled in by the training stages
+        self.meta_data_frame = None
+        self.X_train = None
+        self.X_test = None
         # List of ml features
         self.ml_features = [
             'budget',
@@ -38,11 +54,24 @@ class MLModelTrainer:
         ]
 
     def load_data_from_s3(self):
-        # Download and read CSV content from S3 for input data
-        file_content = self.s3.get_object(
-            Bucket=self.DATASETS_BUCKET, Key=self.INPUT_DATA_FILE)['Body'].read()
-        self.meta_data_frame = pd.read_csv(BytesIO(file_content))
-        print(f"Dataframe created from s3: {self.INPUT_DATA_FILE}")
+        # Download input data, falling back to the CSV copy if missing
+        key = self.INPUT_DATA_FILE
+        try:
+            file_content = self.storage.get_object_bytes(
+                self.DATASETS_BUCKET, key)
+        except ObjectNotFound:
+            if key == csv_key(key):
+                raise
+            print(f"Info: {key} not found, reading {csv_key(key)}")
+            key = csv_key(key)
+            file_content = self.storage.get_object_bytes(
+                self.DATASETS_BUCKET, key)
+
+        self.meta_data_frame = read_data_frame(file_content, key, processed_schema(key))
+        print(f"Dataframe created from s3: {key}")
+
+        if self.storage.cache:
+            print(f"S3 cache stats: {self.storage.cache.stats()}")
 
     def prepare_data(self):
         # Data preparation
@@ -56,6 +85,12 @@ class MLModelTrainer:
         )
 
     def train_model(self):
+        if self.TRAINING_MODE == 'search':
+            # Keep the best candidate by cross validated R-squared
+            self.profit_ratio_model, self.model_search_report = ModelSearch().run(
+                self.X_train, self.y_profit_ratio_train)
+            return
+
         # Model training
         self.profit_ratio_model = DecisionTreeRegressor()
         self.profit_ratio_model.fit(self.X_train, self.y_profit_ratio_train)
@@ -85,17 +120,60 @@ class MLModelTrainer:
         model_file_object = BytesIO()
         joblib.dump(self.profit_ratio_model, model_file_object)
 
-        # Upload the model file to S3
-        self.s3.put_object(Body=model_file_object.getvalue(),
-                           Bucket=self.MODEL_BUCKET, Key=self.MODEL_FILE)
+        # Export a single tree as flat arrays and check it scores like sklearn
+        flat_tree = None
+        if isinstance(self.profit_ratio_model, DecisionTreeRegressor):
+            flat_tree = FlatTree.from_sklearn(
+                self.profit_ratio_model, feature_names=self.ml_features)
+            if not np.array_equal(flat_tree.predict(self.X_test),
+                                  self.profit_ratio_model.predict(self.X_test)):
+                raise Exception('Error: Flat tree predictions differ from the model')
+            X_test = self.X_test.to_numpy(dtype=float)
+            if rejects_missing_features(flat_tree.predict, X_test) != \
+                    rejects_missing_features(self.profit_ratio_model.predict, X_test):
+                raise Exception('Error: Flat tree handles missing features differently from the model')
+
+        # Upload the model files to storage
+        self.storage.put_object(
+            self.MODEL_BUCKET, self.MODEL_FILE, model_file_object.getvalue())
         print(f"Model uploaded to S3: {self.MODEL_FILE}")
 
+        if flat_tree is not None:
+            self.storage.put_object(
+                self.MODEL_BUCKET, self.MODEL_ARRAYS_FILE, flat_tree.to_bytes())
+            print(f"Model arrays uploaded to S3: {self.MODEL_ARRAYS_FILE}")
+        else:
+            # Ensembles are served from the pickle, remove arrays of an older tree
+            self.storage.delete_keys(self.MODEL_BUCKET, [self.MODEL_ARRAYS_FILE])
+            print(f"Model arrays removed from S3: {self.MODEL_ARRAYS_FILE}")
+
+        if self.model_search_report is not None:
+            self.save_model_report_to_s3()
+
+    def save_model_report_to_s3(self):
+        # Add the held-out scores of the chosen model to the search report
+        report = dict(self.model_search_report,
+                      test_mse=float(self.profit_ratio_mse),
+                      test_r2=float(self.profit_ratio_r2))
+
+        self.storage.put_object(
+            self.MODEL_BUCKET, self.MODEL_REPORT_FILE,
+            json.dumps(report, indent=2).encode('utf-8'))
+        print(f"Model report uploaded to S3: {self.MODEL_REPORT_FILE}")
+
     def run_training_process(self):
-        self.load_data_from_s3()
-        self.prepare_data()
-        self.train_model()
-        self.evaluate_model()
-        self.save_model_to_s3()
+        # Stages are timed and reported when JOB_PROFILE is set
+        profiler = JobProfiler('training', self.storage)
+        meta_rows = lambda: count_rows(self.meta_data_frame)
+        train_rows = lambda: count_rows(self.X_train)
+        test_rows = lambda: count_rows(self.X_test)
+
+        with profiler.job_run():
+            profiler.run('load_data_from_s3', self.load_data_from_s3, meta_rows)
+            profiler.run('prepare_data', self.prepare_data, train_rows)
+            profiler.run('train_model', self.train_model, train_rows)
+            profiler.run('evaluate_model', self.evaluate_model, test_rows)
+            profiler.run('save_model_to_s3', self.save_model_to_s3, test_rows)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+import hashlib
+import json
+from datetime import datetime
+
+from feature_index import FeatureIndex
+from metrics import load_phase
+from search_index import SearchIndex
+
+
+class DataSnapshot:
+    # Everything a request reads, loaded together and never modified after
+    # construction, so a refresh can swap in a new one without locking
+    def __init__(self, files, meta_data_frame, unique_leads_data_frame,
+                 unique_directors_data_frame, unique_genres_data_frame,
+                 decision_tree_model, substring_search=False, shared=False):
+        # S3 key -> ETag of every file the snapshot was built from
+        self.files = dict(files)
+        self.version = hashlib.sha256(
+            json.dumps(sorted(self.files.items())).encode('utf-8')).hexdigest()[:12]
+        self.loaded_at = datetime.now()
+
+        self.meta_data_frame = meta_data_frame
+        self.unique_leads_data_frame = unique_leads_data_frame
+        self.unique_directors_data_frame = unique_directors_data_frame
+        self.unique_genres_data_frame = unique_genres_data_frame
+        self.decision_tree_model = decision_tree_model
+
+        # Shared snapshots are built once and then read by forked workers,
+        # so they keep lookups in NumPy arrays rather than Python objects
+        self.shared = shared
+
+        with load_phase('feature_index'):
+            self.build_feature_index()
+        with load_phase('type_id_lookups'):
+            self.build_type_id_lookups()
+        with load_phase('search_indexes'):
+            self.build_search_indexes(substring_search)
+
+    def type_data_frames(self):
+        return (
+            ("director", self.unique_directors_data_frame),
+            ("genre", self.unique_genres_data_frame),
+            ("lead", self.unique_leads_data_frame)
+        )
+
+    def build_feature_index(self):
+        # Precompute per-key aggregates so predict avoids scanning the data
+        self.feature_index = FeatureIndex.from_data_frame(
+            self.meta_data_frame, lookup_arrays=self.shared)
+
+        print(f"Feature index built in {self.feature_index.build_seconds:.3f}s "
+              f"using ~{self.feature_index.memory_bytes() / (1024 * 1024):.2f} MiB")
+
+    def build_type_id_lookups(self):
+        # Map names from the unique tables to their ids for batch requests
+        self.type_id_lookups = {}
+        for column, type_df in self.type_data_frames():
+            self.type_id_lookups[column] = type_df.drop_duplicates(
+                subset=column).set_index(column)['id']
+
+            # Build the index's hash table now rather than in every worker
+            if self.shared:
+                self.type_id_lookups[column].index.get_indexer(
+                    self.type_id_lookups[column].index[:1])
+
+    def build_search_indexes(self, substring_search):
+        # Sorted name indexes so search does not scan the unique tables
+        self.search_indexes = {}
+        for column, type_df in self.type_data_frames():
+            self.search_indexes[column] = SearchIndex(
+                type_df, column, substring=substring_search)
+
+            print(f"Search index built: {column}")
+
+    def status(self):
+        return {
+            'version': self.version,
+            'loaded_at': self.loaded_at.isoformat(),
+            'files': self.files,
+        }
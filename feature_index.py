@@ -0,0 +1,332 @@
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Columns whose mean profit ratio is used as a feature
+AVERAGE_COLUMNS = ('lead', 'director')
+
+# Column pairs whose co-occurrence count is used as a feature
+PAIR_COLUMNS = (('lead', 'genre'), ('director', 'genre'), ('director', 'lead'))
+
+# Names of the frames produced by FeatureIndex.to_data_frames
+AGGREGATE_TABLES = [*AVERAGE_COLUMNS, *('_'.join(columns) for columns in PAIR_COLUMNS)]
+
+# Feature name produced from each aggregate
+AVERAGE_FEATURES = {
+    'lead': 'lead_average_profit_ratio',
+    'director': 'director_average_profit_ratio',
+}
+PAIR_FEATURES = {
+    ('lead', 'genre'): 'lead_worked_in_genre_count',
+    ('director', 'genre'): 'director_worked_in_genre_count',
+    ('director', 'lead'): 'director_worked_with_lead_count',
+}
+
+# Looked up features in the order the model expects them after 'budget'
+FEATURE_COLUMNS = [
+    'director_average_profit_ratio',
+    'lead_average_profit_ratio',
+    'lead_worked_in_genre_count',
+    'director_worked_in_genre_count',
+    'director_worked_with_lead_count',
+]
+
+
+def to_lookup(series):
+    # Convert an aggregate Series into a dict keyed by plain Python scalars
+    if isinstance(series.index, pd.MultiIndex):
+        keys = zip(*(series.index.get_level_values(level).tolist()
+                     for level in range(series.index.nlevels)))
+    else:
+        keys = series.index.tolist()
+    return dict(zip(keys, series.tolist()))
+
+
+def pack_pairs(first, second):
+    # Pack two arrays of integer ids into one sortable int64 key, with -1
+    # for pairs that cannot name a stored id
+    first = np.asarray(first, dtype=np.float64)
+    second = np.asarray(second, dtype=np.float64)
+    valid = ((first == np.floor(first)) & (second == np.floor(second)) &
+             (first >= 0) & (second >= 0) & (first < 2 ** 31) & (second < 2 ** 31))
+
+    packed = np.full(len(first), -1, dtype=np.int64)
+    packed[valid] = (first[valid].astype(np.int64) << 32) | second[valid].astype(np.int64)
+    return packed
+
+
+def sorted_positions(sorted_keys, keys):
+    # Position of each key in sorted_keys, -1 where it is missing
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == len(sorted_keys)] = 0
+    found = (sorted_keys[positions] == keys) if len(sorted_keys) else np.zeros(len(keys), bool)
+    return np.where(found, positions, -1)
+
+
+def sorted_position(sorted_keys, key):
+    # Position of one key in sorted_keys, -1 when it is missing
+    position = int(sorted_keys.searchsorted(key))
+    if position < len(sorted_keys) and sorted_keys[position] == key:
+        return position
+    return -1
+
+
+def pack_pair(first, second):
+    # pack_pairs for one pair, without building arrays
+    first = float(first)
+    second = float(second)
+    if not (first.is_integer() and second.is_integer() and
+            0 <= first < 2 ** 31 and 0 <= second < 2 ** 31):
+        return -1
+    return (int(first) << 32) | int(second)
+
+
+def deep_getsizeof(value):
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class FeatureIndex:
+    def __init__(self, profit_ratio_sums, profit_ratio_counts, pair_counts):
+        # Aggregate tables keyed by id (or id pair), one Series per column
+        self.profit_ratio_sums = profit_ratio_sums
+        self.profit_ratio_counts = profit_ratio_counts
+        self.pair_counts = pair_counts
+
+        # Plain dictionaries for scalar lookups, filled in by build_lookups
+        self.profit_ratio_sum_lookup = {}
+        self.profit_ratio_count_lookup = {}
+        self.pair_count_lookup = {}
+
+        # Sorted NumPy keys and values, filled in by build_lookup_arrays
+        self.average_arrays = None
+        self.pair_arrays = None
+
+        # Build time, filled in by from_data_frame
+        self.build_seconds = None
+
+    @classmethod
+    def from_data_frame(cls, data_frame, scalar_lookups=True, lookup_arrays=False):
+        start_time = time.perf_counter()
+
+        profit_ratios = data_frame['profit_ratio'].to_numpy(dtype=np.float64)
+
+        profit_ratio_sums = {}
+        profit_ratio_counts = {}
+        for column in AVERAGE_COLUMNS:
+            # Sum each group with numpy over rows in their original order so
+            # that sum / count is bit-for-bit equal to Series.mean() on a mask
+            group_positions = data_frame.groupby(column, sort=False).indices
+            keys = pd.Index(list(group_positions.keys()),
+                            dtype=data_frame[column].dtype, name=column)
+            profit_ratio_sums[column] = pd.Series(
+                [profit_ratios[positions].sum() for positions in group_positions.values()],
+                index=keys, dtype=np.float64)
+            profit_ratio_counts[column] = pd.Series(
+                [len(positions) for positions in group_positions.values()],
+                index=keys, dtype=np.int64)
+
+        pair_counts = {}
+        for columns in PAIR_COLUMNS:
+            pair_counts[columns] = data_frame.groupby(
+                list(columns), sort=False).size()
+
+        index = cls(profit_ratio_sums, profit_ratio_counts, pair_counts)
+        if lookup_arrays:
+            index.build_lookup_arrays()
+        elif scalar_lookups:
+            index.build_lookups()
+
+        index.build_seconds = time.perf_counter() - start_time
+
+        return index
+
+    @classmethod
+    def from_data_frames(cls, frames):
+        # Rebuild the aggregate tables from the frames written by to_data_frames
+        profit_ratio_sums = {}
+        profit_ratio_counts = {}
+        for column in AVERAGE_COLUMNS:
+            table = frames[column].set_index(column)
+            profit_ratio_sums[column] = table['profit_ratio_sum'].astype(np.float64)
+            profit_ratio_counts[column] = table['profit_ratio_count'].astype(np.int64)
+
+        pair_counts = {}
+        for columns in PAIR_COLUMNS:
+            table = frames['_'.join(columns)].set_index(list(columns))
+            pair_counts[columns] = table['count'].astype(np.int64)
+
+        return cls(profit_ratio_sums, profit_ratio_counts, pair_counts)
+
+    def to_data_frames(self):
+        # Flatten the aggregate tables into frames that can be saved
+        frames = {}
+        for column in AVERAGE_COLUMNS:
+            frames[column] = pd.DataFrame({
+                'profit_ratio_sum': self.profit_ratio_sums[column],
+                'profit_ratio_count': self.profit_ratio_counts[column],
+            }).rename_axis(column).reset_index()
+
+        for columns in PAIR_COLUMNS:
+            frames['_'.join(columns)] = self.pair_counts[columns].rename(
+                'count').rename_axis(list(columns)).reset_index()
+
+        return frames
+
+    def build_lookups(self):
+        # Plain dictionaries for O(1) scalar lookups on the request path
+        self.profit_ratio_sum_lookup = {
+            column: to_lookup(series) for column, series in self.profit_ratio_sums.items()}
+        self.profit_ratio_count_lookup = {
+            column: to_lookup(series) for column, series in self.profit_ratio_counts.items()}
+        self.pair_count_lookup = {
+            columns: to_lookup(series) for columns, series in self.pair_counts.items()}
+
+    def build_lookup_arrays(self):
+        # Lookups on sorted NumPy arrays instead of dictionaries. Reading
+        # them never touches Python object refcounts, so forked workers
+        # keep sharing the pages with the process that built them.
+        self.average_arrays = {}
+        for column in AVERAGE_COLUMNS:
+            sums = self.profit_ratio_sums[column]
+            keys = sums.index.to_numpy(dtype=np.float64)
+            order = np.argsort(keys, kind='stable')
+            self.average_arrays[column] = (
+                keys[order],
+                sums.to_numpy(dtype=np.float64)[order],
+                self.profit_ratio_counts[column].reindex(sums.index).to_numpy(dtype=np.int64)[order])
+
+        self.pair_arrays = {}
+        for columns in PAIR_COLUMNS:
+            counts = self.pair_counts[columns]
+            keys = pack_pairs(counts.index.get_level_values(0), counts.index.get_level_values(1))
+            if (keys < 0).any():
+                raise Exception(f"Error: Non-integer ids in {columns}")
+            order = np.argsort(keys, kind='stable')
+            self.pair_arrays[columns] = (keys[order], counts.to_numpy(dtype=np.int64)[order])
+
+        # The arrays replace the dictionaries
+        self.profit_ratio_sum_lookup = {}
+        self.profit_ratio_count_lookup = {}
+        self.pair_count_lookup = {}
+
+    def row_count(self):
+        # Every row contributes exactly once to the per-lead counts
+        return int(self.profit_ratio_counts['lead'].sum())
+
+    def update(self, data_frame):
+        # Fold new rows into the running sums and counts in O(new rows)
+        batch = FeatureIndex.from_data_frame(data_frame, scalar_lookups=False)
+
+        for column in AVERAGE_COLUMNS:
+            self.profit_ratio_sums[column] = self.profit_ratio_sums[column].add(
+                batch.profit_ratio_sums[column], fill_value=0)
+            self.profit_ratio_counts[column] = self.profit_ratio_counts[column].add(
+                batch.profit_ratio_counts[column], fill_value=0).astype(np.int64)
+
+        for columns in PAIR_COLUMNS:
+            self.pair_counts[columns] = self.pair_counts[columns].add(
+                batch.pair_counts[columns], fill_value=0).astype(np.int64)
+
+        # Refresh the scalar lookups only if they were in use
+        if self.average_arrays is not None:
+            self.build_lookup_arrays()
+        elif self.pair_count_lookup:
+            self.build_lookups()
+
+    def memory_bytes(self):
+        # Approximate footprint of the aggregate tables and lookup dictionaries
+        tables = [*self.profit_ratio_sums.values(),
+                  *self.profit_ratio_counts.values(),
+                  *self.pair_counts.values()]
+        lookups = [*self.profit_ratio_sum_lookup.values(),
+                   *self.profit_ratio_count_lookup.values(),
+                   *self.pair_count_lookup.values()]
+        arrays = [array
+                  for arrays in (*(self.average_arrays or {}).values(),
+                                 *(self.pair_arrays or {}).values())
+                  for array in arrays]
+
+        total = sum(table.memory_usage(index=True, deep=True) for table in tables)
+        total += sum(array.nbytes for array in arrays)
+        for lookup in lookups:
+            total += sys.getsizeof(lookup)
+            if lookup:
+                # Size entries from a sample instead of walking every object
+                key, value = next(iter(lookup.items()))
+                total += len(lookup) * (deep_getsizeof(key) + sys.getsizeof(value))
+        return total
+
+    def average_profit_ratio(self, column, key):
+        # Mean profit ratio for a key, NaN when the key has no rows
+        if self.average_arrays is not None:
+            keys, sums, counts = self.average_arrays[column]
+            position = sorted_position(keys, float(key))
+            return np.nan if position < 0 else sums[position] / counts[position]
+
+        count = self.profit_ratio_count_lookup[column].get(key, 0)
+        if not count:
+            return np.nan
+        return self.profit_ratio_sum_lookup[column][key] / count
+
+    def pair_count(self, columns, first_key, second_key):
+        if self.pair_arrays is not None:
+            keys, counts = self.pair_arrays[columns]
+            position = sorted_position(keys, pack_pair(first_key, second_key))
+            return 0 if position < 0 else int(counts[position])
+
+        return self.pair_count_lookup[columns].get((first_key, second_key), 0)
+
+    def lookup(self, lead, director, genre):
+        keys = {'lead': lead, 'director': director, 'genre': genre}
+
+        features = {}
+        for column, feature in AVERAGE_FEATURES.items():
+            features[feature] = self.average_profit_ratio(column, keys[column])
+        for columns, feature in PAIR_FEATURES.items():
+            features[feature] = self.pair_count(
+                columns, keys[columns[0]], keys[columns[1]])
+        return features
+
+    def lookup_batch(self, leads, directors, genres):
+        # Vectorised equivalent of lookup for whole arrays of ids
+        keys = {
+            'lead': np.asarray(leads, dtype=np.float64),
+            'director': np.asarray(directors, dtype=np.float64),
+            'genre': np.asarray(genres, dtype=np.float64),
+        }
+
+        if self.average_arrays is not None:
+            return self.lookup_batch_arrays(keys)
+
+        features = {}
+        for column, feature in AVERAGE_FEATURES.items():
+            sums = self.profit_ratio_sums[column].reindex(keys[column])
+            counts = self.profit_ratio_counts[column].reindex(keys[column])
+            features[feature] = sums.to_numpy() / counts.to_numpy()
+        for columns, feature in PAIR_FEATURES.items():
+            pair_keys = pd.MultiIndex.from_arrays(
+                [keys[columns[0]], keys[columns[1]]])
+            counts = self.pair_counts[columns].reindex(pair_keys)
+            features[feature] = counts.fillna(0).to_numpy(dtype=np.int64)
+
+        return pd.DataFrame(features, columns=FEATURE_COLUMNS)
+
+    def lookup_batch_arrays(self, keys):
+        features = {}
+        for column, feature in AVERAGE_FEATURES.items():
+            sorted_keys, sums, counts = self.average_arrays[column]
+            positions = sorted_positions(sorted_keys, keys[column])
+            found = positions >= 0
+            features[feature] = np.full(len(positions), np.nan)
+            features[feature][found] = sums[positions[found]] / counts[positions[found]]
+        for columns, feature in PAIR_FEATURES.items():
+            sorted_keys, counts = self.pair_arrays[columns]
+            positions = sorted_positions(
+                sorted_keys, pack_pairs(keys[columns[0]], keys[columns[1]]))
+            features[feature] = np.where(positions >= 0, counts[positions], 0)
+
+        return pd.DataFrame(features, columns=FEATURE_COLUMNS)
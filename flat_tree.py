@@ -0,0 +1,124 @@
+from io import BytesIO
+
+import numpy as np
+
+# Child index sklearn uses to mark a leaf
+LEAF = -1
+
+
+def rejects_missing_features(predict, X):
+    # Whether predict refuses a row with any one feature missing, as sklearn
+    # trees do, rather than scoring it
+    row = np.asarray(X[:1], dtype=np.float64)
+    for column in range(row.shape[1]):
+        missing = row.copy()
+        missing[0, column] = np.nan
+        try:
+            predict(missing)
+        except ValueError:
+            continue
+        return False
+    return True
+
+
+class FlatTree:
+    # A fitted regression tree as flat arrays, scored without sklearn
+    def __init__(self, feature, threshold, left, right, value, feature_names=None,
+                 row_lists=True):
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.feature_names = None if feature_names is None else list(feature_names)
+
+        # Plain lists are faster than arrays for walking one row, but every
+        # walk writes to the refcounts of the objects it reads, so processes
+        # sharing the tree after a fork walk the arrays instead
+        self.nodes = None
+        self.leaf_values = None
+        if row_lists:
+            self.nodes = list(zip(self.feature.tolist(), self.threshold.tolist(),
+                                  self.left.tolist(), self.right.tolist()))
+            self.leaf_values = self.value.tolist()
+
+    @classmethod
+    def from_sklearn(cls, model, feature_names=None):
+        tree = model.tree_
+        if tree.n_outputs != 1:
+            raise Exception('Error: Only single output trees can be flattened')
+
+        return cls(tree.feature, tree.threshold, tree.children_left,
+                   tree.children_right, tree.value[:, 0, 0], feature_names)
+
+    @classmethod
+    def from_bytes(cls, content, row_lists=True):
+        arrays = np.load(BytesIO(content), allow_pickle=False)
+        feature_names = arrays['feature_names'].tolist() if 'feature_names' in arrays else None
+
+        return cls(arrays['feature'], arrays['threshold'], arrays['left'],
+                   arrays['right'], arrays['value'], feature_names, row_lists)
+
+    def to_bytes(self):
+        arrays = {
+            'feature': self.feature,
+            'threshold': self.threshold,
+            'left': self.left,
+            'right': self.right,
+            'value': self.value,
+        }
+        if self.feature_names is not None:
+            arrays['feature_names'] = np.asarray(self.feature_names, dtype=str)
+
+        buffer = BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    def predict_row(self, row):
+        # Walk one row down the tree
+        if self.nodes is None:
+            return self.predict_row_arrays(row)
+
+        nodes = self.nodes
+        node = 0
+        feature, threshold, left, right = nodes[node]
+        while left != LEAF:
+            node = left if row[feature] <= threshold else right
+            feature, threshold, left, right = nodes[node]
+        return self.leaf_values[node]
+
+    def predict_row_arrays(self, row):
+        feature, threshold, left, right = self.feature, self.threshold, self.left, self.right
+        node = 0
+        while left[node] != LEAF:
+            node = left[node] if row[feature[node]] <= threshold[node] else right[node]
+        return float(self.value[node])
+
+    def predict(self, X):
+        # sklearn compares float32 inputs against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        # NaN compares False and would always go right, so refuse it as
+        # sklearn does, with the same messages
+        if not np.isfinite(X).all():
+            if np.isnan(X).any():
+                raise ValueError('Input X contains NaN.')
+            raise ValueError(
+                "Input X contains infinity or a value too large for dtype('float32').")
+
+        if len(X) == 1:
+            return np.array([self.predict_row(X[0].astype(np.float64).tolist())])
+
+        # Move rows down one level per step, dropping those that reach a leaf
+        node = np.zeros(len(X), dtype=np.int64)
+        active = np.arange(len(X)) if self.left[0] != LEAF else np.arange(0)
+        while active.size:
+            current = node[active]
+            go_left = X[active, self.feature[current]] <= self.threshold[current]
+            current = np.where(go_left, self.left[current], self.right[current])
+            node[active] = current
+            active = active[self.left[current] != LEAF]
+
+        return self.value[node]
@@ -1,20 +1,29 @@
 import os
 import pandas as pd
 import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from data_format import processed_data_extension, write_data_frame
+from schema import processed_schema
+from serialized_fields import director_name, genre_name, lead_name
 
 # Constants
 CURRENT_DIR = os.path.dirname(__file__)
 
-RAW_DIR = os.path.join(CURRENT_DIR, 'raw_datasets')
-PROCESSED_DIR = os.path.join(CURRENT_DIR, 'datasets')
+# Input and output directories, overridable to run against other data
+RAW_DIR = os.environ.get('RAW_DATA_DIR', os.path.join(CURRENT_DIR, 'raw_datasets'))
+PROCESSED_DIR = os.environ.get(
+    'PROCESSED_DATA_DIR', os.path.join(CURRENT_DIR, 'datasets'))
 
 CREDITS_FILE = os.path.join(RAW_DIR, 'credits.csv')
 MOVIES_METADATA_FILE = os.path.join(RAW_DIR, 'movies_metadata.csv')
 
-UNIQUE_LEADS_FILE = 'unique_leads.csv'
-UNIQUE_DIRECTORS_FILE = 'unique_directors.csv'
-UNIQUE_GENRES_FILE = 'unique_genres.csv'
-INPUT_DATA_FILE = 'input_data.csv'
+DATA_FILE_EXTENSION = processed_data_extension()
+UNIQUE_LEADS_FILE = 'unique_leads' + DATA_FILE_EXTENSION
+UNIQUE_DIRECTORS_FILE = 'unique_directors' + DATA_FILE_EXTENSION
+UNIQUE_GENRES_FILE = 'unique_genres' + DATA_FILE_EXTENSION
+INPUT_DATA_FILE = 'input_data' + DATA_FILE_EXTENSION
 
 CREDITS_DATA_FRAME_COLUMNS = [
     'id',
@@ -30,6 +39,17 @@ MOVIES_METADATA_DATA_FRAME_COLUMNS = [
     'revenue'
 ]
 
+# Columns clean_data filters on, read alongside the metadata columns
+MOVIES_METADATA_FILTER_COLUMNS = [
+    'original_language',
+    'status'
+]
+
+# Read every raw column as text, cleaning converts the numeric ones
+CREDITS_DTYPES = {column: str for column in CREDITS_DATA_FRAME_COLUMNS}
+MOVIES_METADATA_DTYPES = {
+    column: str for column in MOVIES_METADATA_DATA_FRAME_COLUMNS + MOVIES_METADATA_FILTER_COLUMNS}
+
 ML_INPUT_DATA_FRAME_COLUMNS = [
     'title',
     'lead',
@@ -46,6 +66,21 @@ ML_INPUT_DATA_FRAME_COLUMNS = [
 ]
 
 
+def generate_settings():
+    # Pipeline mode, worker count and chunk size, overridable through the environment
+    return {
+        'mode': os.environ.get('GENERATE_MODE', 'chunked').lower(),
+        'workers': int(os.environ.get('GENERATE_WORKERS', os.cpu_count() or 1)),
+        'chunk_rows': int(os.environ.get('GENERATE_CHUNK_ROWS', 50000)),
+    }
+
+
+def save_data_frame(data_frame, output_filename):
+    with open(os.path.join(PROCESSED_DIR, output_filename), 'wb') as file:
+        file.write(write_data_frame(
+            data_frame, output_filename, processed_schema(output_filename)))
+
+
 def save_unique_data(data, column_name, output_filename):
     # Get unique values from the data
     unique_values = data[column_name].unique()
@@ -54,9 +89,8 @@ def save_unique_data(data, column_name, output_filename):
     unique_values_df = pd.DataFrame(
         {'id': range(1, len(unique_values) + 1), column_name: unique_values})
 
-    # Save to a CSV file
-    unique_values_df.to_csv(os.path.join(
-        PROCESSED_DIR, output_filename), index=False)
+    # Save in the format given by the file extension
+    save_data_frame(unique_values_df, output_filename)
 
     # Create a mapping dictionary for the original values to their corresponding IDs
     mapping = unique_values_df.set_index(column_name)['id'].to_dict()
@@ -71,9 +105,8 @@ def save_data(combined_data):
     save_unique_data(combined_data, 'director', UNIQUE_DIRECTORS_FILE)
     save_unique_data(combined_data, 'genre', UNIQUE_GENRES_FILE)
 
-    # Save the combined data to a CSV file using Pandas to_csv
-    combined_data.to_csv(os.path.join(
-        PROCESSED_DIR, INPUT_DATA_FILE), index=False)
+    # Save the combined data in the format given by the file extension
+    save_data_frame(combined_data, INPUT_DATA_FILE)
 
 
 def clean_data(data):
@@ -128,38 +161,90 @@ def create_artificial_features(data):
     return data.dropna()
 
 
-def main():
-    # Load Set A (credits) from a CSV file
-    credits_data_frame = pd.read_csv(CREDITS_FILE)
+def extract_credits(credits_data_frame):
+    # Select the columns you want to keep in Set A
+    credits_data_frame = credits_data_frame[CREDITS_DATA_FRAME_COLUMNS]
 
-    # Load Set B (metadata) from a CSV file
-    movies_metadata_data_frame = pd.read_csv(MOVIES_METADATA_FILE)
+    credits_data_frame = credits_data_frame.dropna(subset=['cast', 'crew'])
 
+    # Read only the names needed from the serialized cast and crew lists
+    credits_data_frame['lead'] = credits_data_frame['cast'].map(lead_name)
+    credits_data_frame['director'] = credits_data_frame['crew'].map(
+        director_name)
+    return credits_data_frame.drop(['cast', 'crew'], axis=1)
+
+
+def extract_movies_metadata(movies_metadata_data_frame):
     # Clean data for Set B
     movies_metadata_data_frame = clean_data(movies_metadata_data_frame)
 
-    # Select and rename the columns you want to keep in Set A
-    credits_data_frame = credits_data_frame[CREDITS_DATA_FRAME_COLUMNS]
-
-    credits_data_frame = credits_data_frame.dropna(subset=['cast', 'crew'])
-    credits_data_frame['cast'] = credits_data_frame['cast'].apply(eval)
-    credits_data_frame['lead'] = credits_data_frame['cast'].apply(
-        lambda x: x[0]['name'] if x else None)
-    credits_data_frame['crew'] = credits_data_frame['crew'].apply(eval)
-    credits_data_frame['director'] = credits_data_frame['crew'].apply(lambda x: next(
-        (member['name'] for member in x if member['job'] == 'Director'), None))
-
-    # Select and rename the columns you want to keep in Set B
+    # Select the columns you want to keep in Set B
     movies_metadata_data_frame = movies_metadata_data_frame[MOVIES_METADATA_DATA_FRAME_COLUMNS]
 
     movies_metadata_data_frame = movies_metadata_data_frame.dropna(subset=[
                                                                    'genres'])
-    movies_metadata_data_frame['genres'] = movies_metadata_data_frame['genres'].apply(
-        eval)
-    movies_metadata_data_frame['genre'] = movies_metadata_data_frame['genres'].apply(
-        lambda x: x[0]['name'] if x else None)
-    movies_metadata_data_frame = movies_metadata_data_frame.drop([
-                                                                 'genres'], axis=1)
+    movies_metadata_data_frame['genre'] = movies_metadata_data_frame['genres'].map(
+        genre_name)
+    return movies_metadata_data_frame.drop(['genres'], axis=1)
+
+
+def extract_credits_chunk(credits_chunk):
+    # Ids are read as text in chunks, convert them to match the metadata ids
+    credits_chunk = extract_credits(credits_chunk)
+    credits_chunk['id'] = pd.to_numeric(credits_chunk['id'], errors='coerce')
+    return credits_chunk.dropna(subset=['id']).astype({'id': 'Int64'})
+
+
+def map_chunks(executor, function, chunks, max_pending):
+    # Process chunks in order, reading ahead by at most max_pending chunks
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(function, chunk))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def extract_chunked(file_path, columns, dtypes, function, settings):
+    # Stream a raw CSV in chunks, keeping only the slim extracted columns
+    chunks = pd.read_csv(file_path, usecols=columns, dtype=dtypes,
+                         chunksize=settings['chunk_rows'])
+
+    if settings['workers'] <= 1:
+        extracted = [function(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=settings['workers']) as executor:
+            extracted = list(map_chunks(
+                executor, function, chunks, max_pending=2 * settings['workers']))
+
+    return pd.concat(extracted, ignore_index=True)
+
+
+def load_extracted_data(settings):
+    if settings['mode'] != 'chunked':
+        # Load Set A (credits) and Set B (metadata) from CSV files
+        credits_data_frame = extract_credits(pd.read_csv(CREDITS_FILE))
+        movies_metadata_data_frame = extract_movies_metadata(
+            pd.read_csv(MOVIES_METADATA_FILE))
+        return credits_data_frame, movies_metadata_data_frame
+
+    credits_data_frame = extract_chunked(
+        CREDITS_FILE, CREDITS_DATA_FRAME_COLUMNS, CREDITS_DTYPES,
+        extract_credits_chunk, settings)
+    movies_metadata_data_frame = extract_chunked(
+        MOVIES_METADATA_FILE,
+        MOVIES_METADATA_DATA_FRAME_COLUMNS + MOVIES_METADATA_FILTER_COLUMNS,
+        MOVIES_METADATA_DTYPES, extract_movies_metadata, settings)
+    return credits_data_frame, movies_metadata_data_frame
+
+
+def main():
+    settings = generate_settings()
+    print(f"Generating datasets: {settings}")
+
+    credits_data_frame, movies_metadata_data_frame = load_extracted_data(
+        settings)
 
     # Merge Set A and Set B based on the 'id' column using Pandas merge
     combined_data = credits_data_frame.merge(
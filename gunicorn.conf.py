@@ -0,0 +1,33 @@
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:80')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+
+# Load the model and data once in the master and fork the workers from it,
+# so every worker shares the same pages instead of loading its own copy
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1').lower() in ('1', 'true')
+
+# Have the app keep its snapshot in memory that forked workers can share
+if preload_app:
+    os.environ.setdefault('SHARED_SNAPSHOT', '1')
+
+# Warm up before forking when preloading, so workers share the imported
+# chart libraries and are ready as soon as they start
+if preload_app:
+    os.environ.setdefault('WARM_UP_IN_BACKGROUND', '0')
+
+# Every process writes its metrics to files in one directory, which /metrics
+# adds up whichever worker serves it. This runs before the app is loaded, so
+# metrics left by an earlier run are cleared before any are recorded.
+metrics_directory = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'etl-project-metrics'))
+shutil.rmtree(metrics_directory, ignore_errors=True)
+os.makedirs(metrics_directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Stop reporting the live values of a worker that has exited
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,193 @@
+import cProfile
+import json
+import os
+import platform
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from stack_sampler import StackSampler
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROFILERS = ('cprofile', 'sample')
+
+
+def profiler_settings():
+    # Opt-in stage profiling, configured through the environment
+    return {
+        'enabled': os.environ.get('JOB_PROFILE', '').lower() in ('1', 'true'),
+        'profiler': os.environ.get('JOB_PROFILER', '').lower() or None,
+        'sample_interval': float(os.environ.get('JOB_PROFILE_SAMPLE_INTERVAL', 0.005)),
+        'report_dir': os.environ.get('JOB_REPORT_DIR', os.path.join(CURRENT_DIR, 'job_reports')),
+        'report_bucket': os.environ.get('JOB_REPORT_BUCKET') or None,
+    }
+
+
+def count_rows(data_frame):
+    return None if data_frame is None else len(data_frame)
+
+
+def read_memory():
+    # Current and peak resident memory in bytes, from /proc where available
+    try:
+        with open('/proc/self/status') as file:
+            fields = dict(line.split(':', 1) for line in file)
+        return (int(fields['VmRSS'].split()[0]) * 1024,
+                int(fields['VmHWM'].split()[0]) * 1024)
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_memory():
+    # Linux resets the peak to the current size on writing 5 to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def cpu_seconds():
+    # This process and its finished children, such as model search workers
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class JobProfiler:
+    # Times each stage of a job and writes a report of the run. Disabled,
+    # run() only calls the stage.
+    def __init__(self, job, storage=None, settings=None):
+        self.job = job
+        self.storage = storage
+        self.settings = settings or profiler_settings()
+        self.enabled = self.settings['enabled']
+
+        if self.settings['profiler'] not in (None, *PROFILERS):
+            raise Exception(f"Error: Unknown profiler {self.settings['profiler']}")
+
+        self.run_id = datetime.now().strftime('%Y%m%d%H%M%S') + f"_{os.getpid()}"
+        self.stages = []
+        self.profiles = {}
+
+    def run(self, name, function, rows=None):
+        # Run one stage, recording time, memory and rows before and after
+        if not self.enabled:
+            return function()
+
+        stage = {'stage': name, 'rows_in': rows() if rows else None}
+        peak_reset = reset_peak_memory()
+        rss_before, _ = read_memory()
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+
+        profile = None
+        if self.settings['profiler'] == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+        elif self.settings['profiler'] == 'sample':
+            profile = StackSampler(self.settings['sample_interval']).start()
+
+        try:
+            value = function()
+            stage['status'] = 'ok'
+            return value
+        except Exception as e:
+            stage['status'] = 'failed'
+            stage['error'] = str(e)
+            raise
+        finally:
+            if isinstance(profile, cProfile.Profile):
+                profile.disable()
+                self.profiles[f"{name}.pstats"] = profile
+            elif profile is not None:
+                profile.stop()
+                self.profiles[f"{name}.collapsed"] = profile
+
+            rss_after, peak = read_memory()
+            stage.update({
+                'wall_seconds': time.perf_counter() - start,
+                'cpu_seconds': cpu_seconds() - cpu_start,
+                'rss_before_bytes': rss_before,
+                'rss_after_bytes': rss_after,
+                'peak_rss_bytes': peak,
+                'peak_rss_is_stage_peak': peak_reset,
+                'rows_out': rows() if rows else None,
+            })
+            self.stages.append(stage)
+
+            print(f"Stage {name}: {stage['wall_seconds']:.3f}s wall, "
+                  f"{stage['cpu_seconds']:.3f}s CPU, rows {stage['rows_in']} -> {stage['rows_out']}")
+
+    @contextmanager
+    def job_run(self):
+        # Write the report when the job ends, however it ends
+        start = time.perf_counter()
+        started_at = datetime.now()
+        status, error = 'ok', None
+        try:
+            yield self
+        except Exception as e:
+            status, error = 'failed', str(e)
+            raise
+        finally:
+            if self.enabled:
+                self.save_report(self.report(started_at, time.perf_counter() - start, status, error))
+
+    def report(self, started_at, wall_seconds, status, error):
+        _, peak = read_memory()
+        return {
+            'job': self.job,
+            'run_id': self.run_id,
+            'started_at': started_at.isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'status': status,
+            'error': error,
+            'wall_seconds': wall_seconds,
+            'peak_rss_bytes': peak,
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'profiler': self.settings['profiler'],
+            'stages': self.stages,
+            'profiles': sorted(self.profiles),
+        }
+
+    def profile_bytes(self, profile):
+        if isinstance(profile, cProfile.Profile):
+            # pstats files can only be written to a path
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'profile.pstats')
+                profile.dump_stats(path)
+                with open(path, 'rb') as file:
+                    return file.read()
+        return profile.collapsed().encode('utf-8')
+
+    def save_report(self, report):
+        # Reports and profiles of a run share one folder, in S3 or locally
+        files = {'report.json': json.dumps(report, indent=2).encode('utf-8')}
+        for name, profile in self.profiles.items():
+            files[name] = self.profile_bytes(profile)
+
+        prefix = f"{self.job}/{self.run_id}"
+        try:
+            if self.settings['report_bucket']:
+                for name, content in files.items():
+                    self.storage.put_object(
+                        self.settings['report_bucket'], f"{prefix}/{name}", content)
+                location = f"{self.settings['report_bucket']}/{prefix}"
+            else:
+                location = os.path.join(self.settings['report_dir'], self.job, self.run_id)
+                os.makedirs(location, exist_ok=True)
+                for name, content in files.items():
+                    with open(os.path.join(location, name), 'wb') as file:
+                        file.write(content)
+        except Exception as e:
+            # A failed report must not fail the job it describes
+            print(f"Error saving job report: {e}")
+            return
+
+        print(f"Job report saved: {location}")
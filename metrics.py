@@ -0,0 +1,64 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Histogram, generate_latest, multiprocess)
+
+# Latency buckets in seconds, from cached predictions up to slow uploads
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                 0.05, 0.1, 0.25, 1)
+LOAD_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_SECONDS = Histogram(
+    'etl_app_request_seconds', 'Time to handle a request',
+    ['route', 'method'], buckets=REQUEST_BUCKETS)
+REQUESTS = Counter(
+    'etl_app_requests', 'Requests handled',
+    ['route', 'method', 'status'])
+PREDICT_STAGE_SECONDS = Histogram(
+    'etl_app_predict_stage_seconds', 'Time spent in each stage of /predict',
+    ['stage'], buckets=STAGE_BUCKETS)
+LOAD_SECONDS = Histogram(
+    'etl_app_load_seconds', 'Time spent loading the model and data, at startup and on reload',
+    ['phase', 'file'], buckets=LOAD_BUCKETS)
+
+
+def multiprocess_directory():
+    # Set for gunicorn, where every worker writes its metrics to files there
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+@contextmanager
+def timed(histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+def predict_stage(stage):
+    return timed(PREDICT_STAGE_SECONDS, stage=stage)
+
+
+def load_phase(phase, file=''):
+    return timed(LOAD_SECONDS, phase=phase, file=file)
+
+
+def observe_request(route, method, status, seconds):
+    REQUEST_SECONDS.labels(route=route, method=method).observe(seconds)
+    REQUESTS.labels(route=route, method=method, status=str(status)).inc()
+
+
+def render_metrics():
+    # Metrics of every worker when running under gunicorn, else of this process
+    if multiprocess_directory():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,204 @@
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+from sklearn.model_selection import KFold, cross_validate
+from sklearn.tree import DecisionTreeRegressor
+
+MODEL_TYPES = {
+    'decision_tree': DecisionTreeRegressor,
+    'random_forest': RandomForestRegressor,
+    'extra_trees': ExtraTreesRegressor,
+}
+
+# Decision tree settings searched, simplest trees first
+MAX_DEPTHS = [4, 6, 8, 10, 12, 16, None]
+MIN_SAMPLES_SPLITS = [2, 10, 50]
+MIN_SAMPLES_LEAFS = [1, 5, 20, 50]
+
+# Ensemble candidates, only evaluated when enabled
+ENSEMBLE_CANDIDATES = [
+    ('random_forest', {'n_estimators': 100, 'max_depth': 12, 'min_samples_leaf': 5}),
+    ('random_forest', {'n_estimators': 100, 'max_depth': None, 'min_samples_leaf': 1}),
+    ('extra_trees', {'n_estimators': 100, 'max_depth': 12, 'min_samples_leaf': 5}),
+    ('extra_trees', {'n_estimators': 100, 'max_depth': None, 'min_samples_leaf': 1}),
+]
+
+RANDOM_STATE = 42
+
+
+def search_settings():
+    # Search limits, overridable through the environment
+    return {
+        'time_budget_seconds': float(os.environ.get('TRAINING_TIME_BUDGET_SECONDS', 300)),
+        'cv_folds': int(os.environ.get('TRAINING_CV_FOLDS', 5)),
+        'workers': int(os.environ.get('TRAINING_WORKERS', os.cpu_count() or 1)),
+        'patience': int(os.environ.get('TRAINING_PATIENCE', 20)),
+        'ensembles': os.environ.get('TRAINING_ENSEMBLES', '').lower() in ('1', 'true'),
+    }
+
+
+def candidates(ensembles=False):
+    # Model type and parameters of every candidate, in the order they start
+    grid = [
+        ('decision_tree', {'max_depth': max_depth, 'min_samples_split': min_samples_split,
+                           'min_samples_leaf': min_samples_leaf})
+        for max_depth, min_samples_split, min_samples_leaf in itertools.product(
+            MAX_DEPTHS, MIN_SAMPLES_SPLITS, MIN_SAMPLES_LEAFS)
+    ]
+    # Cheap trees go first so a tight budget still finishes some of them,
+    # early stopping skips the rest of the grid but never the ensembles
+    return grid + ENSEMBLE_CANDIDATES if ensembles else grid
+
+
+def build_model(model_type, params):
+    return MODEL_TYPES[model_type](random_state=RANDOM_STATE, **params)
+
+
+# Training data, set once in each worker process
+WORKER_DATA = {}
+
+
+def set_worker_data(X, y, cv_folds):
+    WORKER_DATA.update(X=X, y=y, cv_folds=cv_folds)
+
+
+def evaluate_candidate(index, model_type, params):
+    # Cross validate one candidate on the worker's training data
+    start = time.perf_counter()
+    scores = cross_validate(
+        build_model(model_type, params), WORKER_DATA['X'], WORKER_DATA['y'],
+        cv=KFold(WORKER_DATA['cv_folds'], shuffle=True, random_state=RANDOM_STATE),
+        scoring='r2', n_jobs=1)
+
+    return {
+        'index': index,
+        'model_type': model_type,
+        'params': params,
+        'r2_mean': float(np.mean(scores['test_score'])),
+        'r2_std': float(np.std(scores['test_score'])),
+        'fit_seconds': float(np.sum(scores['fit_time'])),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+class ModelSearch:
+    def __init__(self, settings=None):
+        self.settings = settings or search_settings()
+
+    def run(self, X, y):
+        # Cross validate candidates on every core, within the time budget
+        settings = self.settings
+        candidate_list = candidates(settings['ensembles'])
+        X_values = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        workers = max(1, settings['workers'])
+
+        start = time.perf_counter()
+        deadline = start + settings['time_budget_seconds']
+        results = queue.Queue()
+
+        # Candidates are handed out as workers free up, so the ones not yet
+        # started can be skipped once the tree grid stops improving
+        pending = collections.deque(enumerate(candidate_list))
+        running = {}
+
+        completed = []
+        best = None
+        best_tree = None
+        since_improvement = 0
+        stop_reason = 'all candidates evaluated'
+
+        pool = multiprocessing.Pool(
+            workers, initializer=set_worker_data,
+            initargs=(X_values, y, settings['cv_folds']))
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    index, (model_type, params) = pending.popleft()
+                    pool.apply_async(evaluate_candidate, (index, model_type, params),
+                                     callback=results.put,
+                                     error_callback=lambda e, index=index: results.put(
+                                         {'index': index, 'error': str(e)}))
+                    running[index] = model_type
+
+                try:
+                    result = results.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    stop_reason = 'time budget reached'
+                    break
+
+                del running[result['index']]
+                completed.append(result)
+                if 'error' in result:
+                    print(f"Error evaluating candidate {result['index']}: {result['error']}")
+                    continue
+
+                print(f"Candidate {result['model_type']} {result['params']}: "
+                      f"R2 {result['r2_mean']:.4f} in {result['seconds']:.2f}s")
+
+                if best is None or result['r2_mean'] > best['r2_mean']:
+                    best = result
+                if result['model_type'] != 'decision_tree':
+                    continue
+
+                # Skip the rest of the tree grid once a run of finished trees
+                # has not beaten the best tree, ensembles still run
+                if best_tree is None or result['r2_mean'] > best_tree['r2_mean']:
+                    best_tree = result
+                    since_improvement = 0
+                else:
+                    since_improvement += 1
+                if since_improvement >= settings['patience'] and \
+                        stop_reason == 'all candidates evaluated':
+                    stop_reason = f"no improvement in {settings['patience']} candidates"
+                    pending = collections.deque(
+                        candidate for candidate in pending
+                        if candidate[1][0] != 'decision_tree')
+
+                    # Nothing left but trees already running
+                    if not pending and set(running.values()) <= {'decision_tree'}:
+                        break
+        finally:
+            # Stop candidates still running, the budget is a hard limit
+            pool.terminate()
+            pool.join()
+
+        # Without a finished candidate, train the tree single mode would
+        refit_start = time.perf_counter()
+        if best is None:
+            print(f"Info: No candidate finished ({stop_reason}), "
+                  f"using the default decision tree")
+            model = build_model('decision_tree', {})
+        else:
+            # Refit the best candidate on all of the training data, keeping
+            # the column names X came with
+            model = build_model(best['model_type'], best['params'])
+        model.fit(X, y)
+
+        finished = {result['index'] for result in completed}
+        report = {
+            'settings': settings,
+            'stop_reason': stop_reason,
+            'search_seconds': refit_start - start,
+            'refit_seconds': time.perf_counter() - refit_start,
+            'best': best,
+            'fallback': None if best is not None else {
+                'model_type': 'decision_tree', 'params': {}},
+            'candidates': sorted(completed, key=lambda result: result['index']),
+            'not_finished': [
+                {'index': index, 'model_type': model_type, 'params': params}
+                for index, (model_type, params) in enumerate(candidate_list)
+                if index not in finished],
+        }
+
+        if best is not None:
+            print(f"Model search stopped: {stop_reason}, best {best['model_type']} "
+                  f"{best['params']} with R2 {best['r2_mean']:.4f}")
+
+        return model, report
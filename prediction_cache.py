@@ -0,0 +1,230 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def prediction_cache_settings():
+    # Cache size, lifetime and store, overridable through the environment
+    return {
+        'max_size': int(os.environ.get('PREDICTION_CACHE_SIZE', 10000)),
+        'ttl_seconds': float(os.environ.get('PREDICTION_CACHE_TTL_SECONDS', 3600)),
+        'shared': os.environ.get('PREDICTION_CACHE_SHARED', '').lower() in ('1', 'true'),
+        'path': os.environ.get('PREDICTION_CACHE_PATH', os.path.join(
+            tempfile.gettempdir(), 'etl-project-prediction-cache.sqlite')),
+    }
+
+
+def create_prediction_cache():
+    # In-process or shared cache chosen by the environment, None when disabled
+    settings = prediction_cache_settings()
+    if settings['max_size'] <= 0:
+        return None
+
+    if settings['shared']:
+        return SharedPredictionCache(
+            settings['path'], settings['max_size'], settings['ttl_seconds'])
+    return PredictionCache(settings['max_size'], settings['ttl_seconds'])
+
+
+def prediction_key(lead, director, genre, budget, chart):
+    # The same inputs give the same key however the numbers were written
+    return json.dumps([repr(float(lead)), repr(float(director)), repr(float(genre)),
+                       repr(float(budget)), 'json' if chart == 'json' else 'image'])
+
+
+class PredictionCache:
+    # Least recently used results of this process, each kept up to ttl_seconds.
+    # Entries belong to one snapshot version and are dropped when it changes.
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+
+        # Counters for this process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def use_version(self, version):
+        # Called with the lock held
+        if version != self.version:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.version = version
+
+    def get(self, version, key):
+        with self.lock:
+            self.use_version(version)
+
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, version, key, value):
+        with self.lock:
+            self.use_version(version)
+
+            self.entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        size = self.size()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'store': 'memory',
+                'size': size,
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+class SharedPredictionCache(PredictionCache):
+    # The same cache in an SQLite file, shared by every worker on the host.
+    # Workers reload snapshots at different times, so a worker that moves
+    # to a new version only deletes the entries of the version it left.
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path, max_size, ttl_seconds):
+        super(SharedPredictionCache, self).__init__(max_size, ttl_seconds)
+        self.path = path
+        self.local = threading.local()
+        self.puts = 0
+
+    def connection(self):
+        # One connection per thread, opened after any fork
+        if getattr(self.local, 'process_id', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS predictions ('
+                'version TEXT, key TEXT, value TEXT, expires_at REAL, used_at REAL, '
+                'PRIMARY KEY (version, key))')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS predictions_used_at ON predictions (used_at)')
+            self.local.connection = connection
+            self.local.process_id = os.getpid()
+        return self.local.connection
+
+    def use_version(self, version):
+        with self.lock:
+            previous, self.version = self.version, version
+        if previous is None or previous == version:
+            return
+
+        deleted = self.connection().execute(
+            'DELETE FROM predictions WHERE version = ?', (previous,)).rowcount
+        self.count('invalidations', deleted)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, version, key):
+        try:
+            self.use_version(version)
+            connection = self.connection()
+            row = connection.execute(
+                'SELECT value, expires_at FROM predictions WHERE version = ? AND key = ?',
+                (version, key)).fetchone()
+            if row is None:
+                self.count('misses')
+                return None
+
+            value, expires_at = row
+            now = time.time()
+            if expires_at <= now:
+                connection.execute(
+                    'DELETE FROM predictions WHERE version = ? AND key = ?', (version, key))
+                self.count('expirations')
+                self.count('misses')
+                return None
+
+            connection.execute(
+                'UPDATE predictions SET used_at = ? WHERE version = ? AND key = ?',
+                (now, version, key))
+            self.count('hits')
+            return json.loads(value)
+        except sqlite3.Error as e:
+            # A busy or broken store only costs the prediction a recompute
+            print(f"Error reading prediction cache: {e}")
+            self.count('misses')
+            return None
+
+    def put(self, version, key, value):
+        try:
+            self.use_version(version)
+            connection = self.connection()
+            now = time.time()
+            connection.execute(
+                'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+                (version, key, json.dumps(value), now + self.ttl_seconds, now))
+
+            # Trim to max_size now and then rather than on every write
+            with self.lock:
+                self.puts += 1
+                trim = self.puts % self.EVICTION_INTERVAL == 0
+            if trim:
+                self.evict(connection, now)
+        except sqlite3.Error as e:
+            print(f"Error writing prediction cache: {e}")
+
+    def evict(self, connection, now):
+        expired = connection.execute(
+            'DELETE FROM predictions WHERE expires_at <= ?', (now,)).rowcount
+        self.count('expirations', expired)
+
+        excess = connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0] - self.max_size
+        if excess > 0:
+            evicted = connection.execute(
+                'DELETE FROM predictions WHERE rowid IN ('
+                'SELECT rowid FROM predictions ORDER BY used_at LIMIT ?)', (excess,)).rowcount
+            self.count('evictions', evicted)
+
+    def size(self):
+        try:
+            return self.connection().execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def stats(self):
+        stats = super(SharedPredictionCache, self).stats()
+        stats['store'] = 'shared'
+        stats['path'] = self.path
+        return stats
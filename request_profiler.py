@@ -0,0 +1,143 @@
+import cProfile
+import heapq
+import hmac
+import itertools
+import marshal
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+# Paths shorter than this are left out of the collapsed stacks
+MIN_PATH_SECONDS = 1e-6
+
+
+def request_profiler_settings():
+    # Share of requests to profile and how many of the slowest to keep
+    return {
+        'rate': float(os.environ.get('REQUEST_PROFILE_RATE', 0)),
+        'keep': int(os.environ.get('REQUEST_PROFILE_KEEP', 20)),
+        'header': os.environ.get('REQUEST_PROFILE_HEADER', 'X-Profile-Request'),
+        # Profiling on demand and downloading profiles both need the token
+        'token': os.environ.get('REQUEST_PROFILE_TOKEN') or None,
+    }
+
+
+def function_name(function):
+    file_name, line, name = function
+    if file_name == '~':
+        # Built-in functions, e.g. "<method 'sort' of 'list' objects>"
+        return name
+    return f"{os.path.basename(file_name)}:{name}:{line}"
+
+
+def collapsed_stacks(stats):
+    # Flame graph lines ("outer;...;inner microseconds") from cProfile stats.
+    # cProfile only records direct callers, so when a function is reached
+    # along several paths its time is split between them in proportion to
+    # each caller's share, the usual approximation.
+    children = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            children.setdefault(caller, []).append((function, cumulative))
+
+    lines = {}
+
+    def visit(function, path, share):
+        own_time = stats[function][2]
+        path = path + (function,)
+        key = ';'.join(function_name(item) for item in path)
+        lines[key] = lines.get(key, 0) + own_time * share
+
+        for child, cumulative in children.get(function, []):
+            # Recursive calls are already counted in the outer call
+            if child in path or child not in stats or not stats[child][3]:
+                continue
+            if share * cumulative < MIN_PATH_SECONDS:
+                continue
+            visit(child, path, share * cumulative / stats[child][3])
+
+    for function, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            visit(function, (), 1.0)
+
+    return ''.join(f"{key} {round(seconds * 1e6)}\n"
+                   for key, seconds in sorted(lines.items()) if round(seconds * 1e6) > 0)
+
+
+def pstats_bytes(stats):
+    # The file format pstats.Stats reads, as cProfile.Profile.dump_stats writes
+    return marshal.dumps(stats)
+
+
+class RequestProfiler:
+    # Profiles a random share of requests, and requests that carry the
+    # profiling header with the token, keeping the slowest few in memory
+    def __init__(self, rate=0.0, keep=20, header='X-Profile-Request', token=None):
+        self.rate = rate
+        self.keep = keep
+        self.header = header
+        self.token = token
+
+        self.lock = threading.Lock()
+        self.slowest = []
+        self.ids = itertools.count(1)
+        self.profiled = 0
+
+    @classmethod
+    def from_settings(cls):
+        # Profiler configured from the environment, or None when disabled
+        settings = request_profiler_settings()
+        if settings['rate'] <= 0 and settings['token'] is None:
+            return None
+        return cls(settings['rate'], settings['keep'], settings['header'], settings['token'])
+
+    def authorized(self, value):
+        return self.token is not None and value is not None and \
+            hmac.compare_digest(value.encode('utf-8'), self.token.encode('utf-8'))
+
+    def should_profile(self, headers):
+        if self.rate > 0 and random.random() < self.rate:
+            return True
+        return self.authorized(headers.get(self.header))
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile, time.perf_counter()
+
+    def finish(self, started, details):
+        profile, start = started
+        profile.disable()
+        seconds = time.perf_counter() - start
+
+        with self.lock:
+            self.profiled += 1
+            # Skip building the stats for requests faster than all kept ones
+            if len(self.slowest) >= self.keep and seconds <= self.slowest[0][0]:
+                return
+
+        profile.create_stats()
+        entry = dict(details, id=next(self.ids), seconds=seconds,
+                     finished_at=datetime.now().isoformat(), stats=profile.stats)
+
+        with self.lock:
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, (seconds, entry['id'], entry))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, entry['id'], entry))
+
+    def profiles(self):
+        # The kept profiles, slowest first, without their stats
+        with self.lock:
+            entries = [entry for _, _, entry in sorted(self.slowest, reverse=True)]
+        return [{key: value for key, value in entry.items() if key != 'stats'}
+                for entry in entries]
+
+    def stats(self, profile_id):
+        with self.lock:
+            for _, _, entry in self.slowest:
+                if entry['id'] == profile_id:
+                    return entry['stats']
+        return None
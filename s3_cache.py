@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are unavailable on Windows, workers then download separately
+    fcntl = None
+
+
+def cache_settings():
+    # Cache location and size, overridable through the environment
+    return {
+        'enabled': os.environ.get('S3_CACHE_ENABLED', '1').lower() in ('1', 'true'),
+        'directory': os.environ.get(
+            'S3_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'etl-project-s3-cache')),
+        'max_bytes': int(os.environ.get('S3_CACHE_MAX_BYTES', 2 * 1024 ** 3)),
+    }
+
+
+def digest(*parts):
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def is_not_modified(error):
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return status == 304 or error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
+class S3DiskCache:
+    def __init__(self, directory=None, max_bytes=None):
+        settings = cache_settings()
+
+        self.directory = directory or settings['directory']
+        self.max_bytes = max_bytes or settings['max_bytes']
+
+        # Blobs are named by bucket/key/ETag, refs point a bucket/key at a blob
+        self.objects_directory = os.path.join(self.directory, 'objects')
+        self.refs_directory = os.path.join(self.directory, 'refs')
+        self.locks_directory = os.path.join(self.directory, 'locks')
+        for directory in (self.objects_directory, self.refs_directory, self.locks_directory):
+            os.makedirs(directory, exist_ok=True)
+
+        # Counters for this process
+        self.counter_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_settings(cls):
+        # Cache configured from the environment, or None when disabled
+        return cls() if cache_settings()['enabled'] else None
+
+    def stats(self):
+        with self.counter_lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def count(self, counter):
+        with self.counter_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @contextmanager
+    def key_lock(self, bucket, key):
+        # Serialise downloads of the same object across workers on this host
+        with self.name_lock(digest(bucket, key)):
+            yield
+
+    @contextmanager
+    def name_lock(self, name, blocking=True):
+        # Lock on locks/<name>.lock, yielding whether it is held
+        if fcntl is None:
+            yield True
+            return
+
+        lock_path = os.path.join(self.locks_directory, name + '.lock')
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                yield False
+                return
+
+            # Evict may have removed the lock file while this worker waited on it
+            if self.is_open_file(lock_file, lock_path):
+                break
+            lock_file.close()
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def is_open_file(self, file, path):
+        try:
+            return os.stat(path).st_ino == os.fstat(file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def write_atomic(self, path, content):
+        # Write to a temporary file then rename so readers never see partial data
+        directory = os.path.dirname(path)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                file.write(content)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def read_ref(self, bucket, key):
+        return self.read_named_ref(digest(bucket, key))
+
+    def read_named_ref(self, name):
+        # Cached ETag and blob path for an object, if the blob still exists
+        try:
+            with open(os.path.join(self.refs_directory, name + '.json')) as file:
+                ref = json.load(file)
+        except (OSError, ValueError):
+            return None, None
+
+        blob_path = os.path.join(self.objects_directory, ref['blob'])
+        if not os.path.exists(blob_path):
+            return None, None
+        return ref['etag'], blob_path
+
+    def get_object(self, s3, bucket, key):
+        # Object content and ETag, from disk when S3 reports it unchanged
+        from botocore.exceptions import ClientError
+
+        with self.key_lock(bucket, key):
+            etag, blob_path = self.read_ref(bucket, key)
+
+            if etag:
+                try:
+                    response = s3.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+                except ClientError as e:
+                    if not is_not_modified(e):
+                        raise
+                    response = None
+
+                # Unchanged in S3, serve the cached copy and mark it recently used
+                if response is None:
+                    try:
+                        with open(blob_path, 'rb') as file:
+                            content = file.read()
+                        os.utime(blob_path)
+                        self.count('hits')
+                        return content, etag
+                    except FileNotFoundError:
+                        # Evicted by another worker since the ref was read
+                        response = s3.get_object(Bucket=bucket, Key=key)
+            else:
+                response = s3.get_object(Bucket=bucket, Key=key)
+
+            content = response['Body'].read()
+            self.count('misses')
+
+            # Store the new version under its ETag and point the ref at it
+            blob_name = digest(bucket, key, response['ETag'])
+            new_blob_path = os.path.join(self.objects_directory, blob_name)
+            self.write_atomic(new_blob_path, content)
+            self.write_atomic(
+                os.path.join(self.refs_directory, digest(bucket, key) + '.json'),
+                json.dumps({'bucket': bucket, 'key': key,
+                            'etag': response['ETag'], 'blob': blob_name}).encode('utf-8'))
+
+            # The previous version of this object can no longer be served
+            if blob_path and blob_path != new_blob_path and os.path.exists(blob_path):
+                os.remove(blob_path)
+
+        self.evict(keep=blob_name)
+        return content, response['ETag']
+
+    def evict(self, keep=None):
+        # Remove least recently used blobs until the cache fits its size limit
+        blobs = []
+        for entry in os.scandir(self.objects_directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                # Another worker may evict the blob after it is listed
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+
+        total_bytes = sum(blob[1] for blob in blobs)
+        for _, size, path, name in sorted(blobs):
+            if total_bytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            self.count('evictions')
+
+        self.prune_refs()
+
+    def prune_refs(self):
+        # Remove refs whose blob is gone, and lock files left without a ref
+        names = {os.path.splitext(entry.name)[0]
+                 for directory in (self.refs_directory, self.locks_directory)
+                 for entry in os.scandir(directory)
+                 if entry.name.endswith(('.json', '.lock'))}
+
+        for name in names:
+            if self.read_named_ref(name)[1]:
+                continue
+
+            # A worker holding the lock may be about to write the ref
+            with self.name_lock(name, blocking=False) as locked:
+                if not locked or self.read_named_ref(name)[1]:
+                    continue
+
+                for path in (os.path.join(self.refs_directory, name + '.json'),
+                             os.path.join(self.locks_directory, name + '.lock')):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
@@ -0,0 +1,141 @@
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Largest number of keys accepted by a single delete_objects call
+DELETE_BATCH_SIZE = 1000
+
+# S3 error codes worth retrying, anything else fails straight away
+RETRYABLE_ERROR_CODES = {
+    'InternalError',
+    'RequestTimeout',
+    'ServiceUnavailable',
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+}
+
+
+def transfer_settings():
+    # Concurrency and retry settings, overridable through the environment
+    return {
+        'concurrency': int(os.environ.get('S3_TRANSFER_CONCURRENCY', 8)),
+        'max_attempts': int(os.environ.get('S3_TRANSFER_MAX_ATTEMPTS', 4)),
+        'backoff_seconds': float(os.environ.get('S3_TRANSFER_BACKOFF_SECONDS', 0.5)),
+    }
+
+
+def client_config():
+    # Size the connection pool so parallel requests do not wait on it
+    from botocore.config import Config
+    return Config(max_pool_connections=max(10, transfer_settings()['concurrency']))
+
+
+def map_concurrently(function, items, concurrency):
+    # Run function over items on a bounded thread pool, keeping the order
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def is_retryable(error):
+    # botocore is imported on first use, so local storage never loads it
+    from botocore.exceptions import (ClientError, ConnectionError, HTTPClientError,
+                                     IncompleteReadError)
+
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get(
+            'ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500
+    return isinstance(error, (ConnectionError, HTTPClientError, IncompleteReadError))
+
+
+class S3Transfer:
+    def __init__(self, s3, concurrency=None, max_attempts=None, backoff_seconds=None,
+                 cache=None):
+        settings = transfer_settings()
+
+        self.s3 = s3
+        self.cache = cache
+        self.concurrency = concurrency or settings['concurrency']
+        self.max_attempts = max_attempts or settings['max_attempts']
+        self.backoff_seconds = backoff_seconds or settings['backoff_seconds']
+
+    def with_retries(self, function, *args, **kwargs):
+        # Retry transient failures with exponential backoff and jitter
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_attempts or not is_retryable(e):
+                    raise
+                delay = self.backoff_seconds * (2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.5)
+                print(f"Retrying S3 call in {delay:.2f}s after error: {e}")
+                time.sleep(delay)
+
+    def get_object(self, bucket, key):
+        # Object content and ETag, through the disk cache when configured
+        if self.cache:
+            return self.with_retries(self.cache.get_object, self.s3, bucket, key)
+
+        def fetch():
+            # Retry the read as well, since the body streams after get_object
+            response = self.s3.get_object(Bucket=bucket, Key=key)
+            return response['Body'].read(), response['ETag']
+
+        return self.with_retries(fetch)
+
+    def get_object_bytes(self, bucket, key):
+        return self.get_object(bucket, key)[0]
+
+    def head_etag(self, bucket, key):
+        # Current ETag of an object, or None if it does not exist
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.with_retries(self.s3.head_object, Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404 or \
+                    e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response['ETag']
+
+    def list_keys(self, bucket, prefix=''):
+        # Page through every key, not just the first 1000
+        paginator = self.s3.get_paginator('list_objects_v2')
+
+        keys = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def map(self, function, items):
+        return map_concurrently(function, items, self.concurrency)
+
+    def delete_keys(self, bucket, keys):
+        # Delete keys in batches of up to 1000, returning the keys deleted
+        keys = list(keys)
+
+        deleted_keys = []
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            response = self.with_retries(
+                self.s3.delete_objects,
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+            failed_keys = set()
+            for error in response.get('Errors', []):
+                failed_keys.add(error['Key'])
+                print(f"Error deleting from S3: {error['Key']} ({error.get('Message')})")
+
+            deleted_keys.extend(key for key in batch if key not in failed_keys)
+
+        return deleted_keys
@@ -0,0 +1,75 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+# Ids and counts fit in 32 bits
+ID_DTYPE = 'int32'
+COUNT_DTYPE = 'int32'
+
+# The average features are only read by the model, which scores in float32
+# anyway, so storing them as float32 leaves every prediction unchanged
+FEATURE_DTYPE = 'float32'
+
+# profit_ratio is the training target and is summed into the aggregates,
+# and budgets over 2**24 would lose whole dollars, so these stay float64
+AMOUNT_DTYPE = 'float64'
+
+# Titles and names are nearly all distinct, so Arrow strings rather than
+# categories, which only pay off for repeated values. ArrowDtype rather than
+# StringDtype('pyarrow'), whose isin is ~40x slower than object in pandas 2.1.
+NAME_DTYPE = pd.ArrowDtype(pa.string())
+
+INPUT_DATA_SCHEMA = {
+    'title': NAME_DTYPE,
+    'lead': ID_DTYPE,
+    'director': ID_DTYPE,
+    'genre': ID_DTYPE,
+    'revenue': AMOUNT_DTYPE,
+    'budget': AMOUNT_DTYPE,
+    'profit_ratio': AMOUNT_DTYPE,
+    'director_average_profit_ratio': FEATURE_DTYPE,
+    'lead_average_profit_ratio': FEATURE_DTYPE,
+    'lead_worked_in_genre_count': COUNT_DTYPE,
+    'director_worked_in_genre_count': COUNT_DTYPE,
+    'director_worked_with_lead_count': COUNT_DTYPE,
+}
+
+# unique_leads, unique_directors and unique_genres, by type column
+TYPE_SCHEMAS = {
+    column: {'id': ID_DTYPE, column: NAME_DTYPE}
+    for column in ('lead', 'director', 'genre')
+}
+
+# Columns of template.csv, which every upload must have and nothing else
+UPLOAD_SCHEMA = {
+    'title': NAME_DTYPE,
+    'lead': NAME_DTYPE,
+    'director': NAME_DTYPE,
+    'genre': NAME_DTYPE,
+    'revenue': AMOUNT_DTYPE,
+    'budget': AMOUNT_DTYPE,
+}
+
+# Processed files by name without the extension
+PROCESSED_SCHEMAS = {
+    'input_data': INPUT_DATA_SCHEMA,
+    'unique_leads': TYPE_SCHEMAS['lead'],
+    'unique_directors': TYPE_SCHEMAS['director'],
+    'unique_genres': TYPE_SCHEMAS['genre'],
+}
+
+
+def processed_schema(key):
+    # Schema of a processed file, None for files without one
+    return PROCESSED_SCHEMAS.get(os.path.splitext(os.path.basename(key))[0])
+
+
+def apply_schema(data_frame, schema):
+    # Cast the columns the schema names, leaving any others as they are
+    if schema is None:
+        return data_frame
+
+    dtypes = {column: dtype for column, dtype in schema.items()
+              if column in data_frame.columns and data_frame[column].dtype != dtype}
+    return data_frame.astype(dtypes) if dtypes else data_frame
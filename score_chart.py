@@ -0,0 +1,148 @@
+import base64
+import threading
+from io import BytesIO
+
+import numpy as np
+
+SCORE_COLOR = '#007bff'
+
+# matplotlib and scipy take about a second to import, so they are imported
+# where they are used and warmed up by the app off the request path
+WARM_UP_MODULES = [
+    'scipy.stats',
+    'matplotlib.figure',
+    'matplotlib.backends.backend_agg',
+    'matplotlib.image',
+    'matplotlib.lines',
+]
+
+
+class ScoreChart:
+    def __init__(self, mean=0, std_dev=1, data_points=100):
+        from scipy.stats import norm
+
+        # Generate random numbers from a normal distribution once
+        self.data = np.random.normal(mean, std_dev, data_points)
+
+        # Fit a normal distribution to the data
+        self.fit_mean, self.fit_std = norm.fit(self.data)
+
+        self.bins = max(10, round(data_points / 20))
+
+        # Percentile lines drawn on the chart
+        self.percentiles = [25, 50, 75]
+        self.percentile_values = np.percentile(self.data, self.percentiles)
+
+        # Figures are not thread safe, so each thread renders on its own
+        self.local = threading.local()
+
+    def percentile(self, score):
+        from scipy.stats import percentileofscore
+
+        # Calculate the percentile of the specific value
+        return percentileofscore(self.data, score)
+
+    def draw_background(self, figure):
+        from matplotlib.lines import Line2D
+        from scipy.stats import norm
+
+        axes = figure.add_subplot()
+
+        # Plot the histogram of the random numbers
+        axes.hist(self.data, bins=self.bins, density=True,
+                  alpha=0.5, color=SCORE_COLOR)
+
+        # Overlay a normal distribution curve
+        xmin, xmax = axes.get_xlim()
+        x = np.linspace(xmin, xmax, 100)
+        p = norm.pdf(x, self.fit_mean, self.fit_std)
+        axes.plot(x, p, 'k', linewidth=2)
+
+        # Add vertical lines to represent percentiles
+        for value in self.percentile_values:
+            axes.axvline(value, color='black', linestyle='dashed', linewidth=1)
+
+        # Add labels, title and a legend entry for the score marker
+        axes.set_title('Score Distribution')
+        axes.set_xlabel('Value')
+        axes.set_ylabel('Probability Density')
+        axes.legend(handles=[Line2D([], [], color=SCORE_COLOR, linestyle='solid',
+                                    linewidth=2, label='Your score')])
+
+        return axes
+
+    def thread_canvas(self):
+        # Lazily render this thread's background and keep it for reuse
+        if not hasattr(self.local, 'canvas'):
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+
+            figure = Figure()
+            canvas = FigureCanvasAgg(figure)
+            axes = self.draw_background(figure)
+            marker = axes.axvline(0, color=SCORE_COLOR, linestyle='solid',
+                                  linewidth=2, animated=True)
+            canvas.draw()
+
+            self.local.canvas = canvas
+            self.local.axes = axes
+            self.local.marker = marker
+            self.local.background = canvas.copy_from_bbox(figure.bbox)
+
+        return self.local
+
+    def render_full(self, score):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        # Render a fresh figure, letting the axis grow to include the score
+        figure = Figure()
+        canvas = FigureCanvasAgg(figure)
+        axes = self.draw_background(figure)
+        axes.axvline(score, color=SCORE_COLOR, linestyle='solid', linewidth=2)
+
+        buffer = BytesIO()
+        canvas.print_png(buffer)
+        return buffer.getvalue()
+
+    def render_png(self, score):
+        from matplotlib.image import imsave
+
+        state = self.thread_canvas()
+        xmin, xmax = state.axes.get_xlim()
+
+        if not xmin <= score <= xmax:
+            png = self.render_full(score)
+        else:
+            # Restore the cached background and draw only the score marker
+            state.canvas.restore_region(state.background)
+            state.marker.set_xdata([score, score])
+            state.axes.draw_artist(state.marker)
+
+            buffer = BytesIO()
+            imsave(buffer, np.asarray(state.canvas.buffer_rgba()), format='png',
+                   pil_kwargs={'compress_level': 1})
+            png = buffer.getvalue()
+
+        # Convert the image data to a base64-encoded string
+        return base64.b64encode(png).decode('utf-8')
+
+    def to_dict(self, score):
+        from scipy.stats import norm
+
+        # Chart data for rendering in the browser instead of on the server
+        densities, bin_edges = np.histogram(self.data, bins=self.bins, density=True)
+        x = np.linspace(bin_edges[0], bin_edges[-1], 100)
+
+        return {
+            'histogram': {
+                'bin_edges': bin_edges.tolist(),
+                'densities': densities.tolist(),
+            },
+            'curve': {
+                'x': x.tolist(),
+                'y': norm.pdf(x, self.fit_mean, self.fit_std).tolist(),
+            },
+            'percentiles': dict(zip(self.percentiles, self.percentile_values.tolist())),
+            'score': score,
+        }
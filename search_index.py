@@ -0,0 +1,91 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+# Length of the character n-grams used by the substring index
+NGRAM_SIZE = 3
+
+
+class SearchIndex:
+    def __init__(self, type_df, column, substring=False):
+        self.column = column
+
+        # Keep only rows with a usable name, sorted by lowercased name
+        records = [
+            (name.lower(), name, int(id))
+            for id, name in zip(type_df['id'], type_df[column])
+            if isinstance(name, str)
+        ]
+        records.sort()
+
+        self.keys = [record[0] for record in records]
+        self.names = [record[1] for record in records]
+        self.ids = [record[2] for record in records]
+
+        # Optional n-gram postings (n-gram -> sorted positions in self.keys)
+        self.ngram_positions = self.build_ngram_positions() if substring else None
+
+    def build_ngram_positions(self):
+        postings = {}
+        for position, key in enumerate(self.keys):
+            for ngram in {key[i:i + NGRAM_SIZE] for i in range(len(key) - NGRAM_SIZE + 1)}:
+                postings.setdefault(ngram, []).append(position)
+
+        return {ngram: np.array(positions, dtype=np.int32)
+                for ngram, positions in postings.items()}
+
+    def record(self, position):
+        return {'id': self.ids[position], self.column: self.names[position]}
+
+    def prefix_search(self, term, limit):
+        term = term.lower()
+
+        # Matches form a contiguous run in the sorted keys starting at start,
+        # ending where the keys cut to the term's length pass the term
+        start = bisect_left(self.keys, term)
+        end = bisect_right(self.keys, term, start, key=lambda key: key[:len(term)])
+
+        return [self.record(position)
+                for position in range(start, min(end, start + limit))]
+
+    def has_substring_index(self):
+        return self.ngram_positions is not None
+
+    def substring_search(self, term, limit):
+        term = term.lower()
+
+        if not self.has_substring_index():
+            raise Exception('Error: Substring index not built')
+
+        # Short terms have no n-gram to look up, so scan the keys, stopping
+        # at the limit
+        if len(term) < NGRAM_SIZE:
+            results = []
+            for position, key in enumerate(self.keys):
+                if term in key:
+                    results.append(self.record(position))
+                    if len(results) == limit:
+                        break
+            return results
+
+        # Intersect postings from the rarest n-gram upwards
+        ngrams = {term[i:i + NGRAM_SIZE] for i in range(len(term) - NGRAM_SIZE + 1)}
+        postings = sorted((self.ngram_positions.get(ngram) for ngram in ngrams),
+                          key=lambda positions: -1 if positions is None else len(positions))
+        if postings[0] is None:
+            return []
+
+        candidates = postings[0]
+        for positions in postings[1:]:
+            candidates = np.intersect1d(candidates, positions, assume_unique=True)
+            if not len(candidates):
+                return []
+
+        # N-grams can match out of order, so confirm each candidate
+        results = []
+        for position in candidates.tolist():
+            if term in self.keys[position]:
+                results.append(self.record(position))
+                if len(results) == limit:
+                    break
+        return results
@@ -0,0 +1,66 @@
+import ast
+import re
+
+# One "'key': value" pair of a serialized dict, or the end of a dict. String
+# values are matched whole, so text inside them is never read as a key. The
+# cast, crew and genres columns hold lists of flat dicts, so values are never
+# nested lists or dicts.
+FIELD_PATTERN = re.compile(r"""
+    (?P<key>'[^'\\]*'|"[^"\\]*")\s*:\s*
+    (?P<value>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|[^,{}\[\]]*)
+    |(?P<end>})
+""", re.VERBOSE)
+
+
+def literal_value(token):
+    # Decode one serialized value without evaluating anything else
+    token = token.strip()
+    if token[:1] in ('"', "'") and '\\' not in token:
+        return token[1:-1]
+    if token == 'None':
+        return None
+    return ast.literal_eval(token)
+
+
+def first_entry_value(text, key):
+    # Value of key in the first dict of a serialized list, e.g. the lead
+    if not isinstance(text, str):
+        return None
+
+    for match in FIELD_PATTERN.finditer(text):
+        if match.group('end'):
+            return None
+        if match.group('key')[1:-1] == key:
+            return literal_value(match.group('value'))
+    return None
+
+
+def first_matching_entry_value(text, key, match_key, match_value):
+    # Value of key in the first dict where match_key equals match_value
+    if not isinstance(text, str) or match_value not in text:
+        return None
+
+    fields = {}
+    for match in FIELD_PATTERN.finditer(text):
+        if match.group('end'):
+            if match_key in fields and literal_value(fields[match_key]) == match_value:
+                return literal_value(fields[key]) if key in fields else None
+            fields = {}
+            continue
+        fields[match.group('key')[1:-1]] = match.group('value')
+    return None
+
+
+def lead_name(cast):
+    # First member of the cast
+    return first_entry_value(cast, 'name')
+
+
+def director_name(crew):
+    # First member of the crew whose job is Director
+    return first_matching_entry_value(crew, 'name', 'job', 'Director')
+
+
+def genre_name(genres):
+    # First listed genre
+    return first_entry_value(genres, 'name')
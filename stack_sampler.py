@@ -0,0 +1,55 @@
+import os
+import sys
+import threading
+from collections import Counter
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame):
+    # Outermost call first, as flame graph tools expect
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    # Samples one thread's stack on a background thread every interval
+    # seconds, counting identical stacks. Cheaper than cProfile on code
+    # with many small calls, and the counts are ready for a flame graph.
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample_forever, name='stack-sampler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self
+
+    def sample_forever(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.stacks[collapse_stack(frame)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        # One "outer;...;inner count" line per distinct stack
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
@@ -0,0 +1,223 @@
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+
+from s3_cache import S3DiskCache
+from s3_transfer import S3Transfer, client_config, map_concurrently, transfer_settings
+
+
+def storage_settings():
+    # Storage backend, 's3' unless configured otherwise
+    return {
+        'backend': os.environ.get('STORAGE_BACKEND', 's3').lower(),
+        'directory': os.environ.get(
+            'LOCAL_STORAGE_DIR', os.path.join(os.path.dirname(__file__), 'local_storage')),
+    }
+
+
+def bucket_names():
+    # Bucket names, overridable to point a deployment at other buckets
+    return {
+        'processed': os.environ.get('PROCESSED_BUCKET', 'etl-project-data-processed'),
+        'uploads': os.environ.get('UPLOADS_BUCKET', 'etl-project-uploads'),
+        'model': os.environ.get('MODEL_BUCKET', 'etl-project-ml-model'),
+    }
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class Storage(ABC):
+    # Operations the ETL, trainer and app need from an object store
+    cache = None
+    concurrency = 1
+
+    @abstractmethod
+    def get_object(self, bucket, key):
+        # Object content and ETag, raising ObjectNotFound if it is missing
+        pass
+
+    def get_object_bytes(self, bucket, key):
+        return self.get_object(bucket, key)[0]
+
+    @abstractmethod
+    def head_etag(self, bucket, key):
+        # Current ETag of an object, or None if it does not exist
+        pass
+
+    @abstractmethod
+    def put_object(self, bucket, key, content):
+        pass
+
+    @abstractmethod
+    def upload_fileobj(self, file, bucket, key):
+        # Store a file-like object without reading it into memory first
+        pass
+
+    @abstractmethod
+    def list_keys(self, bucket, prefix=''):
+        pass
+
+    @abstractmethod
+    def delete_keys(self, bucket, keys):
+        # Delete keys, returning the keys deleted
+        pass
+
+    def map(self, function, items):
+        # Run function over items on a bounded thread pool, keeping the order
+        return map_concurrently(function, items, self.concurrency)
+
+
+class S3Storage(Storage):
+    def __init__(self, s3, cache=None):
+        self.s3 = s3
+        self.cache = cache
+        self.transfer = S3Transfer(s3, cache=cache)
+        self.concurrency = self.transfer.concurrency
+
+    def get_object(self, bucket, key):
+        try:
+            return self.transfer.get_object(bucket, key)
+        except self.s3.exceptions.NoSuchKey as e:
+            raise ObjectNotFound(f"{bucket}/{key}") from e
+
+    def head_etag(self, bucket, key):
+        return self.transfer.head_etag(bucket, key)
+
+    def put_object(self, bucket, key, content):
+        self.transfer.with_retries(
+            self.s3.put_object, Body=content, Bucket=bucket, Key=key)
+
+    def upload_fileobj(self, file, bucket, key):
+        self.s3.upload_fileobj(file, bucket, key)
+
+    def list_keys(self, bucket, prefix=''):
+        return self.transfer.list_keys(bucket, prefix)
+
+    def delete_keys(self, bucket, keys):
+        return self.transfer.delete_keys(bucket, keys)
+
+
+class LocalStorage(Storage):
+    # Buckets are directories and keys are paths below them
+    def __init__(self, directory, concurrency=None):
+        self.directory = os.path.abspath(directory)
+        self.concurrency = concurrency or transfer_settings()['concurrency']
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.directory, bucket)
+
+    def object_path(self, bucket, key):
+        bucket_path = self.bucket_path(bucket)
+        path = os.path.normpath(os.path.join(bucket_path, *key.split('/')))
+
+        # Keys must not escape their bucket directory
+        if not path.startswith(bucket_path + os.sep):
+            raise Exception(f"Error: Invalid key {key}")
+        return path
+
+    def etag(self, stat):
+        # Changes whenever the file is rewritten, like an S3 ETag
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def get_object(self, bucket, key):
+        try:
+            with open(self.object_path(bucket, key), 'rb') as file:
+                etag = self.etag(os.fstat(file.fileno()))
+                return file.read(), etag
+        except FileNotFoundError as e:
+            raise ObjectNotFound(f"{bucket}/{key}") from e
+
+    def head_etag(self, bucket, key):
+        try:
+            return self.etag(os.stat(self.object_path(bucket, key)))
+        except FileNotFoundError:
+            return None
+
+    def write_file(self, bucket, key, write):
+        # Write to a temporary file then rename so readers never see partial data
+        path = self.object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        file_descriptor, temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                write(file)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def put_object(self, bucket, key, content):
+        self.write_file(bucket, key, lambda file: file.write(content))
+
+    def upload_fileobj(self, file, bucket, key):
+        self.write_file(bucket, key, lambda target: shutil.copyfileobj(file, target))
+
+    def list_keys(self, bucket, prefix=''):
+        bucket_path = self.bucket_path(bucket)
+
+        keys = []
+        for directory, _, file_names in os.walk(bucket_path):
+            for file_name in file_names:
+                if file_name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, file_name)
+                key = os.path.relpath(path, bucket_path).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+
+        # Same order as an S3 listing
+        return sorted(keys)
+
+    def delete_keys(self, bucket, keys):
+        deleted_keys = []
+        for key in keys:
+            try:
+                os.remove(self.object_path(bucket, key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error deleting from storage: {key} ({e})")
+                continue
+            deleted_keys.append(key)
+
+        # S3 has no folders, so remove folders the deletes left empty
+        bucket_path = self.bucket_path(bucket)
+        for key in deleted_keys:
+            directory = os.path.dirname(self.object_path(bucket, key))
+            while directory.startswith(bucket_path + os.sep):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+        return deleted_keys
+
+
+def create_storage(use_cache=False):
+    # Storage chosen by STORAGE_BACKEND, optionally with the S3 disk cache
+    settings = storage_settings()
+
+    if settings['backend'] == 'local':
+        print(f"Using local storage: {settings['directory']}")
+        return LocalStorage(settings['directory'])
+
+    if settings['backend'] != 's3':
+        raise Exception(f"Error: Unknown storage backend {settings['backend']}")
+
+    # Only S3 needs credentials or boto3, so local storage imports neither
+    import boto3
+    from env import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+
+    s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID,
+                      aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                      config=client_config())
+    cache = S3DiskCache.from_settings() if use_cache else None
+
+    return S3Storage(s3, cache=cache)
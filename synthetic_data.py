@@ -0,0 +1,283 @@
+import argparse
+import os
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from upload_ingest import UploadIngester, manifest_key
+
+# Genres as they appear in the public movies dataset, most common first
+GENRES = [
+    'Drama', 'Comedy', 'Thriller', 'Romance', 'Action', 'Horror', 'Crime',
+    'Documentary', 'Adventure', 'Science Fiction', 'Family', 'Mystery',
+    'Fantasy', 'Animation', 'Foreign', 'Music', 'History', 'War', 'Western',
+    'TV Movie',
+]
+
+FIRST_NAMES = [
+    'James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael',
+    'Linda', 'William', 'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan',
+    'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen', 'Daniel',
+    'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Betty', 'Mark', 'Margaret',
+    'Donald', 'Sandra', 'Steven', 'Ashley', 'Paul', 'Kimberly', 'Andrew',
+    'Emily', 'Joshua', 'Donna', 'Kenneth', 'Michelle',
+]
+
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller',
+    'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Gonzalez',
+    'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark',
+    'Ramirez', 'Lewis', 'Robinson', 'Walker', 'Young', 'Allen', 'King',
+    'Wright', 'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores',
+]
+
+OTHER_LANGUAGES = ['fr', 'it', 'ja', 'de', 'es', 'ru', 'hi', 'ko']
+OTHER_STATUSES = ['Post Production', 'Rumored', 'In Production', 'Planned']
+
+# Distinct people per movie, close to the ratios in the public dataset
+LEAD_RATIO = 0.35
+SUPPORTING_RATIO = 1.2
+DIRECTOR_RATIO = 0.2
+
+# A few people appear in many movies, most appear in one or two
+ZIPF_EXPONENT = 1.1
+
+# Share of rows with the gaps and junk found in the real files
+ZERO_BUDGET_SHARE = 0.25
+ZERO_REVENUE_SHARE = 0.3
+ENGLISH_SHARE = 0.72
+RELEASED_SHARE = 0.98
+EMPTY_CAST_SHARE = 0.02
+NO_DIRECTOR_SHARE = 0.01
+BAD_ID_SHARE = 0.001
+
+CREDITS_FILE = 'credits.csv'
+MOVIES_METADATA_FILE = 'movies_metadata.csv'
+
+# Rows generated and written at a time, to bound memory at large scales
+CHUNK_ROWS = 200000
+
+
+def parse_scale(scale):
+    # Number of movies from text such as 10k, 100k, 1M or 10M
+    scale = str(scale).strip().lower()
+    multipliers = {'k': 1000, 'm': 1000000}
+    if scale[-1:] in multipliers:
+        return int(float(scale[:-1]) * multipliers[scale[-1]])
+    return int(scale)
+
+
+def person_count(movies, ratio):
+    return max(50, int(movies * ratio))
+
+
+def person_names(indices):
+    # Readable, deterministic names for person indices
+    indices = np.asarray(indices)
+    first = np.asarray(FIRST_NAMES, dtype=object)[indices % len(FIRST_NAMES)]
+    last = np.asarray(LAST_NAMES, dtype=object)[
+        (indices // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    generation = indices // (len(FIRST_NAMES) * len(LAST_NAMES))
+
+    names = pd.Series(first) + ' ' + pd.Series(last)
+    suffix = pd.Series(generation + 1).astype(str)
+    return names.where(generation == 0, names + ' ' + suffix).to_numpy()
+
+
+class ZipfSampler:
+    # Draw ranks 0..population-1 with a long tail, using one cumulative table
+    def __init__(self, population, exponent=ZIPF_EXPONENT):
+        weights = 1.0 / np.arange(1, population + 1) ** exponent
+        self.cumulative = np.cumsum(weights / weights.sum())
+
+    def sample(self, rng, size):
+        ranks = np.searchsorted(self.cumulative, rng.random(size), side='right')
+        return np.minimum(ranks, len(self.cumulative) - 1)
+
+
+def cast_string(names, orders, character_ids):
+    return '[' + ', '.join(
+        f"{{'cast_id': {character_id}, 'character': 'Character {character_id}', "
+        f"'gender': 2, 'id': {character_id}, 'name': {name!r}, 'order': {order}}}"
+        for name, order, character_id in zip(names, orders, character_ids)) + ']'
+
+
+def crew_string(members):
+    return '[' + ', '.join(
+        f"{{'department': {department!r}, 'gender': 0, 'id': {person_id}, "
+        f"'job': {job!r}, 'name': {name!r}}}"
+        for department, job, name, person_id in members) + ']'
+
+
+def genres_string(genre_indices):
+    return '[' + ', '.join(
+        f"{{'id': {index + 1}, 'name': {GENRES[index]!r}}}" for index in genre_indices) + ']'
+
+
+def credits_chunk(rng, ids, samplers):
+    size = len(ids)
+    leads = person_names(samplers['lead'].sample(rng, size))
+    supporting = person_names(samplers['supporting'].sample(rng, (size, 2)).ravel()
+                              + len(samplers['lead'].cumulative)).reshape(size, 2)
+    directors = person_names(samplers['director'].sample(rng, size) + 10 ** 7)
+    producers = person_names(rng.integers(0, size * 2, size) + 2 * 10 ** 7)
+
+    empty_cast = rng.random(size) < EMPTY_CAST_SHARE
+    no_director = rng.random(size) < NO_DIRECTOR_SHARE
+
+    cast = []
+    crew = []
+    for row in range(size):
+        if empty_cast[row]:
+            cast.append('[]')
+        else:
+            cast.append(cast_string(
+                (leads[row], supporting[row, 0], supporting[row, 1]),
+                (0, 1, 2),
+                (3 * row, 3 * row + 1, 3 * row + 2)))
+
+        # Directors are usually, but not always, listed after a producer
+        members = [('Production', 'Producer', producers[row], 2 * row)]
+        if not no_director[row]:
+            members.append(('Directing', 'Director', directors[row], 2 * row + 1))
+        crew.append(crew_string(members))
+
+    return pd.DataFrame({'cast': cast, 'crew': crew, 'id': ids})
+
+
+def movies_chunk(rng, ids):
+    size = len(ids)
+
+    # Budgets and revenues are log-normal, with many zeros for unknown values
+    budget = np.round(np.exp(rng.normal(np.log(15e6), 1.2, size)), -3)
+    budget[rng.random(size) < ZERO_BUDGET_SHARE] = 0
+    revenue = np.round(budget * np.exp(rng.normal(0.2, 1.0, size)), -3)
+    revenue[rng.random(size) < ZERO_REVENUE_SHARE] = 0
+
+    genre_sampler = ZipfSampler(len(GENRES), exponent=0.8)
+    primary_genres = genre_sampler.sample(rng, size)
+    secondary_genres = genre_sampler.sample(rng, size)
+    genre_counts = rng.integers(0, 3, size)
+
+    genres = []
+    for row in range(size):
+        genre_indices = [primary_genres[row], secondary_genres[row]][:genre_counts[row]]
+        genres.append(genres_string(genre_indices))
+
+    language = np.where(rng.random(size) < ENGLISH_SHARE, 'en',
+                        rng.choice(OTHER_LANGUAGES, size))
+    status = np.where(rng.random(size) < RELEASED_SHARE, 'Released',
+                      rng.choice(OTHER_STATUSES, size))
+
+    # A handful of ids are dates, as in the real file
+    movie_ids = ids.astype(str).astype(object)
+    bad_ids = rng.random(size) < BAD_ID_SHARE
+    movie_ids[bad_ids] = '2014-01-01'
+
+    return pd.DataFrame({
+        'adult': False,
+        'budget': budget.astype(np.int64),
+        'genres': genres,
+        'id': movie_ids,
+        'imdb_id': ['tt%07d' % movie_id for movie_id in ids],
+        'original_language': language,
+        'original_title': ['Movie %d' % movie_id for movie_id in ids],
+        'popularity': np.round(rng.exponential(3.0, size), 6),
+        'release_date': pd.to_datetime(
+            rng.integers(-2208988800, 1500000000, size), unit='s').strftime('%Y-%m-%d'),
+        'revenue': revenue.astype(np.int64),
+        'runtime': rng.integers(60, 180, size),
+        'status': status,
+        'title': ['Movie %d' % movie_id for movie_id in ids],
+        'vote_average': np.round(rng.uniform(1, 10, size), 1),
+        'vote_count': rng.poisson(100, size),
+    })
+
+
+def samplers_for(movies):
+    return {
+        'lead': ZipfSampler(person_count(movies, LEAD_RATIO)),
+        'supporting': ZipfSampler(person_count(movies, SUPPORTING_RATIO)),
+        'director': ZipfSampler(person_count(movies, DIRECTOR_RATIO)),
+    }
+
+
+def write_raw_data(directory, movies, seed=0):
+    # Write credits.csv and movies_metadata.csv in the public dataset's format
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    samplers = samplers_for(movies)
+
+    credits_path = os.path.join(directory, CREDITS_FILE)
+    movies_path = os.path.join(directory, MOVIES_METADATA_FILE)
+
+    for start in range(0, movies, CHUNK_ROWS):
+        ids = np.arange(start + 1, min(start + CHUNK_ROWS, movies) + 1)
+        mode = 'w' if start == 0 else 'a'
+
+        credits_chunk(rng, ids, samplers).to_csv(
+            credits_path, mode=mode, header=start == 0, index=False)
+        movies_chunk(rng, ids).to_csv(
+            movies_path, mode=mode, header=start == 0, index=False)
+
+        print(f"Synthetic movies written: {ids[-1]} of {movies}")
+
+    return credits_path, movies_path
+
+
+def write_uploads(storage, bucket, movies, files, rows_per_file, seed=0,
+                  new_people_share=0.1):
+    # Upload CSVs in the template format, mostly naming people already known,
+    # staged through the same ingester as /upload
+    ingester = UploadIngester(storage, bucket)
+    rng = np.random.default_rng(seed + 1)
+    samplers = samplers_for(movies)
+
+    keys = []
+    for file_number in range(files):
+        size = rows_per_file
+        leads = samplers['lead'].sample(rng, size)
+        directors = samplers['director'].sample(rng, size) + 10 ** 7
+
+        # Some rows introduce people the processed data has never seen
+        new_people = rng.random(size) < new_people_share
+        leads[new_people] += 3 * 10 ** 7
+
+        budget = np.round(np.exp(rng.normal(np.log(15e6), 1.0, size)), -3)
+        revenue = np.round(budget * np.exp(rng.normal(0.2, 0.8, size)), -3)
+
+        data_frame = pd.DataFrame({
+            'title': [f"Upload {file_number}-{row}" for row in range(size)],
+            'lead': person_names(leads),
+            'director': person_names(directors),
+            'genre': np.asarray(GENRES)[ZipfSampler(len(GENRES), 0.8).sample(rng, size)],
+            'revenue': revenue.astype(np.int64),
+            'budget': budget.astype(np.int64),
+        })
+
+        manifest = ingester.ingest(
+            BytesIO(data_frame.to_csv(index=False).encode('utf-8')),
+            f"synthetic_{file_number:05d}.csv")
+        keys.append(manifest_key(manifest['prefix']))
+
+    print(f"Synthetic uploads written: {len(keys)} files of {rows_per_file} rows")
+
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write synthetic credits.csv and movies_metadata.csv files')
+    parser.add_argument('scale', help='number of movies, e.g. 10k, 100k, 1M or 10M')
+    parser.add_argument('--output', default=os.path.join(
+        os.path.dirname(__file__), 'raw_datasets'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_raw_data(args.output, parse_scale(args.scale), seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+from sklearn.tree import DecisionTreeRegressor
+
+from flat_tree import FlatTree, rejects_missing_features
+
+FEATURE_NAMES = ['budget', 'director_average_profit_ratio', 'lead_average_profit_ratio',
+                 'lead_worked_in_genre_count', 'director_worked_in_genre_count',
+                 'director_worked_with_lead_count']
+
+
+def training_data(rows=2000, seed=0):
+    # Columns shaped like the model's features: a budget, two ratios and counts
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([
+        np.round(np.exp(rng.normal(np.log(15e6), 1.0, rows)), -3),
+        rng.normal(1.5, 1.0, rows),
+        rng.normal(1.5, 1.0, rows),
+        rng.integers(0, 20, rows),
+        rng.integers(0, 20, rows),
+        rng.integers(0, 5, rows),
+    ])
+    y = X[:, 1] * 0.5 + X[:, 2] * 0.3 + rng.normal(0, 0.5, rows)
+    return X, y
+
+
+@pytest.fixture(scope='module')
+def fitted():
+    X, y = training_data()
+    model = DecisionTreeRegressor(random_state=0).fit(X, y)
+    return model, X
+
+
+def flat_trees(model):
+    # As exported, and as the app loads it, with and without row lists
+    flat_tree = FlatTree.from_sklearn(model, feature_names=FEATURE_NAMES)
+    content = flat_tree.to_bytes()
+    return [flat_tree,
+            FlatTree.from_bytes(content, row_lists=True),
+            FlatTree.from_bytes(content, row_lists=False)]
+
+
+def test_batches_match_sklearn(fitted):
+    model, X = fitted
+    X_new, _ = training_data(rows=500, seed=1)
+
+    for flat_tree in flat_trees(model):
+        np.testing.assert_array_equal(flat_tree.predict(X), model.predict(X))
+        np.testing.assert_array_equal(flat_tree.predict(X_new), model.predict(X_new))
+
+
+def test_single_rows_match_sklearn(fitted):
+    model, X = fitted
+    X_new, _ = training_data(rows=100, seed=2)
+
+    for flat_tree in flat_trees(model):
+        for row in np.vstack([X[:100], X_new]):
+            expected = model.predict(row.reshape(1, -1))
+            np.testing.assert_array_equal(flat_tree.predict(row), expected)
+            np.testing.assert_array_equal(flat_tree.predict([row.tolist()]), expected)
+
+
+def test_rows_on_the_thresholds_match_sklearn(fitted):
+    # Values equal to a split threshold, where float32 rounding decides the side
+    model, X = fitted
+    tree = model.tree_
+    rows = []
+    for node in np.flatnonzero(tree.children_left != -1)[:200]:
+        row = X[node % len(X)].copy()
+        row[tree.feature[node]] = tree.threshold[node]
+        rows.append(row)
+    rows = np.array(rows)
+
+    for flat_tree in flat_trees(model):
+        np.testing.assert_array_equal(flat_tree.predict(rows), model.predict(rows))
+        for row in rows:
+            np.testing.assert_array_equal(flat_tree.predict(row),
+                                          model.predict(row.reshape(1, -1)))
+
+
+def test_single_leaf_tree_matches_sklearn():
+    X, _ = training_data(rows=50)
+    model = DecisionTreeRegressor().fit(X, np.full(len(X), 2.5))
+
+    for flat_tree in flat_trees(model):
+        np.testing.assert_array_equal(flat_tree.predict(X), model.predict(X))
+        np.testing.assert_array_equal(flat_tree.predict(X[0]), model.predict(X[:1]))
+
+
+@pytest.mark.parametrize('value, message', [
+    (np.nan, 'Input X contains NaN.'),
+    (np.inf, 'Input X contains infinity'),
+    (-np.inf, 'Input X contains infinity'),
+    (1e39, 'Input X contains infinity'),
+])
+def test_missing_and_infinite_features_are_refused_like_sklearn(fitted, value, message):
+    model, X = fitted
+    batch = X[:5].copy()
+    batch[3, 2] = value
+
+    for flat_tree in flat_trees(model):
+        for rows in (batch, batch[3], batch[3:4]):
+            with pytest.raises(ValueError, match=f"^{message}"):
+                flat_tree.predict(rows)
+
+    with pytest.raises(ValueError, match=f"^{message}"):
+        model.predict(batch)
+
+
+def test_rejects_missing_features_agrees_with_sklearn(fitted):
+    model, X = fitted
+
+    for flat_tree in flat_trees(model):
+        assert rejects_missing_features(flat_tree.predict, X) is True
+    assert rejects_missing_features(model.predict, X) is True
@@ -0,0 +1,89 @@
+import hashlib
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+from s3_cache import S3DiskCache
+
+
+class FakeS3:
+    # Answers conditional GETs with a 304 like S3 when the ETag matches
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        content = self.objects[(Bucket, Key)]
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'},
+                               'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+        return {'Body': FakeBody(content), 'ETag': etag}
+
+
+class FakeBody:
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+def listing(cache):
+    return {name: sorted(os.listdir(directory)) for name, directory in (
+        ('objects', cache.objects_directory),
+        ('refs', cache.refs_directory),
+        ('locks', cache.locks_directory))}
+
+
+def test_evicted_objects_leave_no_refs_or_locks(tmp_path):
+    s3 = FakeS3({('bucket', 'old'): b'x' * 60, ('bucket', 'new'): b'y' * 60})
+    cache = S3DiskCache(str(tmp_path), max_bytes=100)
+
+    cache.get_object(s3, 'bucket', 'old')
+    os.utime(os.path.join(cache.objects_directory, os.listdir(cache.objects_directory)[0]),
+             (0, 0))
+    cache.get_object(s3, 'bucket', 'new')
+
+    files = listing(cache)
+    assert len(files['objects']) == len(files['refs']) == len(files['locks']) == 1
+    assert cache.read_ref('bucket', 'new')[1] is not None
+    assert cache.read_ref('bucket', 'old') == (None, None)
+    assert cache.stats()['evictions'] == 1
+
+    # The evicted object is downloaded again, and served from disk after that
+    assert cache.get_object(s3, 'bucket', 'old')[0] == b'x' * 60
+    assert cache.get_object(s3, 'bucket', 'old')[0] == b'x' * 60
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'evictions': 2}
+
+
+def test_refs_are_kept_while_their_lock_is_held(tmp_path):
+    s3 = FakeS3({('bucket', 'key'): b'x' * 10})
+    cache = S3DiskCache(str(tmp_path), max_bytes=100)
+    cache.get_object(s3, 'bucket', 'key')
+    blob_path = cache.read_ref('bucket', 'key')[1]
+
+    with cache.key_lock('bucket', 'key'):
+        os.remove(blob_path)
+        cache.evict()
+        assert len(listing(cache)['refs']) == 1
+
+    cache.evict()
+    assert listing(cache) == {'objects': [], 'refs': [], 'locks': []}
+
+    # A lock file that was removed is created again by the next download
+    assert cache.get_object(s3, 'bucket', 'key')[0] == b'x' * 10
+    assert len(listing(cache)['locks']) == 1
+
+
+def test_locks_without_a_ref_are_removed(tmp_path):
+    # Left behind by a download that failed, such as a missing key
+    s3 = FakeS3({})
+    cache = S3DiskCache(str(tmp_path), max_bytes=100)
+
+    with pytest.raises(KeyError):
+        cache.get_object(s3, 'bucket', 'missing')
+    assert len(listing(cache)['locks']) == 1
+
+    cache.evict()
+    assert listing(cache)['locks'] == []
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.tree import DecisionTreeRegressor
+
+import generate_ml_datasets
+from data_format import CSV_EXTENSION, read_data_frame
+from feature_index import FEATURE_COLUMNS, FeatureIndex
+from schema import FEATURE_DTYPE, processed_schema
+from synthetic_data import write_raw_data
+
+MOVIES = 3000
+PROCESSED_FILES = ['input_data', 'unique_leads', 'unique_directors', 'unique_genres']
+ML_FEATURES = ['budget', *FEATURE_COLUMNS]
+
+
+def generate(raw_paths, processed_dir, extension):
+    # Processed files written the way generate_ml_datasets.py writes them
+    credits_path, movies_path = raw_paths
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('GENERATE_WORKERS', '1')
+        monkeypatch.setattr(generate_ml_datasets, 'CREDITS_FILE', credits_path)
+        monkeypatch.setattr(generate_ml_datasets, 'MOVIES_METADATA_FILE', movies_path)
+        monkeypatch.setattr(generate_ml_datasets, 'PROCESSED_DIR', str(processed_dir))
+        for name in PROCESSED_FILES:
+            monkeypatch.setattr(generate_ml_datasets, f'{name.upper()}_FILE', name + extension)
+        generate_ml_datasets.main()
+
+    files = {}
+    for name in PROCESSED_FILES:
+        with open(processed_dir / (name + extension), 'rb') as file:
+            files[name] = (name + extension, file.read())
+    return files
+
+
+@pytest.fixture(scope='module')
+def processed_files(tmp_path_factory):
+    # A small synthetic store as CSV, which keeps no dtypes, so loading it
+    # without the schema gives the frames used before the schema existed
+    raw_paths = write_raw_data(str(tmp_path_factory.mktemp('raw')), MOVIES)
+    return generate(raw_paths, tmp_path_factory.mktemp('processed'), CSV_EXTENSION)
+
+
+def load(processed_files, name, typed):
+    key, content = processed_files[name]
+    return read_data_frame(content, key, processed_schema(key) if typed else None)
+
+
+@pytest.mark.parametrize('name', PROCESSED_FILES)
+def test_schema_reduces_memory(processed_files, name):
+    untyped = load(processed_files, name, typed=False)
+    typed = load(processed_files, name, typed=True)
+
+    untyped_bytes = untyped.memory_usage(deep=True).sum()
+    typed_bytes = typed.memory_usage(deep=True).sum()
+    print(f"{name}: {untyped_bytes} bytes without the schema, {typed_bytes} with it")
+
+    assert typed_bytes < untyped_bytes
+    assert list(typed.dtypes) == [processed_schema(name)[column] for column in typed.columns]
+
+    # Only the average features change, rounded to float32
+    expected = untyped.astype({column: FEATURE_DTYPE for column in untyped.columns
+                               if processed_schema(name)[column] == FEATURE_DTYPE})
+    assert typed.astype(expected.dtypes.to_dict()).equals(expected)
+
+
+def feature_rows(feature_index, keys):
+    # Model input rows built the way /predict builds them
+    rows = []
+    for lead, director, genre, budget in keys:
+        features = feature_index.lookup(lead, director, genre)
+        rows.append([budget, *(features[column] for column in FEATURE_COLUMNS)])
+    return pd.DataFrame(rows, columns=ML_FEATURES, dtype=float)
+
+
+def lookup_keys(data_frame):
+    # Known combinations, and the same with ids the data has never seen
+    known = data_frame[['lead', 'director', 'genre', 'budget']].head(200)
+    keys = [(int(lead), int(director), int(genre), float(budget))
+            for lead, director, genre, budget in known.itertuples(index=False)]
+    unseen = int(data_frame[['lead', 'director']].max().max()) + 1
+    unseen_keys = [(unseen, director, genre, budget) for _, director, genre, budget in keys[:5]]
+    unseen_keys += [(lead, unseen, genre, budget) for lead, _, genre, budget in keys[:5]]
+    return keys, unseen_keys
+
+
+def test_schema_leaves_lookups_and_predictions_unchanged(processed_files):
+    untyped = load(processed_files, 'input_data', typed=False)
+    typed = load(processed_files, 'input_data', typed=True)
+    keys, unseen_keys = lookup_keys(untyped)
+    untyped_index = FeatureIndex.from_data_frame(untyped)
+    typed_index = FeatureIndex.from_data_frame(typed)
+
+    untyped_rows = feature_rows(untyped_index, keys)
+    typed_rows = feature_rows(typed_index, keys)
+    pd.testing.assert_frame_equal(typed_rows, untyped_rows)
+
+    # Unknown ids give the same missing features
+    pd.testing.assert_frame_equal(feature_rows(typed_index, unseen_keys),
+                                  feature_rows(untyped_index, unseen_keys))
+
+    untyped_model = DecisionTreeRegressor(random_state=0).fit(
+        untyped[ML_FEATURES], untyped['profit_ratio'])
+    typed_model = DecisionTreeRegressor(random_state=0).fit(
+        typed[ML_FEATURES], typed['profit_ratio'])
+
+    np.testing.assert_array_equal(typed_model.predict(typed_rows),
+                                  untyped_model.predict(untyped_rows))
+    np.testing.assert_array_equal(typed_model.predict(typed[ML_FEATURES]),
+                                  untyped_model.predict(untyped[ML_FEATURES]))
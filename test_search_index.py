@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from search_index import SearchIndex
+
+NAMES = ['Amy Adams', 'Amy Poehler', 'amy\U0010ffffx', 'Am', 'Amz', 'Bob', 'Zed Amy', None]
+
+
+def type_df():
+    return pd.DataFrame({'id': range(1, len(NAMES) + 1), 'lead': NAMES})
+
+
+def names(records):
+    return [record['lead'] for record in records]
+
+
+@pytest.mark.parametrize('term', ['am', 'AMY', 'amy ', 'amy\U0010ffff', '\U0010ffff', 'zz'])
+def test_prefix_search_matches_a_scan(term):
+    expected = sorted((name.lower(), name) for name in NAMES
+                      if isinstance(name, str) and name.lower().startswith(term.lower()))
+
+    assert names(SearchIndex(type_df(), 'lead').prefix_search(term, 100)) == \
+        [name for _, name in expected]
+
+
+def test_substring_search_needs_its_index():
+    with pytest.raises(Exception, match='Substring index not built'):
+        SearchIndex(type_df(), 'lead').substring_search('amy', 10)
+
+
+@pytest.mark.parametrize('term', ['my', 'amy', 'AMY', 'y p', 'zz'])
+def test_substring_search_matches_a_scan(term):
+    # Short terms too, which have no n-gram to look up
+    expected = sorted((name.lower(), name) for name in NAMES
+                      if isinstance(name, str) and term.lower() in name.lower())
+
+    assert names(SearchIndex(type_df(), 'lead', substring=True).substring_search(term, 100)) == \
+        [name for _, name in expected]
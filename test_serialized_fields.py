@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from serialized_fields import director_name, genre_name, lead_name
+from synthetic_data import credits_chunk, movies_chunk, samplers_for
+
+
+# The eval-based extraction the regex extractors replaced, kept as the oracle
+def old_lead_name(cast):
+    cast = eval(cast)
+    return cast[0]['name'] if cast else None
+
+
+def old_director_name(crew):
+    crew = eval(crew)
+    return next((member['name'] for member in crew if member['job'] == 'Director'), None)
+
+
+def old_genre_name(genres):
+    genres = eval(genres)
+    return genres[0]['name'] if genres else None
+
+
+def cast_member(name, character='Himself', order=0):
+    return {'cast_id': 14, 'character': character, 'credit_id': '52fe4284c3a36847f8024f49',
+            'gender': 2, 'id': 31, 'name': name, 'order': order, 'profile_path': None}
+
+
+def crew_member(name, job, department='Directing'):
+    return {'credit_id': '52fe4284c3a36847f8024f49', 'department': department,
+            'gender': 0, 'id': 7879, 'job': job, 'name': name, 'profile_path': '/p.jpg'}
+
+
+# Serialized with repr, as the dataset's columns were
+CAST_SAMPLES = [
+    [],
+    [cast_member('Tom Hanks')],
+    [cast_member("Dylan O'Brien"), cast_member('Tom Hanks', order=1)],
+    [cast_member('Dwayne "The Rock" Johnson')],
+    [cast_member('Say "O\'Neil"')],
+    [cast_member('Back\\slash')],
+    [cast_member('Penélope Cruz'), cast_member('渡辺謙', order=1)],
+    [cast_member('Jane Doe', character="'name': 'Not Her'"), cast_member('John Roe')],
+    [cast_member('Lead', character='Tony {Stark}, [Iron Man]')],
+    [cast_member(None), cast_member('Second')],
+    [cast_member('')],
+]
+
+CREW_SAMPLES = [
+    [],
+    [crew_member('Greta Gerwig', 'Director')],
+    [crew_member('Kathleen Kennedy', 'Producer', 'Production'),
+     crew_member('Steven Spielberg', 'Director')],
+    [crew_member('Roger Deakins', 'Director of Photography', 'Camera'),
+     crew_member('Denis Villeneuve', 'Director')],
+    [crew_member('Only Producer', 'Producer', 'Production'),
+     crew_member('Writer', 'Screenplay', 'Writing')],
+    [crew_member("Peter O'Toole", 'Director'), crew_member('Second', 'Director')],
+    [crew_member('Say "O\'Neil"', 'Director')],
+    [crew_member('Fake', "'job': 'Director'"), crew_member('Real', 'Director')],
+    [crew_member("'job': 'Director'", 'Producer'), crew_member('Real', 'Director')],
+    [crew_member(None, 'Director'), crew_member('Second', 'Director')],
+    [crew_member('Anon', 'Director', department='Directing {co}')],
+]
+
+GENRE_SAMPLES = [
+    [],
+    [{'id': 18, 'name': 'Drama'}],
+    [{'id': 878, 'name': 'Science Fiction'}, {'id': 28, 'name': 'Action'}],
+    [{'id': 1, 'name': "Children's"}],
+    [{'id': 2, 'name': 'Sci-Fi "Hard"'}],
+    [{'name': 'Name First', 'id': 3}],
+]
+
+
+@pytest.mark.parametrize('cast', [repr(sample) for sample in CAST_SAMPLES])
+def test_lead_name_matches_eval(cast):
+    assert lead_name(cast) == old_lead_name(cast)
+
+
+@pytest.mark.parametrize('crew', [repr(sample) for sample in CREW_SAMPLES])
+def test_director_name_matches_eval(crew):
+    assert director_name(crew) == old_director_name(crew)
+
+
+@pytest.mark.parametrize('genres', [repr(sample) for sample in GENRE_SAMPLES])
+def test_genre_name_matches_eval(genres):
+    assert genre_name(genres) == old_genre_name(genres)
+
+
+def test_generated_data_matches_eval():
+    # Rows in the format synthetic_data.py writes, with empty casts and
+    # crews without a director among them
+    rng = np.random.default_rng(0)
+    ids = np.arange(1, 2001)
+    credits = credits_chunk(rng, ids, samplers_for(len(ids)))
+    movies = movies_chunk(rng, ids)
+
+    assert credits['cast'].map(lead_name).tolist() == credits['cast'].map(old_lead_name).tolist()
+    assert credits['crew'].map(director_name).tolist() == \
+        credits['crew'].map(old_director_name).tolist()
+    assert movies['genres'].map(genre_name).tolist() == \
+        movies['genres'].map(old_genre_name).tolist()
+
+    assert (credits['cast'] == '[]').any()
+    assert credits['crew'].map(old_director_name).isna().any()
+
+
+def test_values_are_never_evaluated():
+    # A call eval would have run is refused by ast.literal_eval instead
+    with pytest.raises(ValueError):
+        lead_name("[{'name': __import__('os').getcwd(), 'order': 0}]")
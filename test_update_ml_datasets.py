@@ -0,0 +1,277 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_index import FEATURE_COLUMNS
+from schema import INPUT_DATA_SCHEMA, TYPE_SCHEMAS, UPLOAD_SCHEMA, apply_schema
+from update_ml_datasets import ETLProcessor
+
+TYPE_COLUMNS = ['director', 'genre', 'lead']
+
+
+def old_merge_in_type_definitions(uploads, type_data_frames):
+    # The iterrows loop merge_in_type_definitions replaced, kept as the oracle
+    for column in TYPE_COLUMNS:
+        type_df = type_data_frames[column]
+        type_df_mod = type_df.copy()
+
+        for index, row in uploads.iterrows():
+            value = row[column]
+            existing_record = type_df[type_df[column] == value]
+
+            if existing_record.empty:
+                new_id = type_df_mod['id'].max() + 1 if not type_df_mod.empty else 1
+                new_record = pd.DataFrame({'id': [new_id], column: [value]})
+                type_df_mod = type_df_mod._append(new_record, ignore_index=True)
+
+        merged_df = pd.merge(uploads, type_df_mod, how='left')
+        merged_df[column] = merged_df['id']
+        merged_df = merged_df.drop('id', axis=1)
+        uploads = merged_df.copy()
+        type_data_frames[column] = type_df_mod
+
+    return uploads, type_data_frames
+
+
+def type_tables(names):
+    return {
+        column: pd.DataFrame({'id': range(1, len(names[column]) + 1),
+                              column: names[column]})
+        for column in TYPE_COLUMNS
+    }
+
+
+def uploads_frame(rows):
+    return pd.DataFrame(rows, columns=['title', 'lead', 'director', 'genre',
+                                       'revenue', 'budget'])
+
+
+@pytest.fixture
+def processor(monkeypatch, tmp_path):
+    monkeypatch.setenv('STORAGE_BACKEND', 'local')
+    monkeypatch.setenv('LOCAL_STORAGE_DIR', str(tmp_path))
+    return ETLProcessor()
+
+
+def new_merge_in_type_definitions(processor, uploads, type_data_frames):
+    # Typed as download_uploads and the processed tables are read
+    processor.uploads_data_frames = apply_schema(uploads.copy(), UPLOAD_SCHEMA)
+    processor.unique_directors_data_frame = apply_schema(
+        type_data_frames['director'].copy(), TYPE_SCHEMAS['director'])
+    processor.unique_genres_data_frame = apply_schema(
+        type_data_frames['genre'].copy(), TYPE_SCHEMAS['genre'])
+    processor.unique_leads_data_frame = apply_schema(
+        type_data_frames['lead'].copy(), TYPE_SCHEMAS['lead'])
+
+    processor.merge_in_type_definitions()
+
+    return processor.uploads_data_frames, {
+        'director': processor.unique_directors_data_frame,
+        'genre': processor.unique_genres_data_frame,
+        'lead': processor.unique_leads_data_frame,
+    }
+
+
+def ids(series):
+    return series.astype('float64').tolist()
+
+
+def type_rows(type_df, column):
+    return list(zip(type_df['id'].astype('int64'), type_df[column].astype(object)))
+
+
+def test_matches_old_loop_for_unseen_and_known_names(processor):
+    type_data_frames = type_tables({
+        'director': ['Nolan', 'Bigelow'],
+        'genre': ['Drama', 'Action', 'Comedy'],
+        'lead': ['Blunt'],
+    })
+    uploads = uploads_frame([
+        ['A', 'Blunt', 'Nolan', 'Drama', 100.0, 50.0],
+        ['B', 'Pugh', 'Gerwig', 'Comedy', 90.0, 30.0],
+        ['C', 'Blunt', 'Bigelow', 'Horror', 80.0, 20.0],
+        ['D', 'Kaluuya', 'Peele', 'Action', 70.0, 10.0],
+    ])
+
+    old_uploads, old_types = old_merge_in_type_definitions(
+        uploads.copy(), {column: df.copy() for column, df in type_data_frames.items()})
+    new_uploads, new_types = new_merge_in_type_definitions(
+        processor, uploads, type_data_frames)
+
+    for column in TYPE_COLUMNS:
+        assert ids(new_uploads[column]) == ids(old_uploads[column])
+        assert type_rows(new_types[column], column) == type_rows(old_types[column], column)
+    assert new_uploads['title'].astype(object).tolist() == ['A', 'B', 'C', 'D']
+
+
+def test_new_names_get_ids_after_the_current_maximum(processor):
+    type_data_frames = type_tables({
+        'director': ['Nolan'],
+        'genre': [],
+        'lead': ['Blunt', 'Pugh'],
+    })
+    uploads = uploads_frame([
+        ['A', 'Kaluuya', 'Peele', 'Horror', 100.0, 50.0],
+        ['B', 'Blunt', 'Nolan', 'Drama', 90.0, 30.0],
+    ])
+
+    new_uploads, new_types = new_merge_in_type_definitions(
+        processor, uploads, type_data_frames)
+
+    assert ids(new_uploads['lead']) == [3, 1]
+    assert ids(new_uploads['director']) == [2, 1]
+    # An empty type table starts at 1
+    assert ids(new_uploads['genre']) == [1, 2]
+    assert type_rows(new_types['lead'], 'lead') == [(1, 'Blunt'), (2, 'Pugh'), (3, 'Kaluuya')]
+
+
+def test_repeated_new_name_gets_one_id(processor):
+    # Behaviour change: the old loop gave each occurrence of a new name its
+    # own id, and the merge then duplicated every upload row with that name
+    type_data_frames = type_tables({
+        'director': ['Nolan'],
+        'genre': ['Drama'],
+        'lead': ['Blunt'],
+    })
+    uploads = uploads_frame([
+        ['A', 'Pugh', 'Nolan', 'Drama', 100.0, 50.0],
+        ['B', 'Pugh', 'Nolan', 'Drama', 90.0, 30.0],
+    ])
+
+    old_uploads, old_types = old_merge_in_type_definitions(
+        uploads.copy(), {column: df.copy() for column, df in type_data_frames.items()})
+    new_uploads, new_types = new_merge_in_type_definitions(
+        processor, uploads, type_data_frames)
+
+    assert type_rows(old_types['lead'], 'lead') == [(1, 'Blunt'), (2, 'Pugh'), (3, 'Pugh')]
+    assert len(old_uploads) == 4
+
+    assert type_rows(new_types['lead'], 'lead') == [(1, 'Blunt'), (2, 'Pugh')]
+    assert ids(new_uploads['lead']) == [2, 2]
+    assert new_uploads['title'].astype(object).tolist() == ['A', 'B']
+
+
+def test_missing_names_are_left_without_an_id(processor):
+    # Behaviour change: the old loop added the missing name to the type table
+    # under a new id; it is now left missing and never enters the table
+    type_data_frames = type_tables({
+        'director': ['Nolan'],
+        'genre': ['Drama'],
+        'lead': ['Blunt'],
+    })
+    uploads = uploads_frame([
+        ['A', np.nan, 'Nolan', 'Drama', 100.0, 50.0],
+        ['B', 'Blunt', 'Nolan', 'Drama', 90.0, 30.0],
+    ])
+
+    old_uploads, old_types = old_merge_in_type_definitions(
+        uploads.copy(), {column: df.copy() for column, df in type_data_frames.items()})
+    new_uploads, new_types = new_merge_in_type_definitions(
+        processor, uploads, type_data_frames)
+
+    assert old_types['lead']['id'].tolist() == [1, 2]
+    assert old_types['lead']['lead'].isna().tolist() == [False, True]
+    assert ids(old_uploads['lead']) == [2, 1]
+
+    assert type_rows(new_types['lead'], 'lead') == [(1, 'Blunt')]
+    assert new_uploads['lead'].isna().tolist() == [True, False]
+    assert ids(new_uploads['lead'])[1] == 1
+
+
+def test_rejected_uploads_are_cleared_when_none_are_accepted(processor):
+    bucket = processor.UPLOADS_BUCKET
+    processor.storage.put_object(bucket, 'no_rows.csv', b'title,lead,director,genre,revenue,budget\n')
+    processor.storage.put_object(bucket, 'wrong_columns.csv', b'title,score\nA,1\n')
+    # An upload still being staged, without its manifest, is left alone
+    processor.storage.put_object(bucket, 'staging.csv/part-00000.parquet', b'')
+    processor.download_processed_data = lambda: None
+
+    processor.run_etl_process()
+
+    assert [key for key, reason in processor.rejected_uploads] == ['no_rows.csv', 'wrong_columns.csv']
+    assert processor.storage.list_keys(bucket) == ['staging.csv/part-00000.parquet']
+
+
+def full_recompute(data):
+    # The groupby transforms generate_ml_datasets runs over the full history
+    return pd.DataFrame({
+        'director_average_profit_ratio': data.groupby('director')['profit_ratio'].transform('mean'),
+        'lead_average_profit_ratio': data.groupby('lead')['profit_ratio'].transform('mean'),
+        'lead_worked_in_genre_count': data.groupby(['lead', 'genre'])['title'].transform('count'),
+        'director_worked_in_genre_count': data.groupby(['director', 'genre'])['title'].transform('count'),
+        'director_worked_with_lead_count': data.groupby(['director', 'lead'])['title'].transform('count'),
+    })[FEATURE_COLUMNS]
+
+
+def meta_frame(rows=300, seed=0):
+    rng = np.random.default_rng(seed)
+    meta = pd.DataFrame({
+        'title': [f"Movie {i}" for i in range(rows)],
+        'lead': rng.integers(1, 30, rows),
+        'director': rng.integers(1, 20, rows),
+        'genre': rng.integers(1, 6, rows),
+        'revenue': rng.uniform(1e5, 1e8, rows).round(),
+        'budget': rng.uniform(1e5, 5e7, rows).round(),
+    })
+    meta['profit_ratio'] = meta['revenue'] / meta['budget']
+    meta = pd.concat([meta, full_recompute(meta)], axis=1)
+    return apply_schema(meta, INPUT_DATA_SCHEMA)
+
+
+def upload_batch(meta, rows, seed):
+    # Ids as merge_in_type_definitions leaves them: known leads and
+    # directors, so existing rows are refreshed, and some never seen before
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'title': [f"Upload {seed} {i}" for i in range(rows)],
+        'lead': rng.choice([*meta['lead'].unique()[:5], 100 + seed], rows).astype('float64'),
+        'director': rng.choice([*meta['director'].unique()[:3], 200 + seed], rows).astype('float64'),
+        'genre': rng.integers(1, 7, rows).astype('float64'),
+        'revenue': rng.uniform(2e5, 9e7, rows).round(),
+        'budget': rng.uniform(2e5, 4e7, rows).round(),
+    })
+
+
+def run_feature_stages(processor, meta, uploads):
+    processor.meta_data_frame = meta
+    processor.uploads_data_frames = uploads
+    processor.load_aggregate_state()
+    processor.create_artificial_features()
+    processor.concat_uploads()
+    return processor.meta_data_frame
+
+
+def assert_features_match_full_recompute(data):
+    expected = full_recompute(data)
+    for column in ['director_average_profit_ratio', 'lead_average_profit_ratio']:
+        np.testing.assert_allclose(data[column], expected[column], rtol=1e-6)
+    for column in ['lead_worked_in_genre_count', 'director_worked_in_genre_count',
+                   'director_worked_with_lead_count']:
+        np.testing.assert_array_equal(data[column], expected[column])
+
+
+def test_incremental_features_match_a_full_recompute(processor):
+    meta = meta_frame()
+    original = meta.copy()
+
+    # First run rebuilds the aggregates from the history, as none are saved
+    first = run_feature_stages(processor, meta, upload_batch(meta, 40, seed=1))
+
+    assert len(first) == len(original) + 40
+    assert_features_match_full_recompute(first)
+    changed = (first.loc[:len(original) - 1, FEATURE_COLUMNS] !=
+               original[FEATURE_COLUMNS]).any(axis=1)
+    assert 0 < changed.sum() < len(original)
+    assert first.dtypes.to_dict() == original.dtypes.to_dict()
+
+    # Second run starts from the aggregates the first one saved, the type
+    # tables only need to be present for the save
+    processor.unique_leads_data_frame = pd.DataFrame({'id': [1], 'lead': ['A']})
+    processor.unique_directors_data_frame = pd.DataFrame({'id': [1], 'director': ['A']})
+    processor.unique_genres_data_frame = pd.DataFrame({'id': [1], 'genre': ['A']})
+    processor.upload_processed_data_to_s3()
+    second_processor = ETLProcessor()
+    second = run_feature_stages(second_processor, first.copy(), upload_batch(first, 25, seed=2))
+
+    assert second_processor.aggregate_state.row_count() == len(second) == len(first) + 25
+    assert_features_match_full_recompute(second)
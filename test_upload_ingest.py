@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+from storage import LocalStorage
+from upload_ingest import UploadIngester, UploadRejected
+
+HEADER = 'title,lead,director,genre,revenue,budget\n'
+SETTINGS = {'max_bytes': 10 ** 6, 'max_rows': 100, 'shard_rows': 2}
+
+
+class FailingStorage(LocalStorage):
+    # Fails the put after a number of successful ones, as S3 could
+    def __init__(self, directory, puts_before_failure):
+        super().__init__(directory)
+        self.puts_before_failure = puts_before_failure
+
+    def put_object(self, bucket, key, content):
+        if self.puts_before_failure == 0:
+            raise OSError('storage unavailable')
+        self.puts_before_failure -= 1
+        super().put_object(bucket, key, content)
+
+
+def ingest(storage, body, filename='movies.csv'):
+    return UploadIngester(storage, 'uploads', SETTINGS).ingest(
+        io.BytesIO(body), filename)
+
+
+# Two shards of good rows ahead of the bad one
+GOOD_ROWS = HEADER + 'A,x,y,Drama,100,5\n' * 4
+
+
+@pytest.mark.parametrize('body, message', [
+    ((GOOD_ROWS + 'B,x,y\n').encode(), 'Row 6 has 3 fields, expected 6'),
+    ((GOOD_ROWS + 'B,x,y,Drama,100,5,9\n').encode(), 'Row 6 has 7 fields, expected 6'),
+    (GOOD_ROWS.encode() + b'\xff,x,y,Drama,1,2\n', 'Unreadable CSV'),
+    ((GOOD_ROWS + 'B,x,y,Drama,abc,5\n').encode(), 'Row 6: revenue is not a number'),
+    (b'\xfftitle,lead\n', 'Unreadable CSV'),
+])
+def test_bad_files_are_rejected_without_leaving_shards(tmp_path, body, message):
+    storage = LocalStorage(tmp_path)
+
+    with pytest.raises(UploadRejected, match=f"^Error: {message}"):
+        ingest(storage, body)
+
+    assert storage.list_keys('uploads') == []
+
+
+def test_storage_errors_are_not_reported_as_bad_files(tmp_path):
+    storage = FailingStorage(tmp_path, puts_before_failure=1)
+
+    with pytest.raises(OSError, match='storage unavailable'):
+        ingest(storage, (HEADER + 'A,x,y,Drama,100,5\n' * 5).encode())
+
+    # The shard written before the failure is rolled back
+    assert storage.list_keys('uploads') == []
+
+
+def test_same_file_name_in_the_same_second_gets_its_own_keys(tmp_path):
+    storage = LocalStorage(tmp_path)
+    first = ingest(storage, (HEADER + 'A,x,y,Drama,100,5\n').encode())
+    second = ingest(storage, (HEADER + 'B,x,y,Drama,200,5\n').encode())
+
+    assert first['prefix'] != second['prefix']
+    assert first['prefix'].endswith('_movies.csv')
+    assert len(storage.list_keys('uploads')) == 4
+
+    # Rolling back one upload leaves the other intact
+    UploadIngester(storage, 'uploads', SETTINGS).delete_shards(first['shards'])
+    assert [shard['key'] for shard in second['shards']] == [
+        key for key in storage.list_keys('uploads') if key.startswith(second['prefix'])
+        and not key.endswith('manifest.json')]
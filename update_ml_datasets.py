@@ -1,8 +1,15 @@
+import json
 import pandas as pd
 from functools import reduce
-import boto3
-from env import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
-from io import StringIO
+from io import BytesIO
+from data_format import (csv_key, processed_data_extension, read_data_frame,
+                         write_data_frame)
+from feature_index import AGGREGATE_TABLES, FEATURE_COLUMNS, FeatureIndex
+from job_profiler import JobProfiler, count_rows
+from schema import (ID_DTYPE, INPUT_DATA_SCHEMA, TYPE_SCHEMAS, UPLOAD_SCHEMA,
+                    apply_schema, processed_schema)
+from storage import ObjectNotFound, bucket_names, create_storage
+from upload_ingest import UPLOAD_COLUMNS, is_manifest_key
 
 
 class ETLProcessor:
@@ -11,20 +18,25 @@ class ETLProcessor:
         self.initialise_constants()
 
     def load_env(self):
-        # Load AWS credentials from environment
-        self.aws_access_key_id = AWS_ACCESS_KEY_ID
-        self.aws_secret_access_key = AWS_SECRET_ACCESS_KEY
-        self.s3 = boto3.client('s3', aws_access_key_id=self.aws_access_key_id,
-                               aws_secret_access_key=self.aws_secret_access_key)
+        # S3 or a local directory, chosen by STORAGE_BACKEND
+        self.storage = create_storage()
 
     def initialise_constants(self):
         # Define constants for S3 buckets and file names
-        self.PROCESSED_BUCKET = 'etl-project-data-processed'
-        self.UPLOADS_BUCKET = 'etl-project-uploads'
-        self.INPUT_DATA_FILE = 'input_data.csv'
-        self.UNIQUE_DIRECTORS_FILE = 'unique_directors.csv'
-        self.UNIQUE_GENRES_FILE = 'unique_genres.csv'
-        self.UNIQUE_LEADS_FILE = 'unique_leads.csv'
+        buckets = bucket_names()
+        self.PROCESSED_BUCKET = buckets['processed']
+        self.UPLOADS_BUCKET = buckets['uploads']
+        self.DATA_FILE_EXTENSION = processed_data_extension()
+        self.INPUT_DATA_FILE = 'input_data' + self.DATA_FILE_EXTENSION
+        self.UNIQUE_DIRECTORS_FILE = 'unique_directors' + self.DATA_FILE_EXTENSION
+        self.UNIQUE_GENRES_FILE = 'unique_genres' + self.DATA_FILE_EXTENSION
+        self.UNIQUE_LEADS_FILE = 'unique_leads' + self.DATA_FILE_EXTENSION
+
+        # Running feature aggregates saved as aggregate_state_<table>
+        self.AGGREGATE_STATE_FILE_PREFIX = 'aggregate_state_'
+
+        # Columns every uploaded file must contain, and nothing else
+        self.UPLOAD_COLUMNS = UPLOAD_COLUMNS
 
         # Variables to keep .csv data in state
         self.meta_data_frame = None
@@ -32,12 +44,28 @@ class ETLProcessor:
         self.unique_directors_data_frame = None
         self.unique_genres_data_frame = None
         self.uploads_data_frames = None
+        self.upload_keys = []
+        self.rejected_uploads = []
+        self.aggregate_state = None
 
     def download_csv_from_s3(self, bucket, key):
-        # Download and read CSV content from S3
-        file_content = self.s3.get_object(Bucket=bucket, Key=key)[
-            'Body'].read().decode('utf-8')
-        return pd.read_csv(StringIO(file_content))
+        # Download and read CSV content from S3 without decoding it first
+        file_content = self.storage.get_object_bytes(bucket, key)
+        return pd.read_csv(BytesIO(file_content))
+
+    def download_data_frame_from_s3(self, bucket, key):
+        # Download processed data, falling back to the CSV copy if missing
+        try:
+            file_content = self.storage.get_object_bytes(bucket, key)
+        except ObjectNotFound:
+            if key == csv_key(key):
+                raise
+            print(f"Info: {key} not found, reading {csv_key(key)}")
+            key = csv_key(key)
+            file_content = self.storage.get_object_bytes(bucket, key)
+
+        # Parse straight from bytes in the format given by the extension
+        return read_data_frame(file_content, key, processed_schema(key))
 
     def download_processed_data(self):
         file_keys = [
@@ -47,11 +75,13 @@ class ETLProcessor:
             self.UNIQUE_LEADS_FILE,
         ]
 
-        # Download and read CSV files into DataFrames
-        for file_key in file_keys:
-            data_frame = self.download_csv_from_s3(
-                self.PROCESSED_BUCKET, file_key)
+        # Download and read the files into DataFrames in parallel
+        data_frames = self.storage.map(
+            lambda file_key: self.download_data_frame_from_s3(
+                self.PROCESSED_BUCKET, file_key),
+            file_keys)
 
+        for file_key, data_frame in zip(file_keys, data_frames):
             # Assign DataFrames to state fields based on key
             if "input_data" in file_key:
                 self.meta_data_frame = data_frame
@@ -64,19 +94,106 @@ class ETLProcessor:
 
             print(f"Dataframe created from s3: {file_key}")
 
+    def aggregate_state_key(self, table):
+        return f"{self.AGGREGATE_STATE_FILE_PREFIX}{table}{self.DATA_FILE_EXTENSION}"
+
+    def load_aggregate_state(self):
+        try:
+            data_frames = self.storage.map(
+                lambda table: self.download_data_frame_from_s3(
+                    self.PROCESSED_BUCKET, self.aggregate_state_key(table)),
+                AGGREGATE_TABLES)
+            frames = dict(zip(AGGREGATE_TABLES, data_frames))
+            self.aggregate_state = FeatureIndex.from_data_frames(frames)
+            print("Aggregate state loaded from s3")
+        except Exception as e:
+            print(f"Info: Aggregate state unavailable: {e}")
+            self.aggregate_state = None
+
+        # Rebuild from the full history if missing or out of step with it
+        if self.aggregate_state is None or \
+                self.aggregate_state.row_count() != len(self.meta_data_frame):
+            self.aggregate_state = FeatureIndex.from_data_frame(
+                self.meta_data_frame, scalar_lookups=False)
+            print(f"Aggregate state rebuilt from: {self.INPUT_DATA_FILE}")
+
+    def validate_upload(self, data_frame):
+        # Return the reason a file does not match the upload schema, if any
+        if data_frame.empty:
+            return 'file has no rows'
+
+        missing_columns = [
+            column for column in self.UPLOAD_COLUMNS if column not in data_frame.columns]
+        unexpected_columns = [
+            column for column in data_frame.columns if column not in self.UPLOAD_COLUMNS]
+
+        reasons = []
+        if missing_columns:
+            reasons.append(f"missing columns: {', '.join(missing_columns)}")
+        if unexpected_columns:
+            reasons.append(
+                f"unexpected columns: {', '.join(map(str, unexpected_columns))}")
+        return '; '.join(reasons) or None
+
+    def read_staged_upload(self, manifest_key):
+        # Shards were parsed, validated and typed by /upload, so just read them
+        try:
+            manifest = json.loads(self.storage.get_object_bytes(
+                self.UPLOADS_BUCKET, manifest_key))
+            data_frame = pd.concat([
+                read_data_frame(self.storage.get_object_bytes(
+                    self.UPLOADS_BUCKET, shard['key']), shard['key'], UPLOAD_SCHEMA)
+                for shard in manifest['shards']], ignore_index=True)
+            reason = None
+            if len(data_frame) != manifest['rows']:
+                reason = 'shards do not match the manifest'
+        except Exception as e:
+            data_frame, reason = None, f"unreadable shards: {e}"
+
+        return data_frame, reason
+
+    def read_upload(self, file_key):
+        # Staged uploads are read through their manifest
+        if is_manifest_key(file_key):
+            return self.read_staged_upload(file_key)
+
+        # Raw CSV files, uploaded before staging, are parsed and validated here
+        try:
+            data_frame = self.download_csv_from_s3(
+                self.UPLOADS_BUCKET, file_key)
+            reason = self.validate_upload(data_frame)
+        except Exception as e:
+            data_frame, reason = None, f"unreadable CSV: {e}"
+
+        return data_frame, reason
+
     def download_uploads(self):
-        objects = self.s3.list_objects(Bucket=self.UPLOADS_BUCKET)
-        file_keys = [obj['Key'] for obj in objects.get('Contents', [])]
+        # List every upload, paging past the 1000 key limit
+        all_keys = self.storage.list_keys(self.UPLOADS_BUCKET)
+
+        # A staged upload is a folder of shards and a manifest, written last.
+        # Folders without a manifest are still being uploaded, so are left alone.
+        manifest_keys = [key for key in all_keys if is_manifest_key(key)]
+        prefixes = tuple(key.rsplit('/', 1)[0] + '/' for key in manifest_keys)
+        file_keys = [key for key in all_keys if is_manifest_key(key) or '/' not in key]
+        self.upload_keys = [key for key in all_keys
+                            if '/' not in key or key.startswith(prefixes)]
+
+        # Download and read the uploads into DataFrames in parallel
+        results = self.storage.map(self.read_upload, file_keys)
 
-        # Download and read CSV files into DataFrames
         uploads_data_frames = []
+        self.rejected_uploads = []
 
-        for file_key in file_keys:
-            data_frame = self.download_csv_from_s3(
-                self.UPLOADS_BUCKET, file_key)
+        for file_key, (data_frame, reason) in zip(file_keys, results):
+            # Reject the whole file before it can be concatenated
+            if reason:
+                self.rejected_uploads.append((file_key, reason))
+                print(f"Upload rejected: {file_key} ({reason})")
+                continue
 
-            # Append the DataFrame to the list
-            uploads_data_frames.append(data_frame)
+            # Append the DataFrame to the list with columns in schema order
+            uploads_data_frames.append(data_frame[self.UPLOAD_COLUMNS])
 
             print(f"Dataframe created from s3: {file_key}")
 
@@ -88,11 +205,11 @@ class ETLProcessor:
             uploads_data_frames, ignore_index=True)
 
     def upload_dataframe_to_s3(self, data_frame, bucket, key):
-        # Convert DataFrame to CSV content
-        csv_content = data_frame.to_csv(index=False)
+        # Convert DataFrame to content in the format given by the extension
+        file_content = write_data_frame(data_frame, key, processed_schema(key))
 
-        # Upload CSV content to S3
-        self.s3.put_object(Body=csv_content, Bucket=bucket, Key=key)
+        # Upload the content to storage
+        self.storage.put_object(bucket, key, file_content)
         print(f"DataFrame uploaded to S3: {key}")
 
     def upload_processed_data_to_s3(self):
@@ -103,31 +220,30 @@ class ETLProcessor:
             self.UNIQUE_GENRES_FILE: self.unique_genres_data_frame,
         }
 
-        for file_key, data_frame in data_frames_to_upload.items():
-            self.upload_dataframe_to_s3(
-                data_frame, self.PROCESSED_BUCKET, file_key)
+        # Save the aggregate state alongside the data it was built from
+        for table, data_frame in self.aggregate_state.to_data_frames().items():
+            data_frames_to_upload[self.aggregate_state_key(table)] = data_frame
+
+        # Upload the files in parallel
+        self.storage.map(
+            lambda item: self.upload_dataframe_to_s3(
+                item[1], self.PROCESSED_BUCKET, item[0]),
+            data_frames_to_upload.items())
 
     def clear_upload_data(self):
-        objects = self.s3.list_objects(Bucket=self.UPLOADS_BUCKET)
+        # Only delete the files read in this run, in batches of up to 1000
+        deleted_keys = self.storage.delete_keys(
+            self.UPLOADS_BUCKET, self.upload_keys)
 
-        for obj in objects.get('Contents', []):
-            file_key = obj['Key']
-            self.s3.delete_object(Bucket=self.UPLOADS_BUCKET, Key=file_key)
-            print(f"File deleted from S3: {file_key}")
+        print(f"Files deleted from S3: {len(deleted_keys)}")
 
     def filter_uploads(self):
         # Shortened name for self.uploads_data_frames
         uploads_df = self.uploads_data_frames
 
-        # Define the expected columns that should be present in the DataFrames
-        expected_columns = ['title', 'lead',
-                            'director', 'genre', 'revenue', 'budget']
-
-        # Filter DataFrame rows based on expected columns
-        uploads_df = uploads_df[
-            uploads_df.apply(lambda row: all(col in row.index for col in expected_columns) and len(
-                row.index) == len(expected_columns), axis=1)
-        ].drop_duplicates(subset='title').reset_index(drop=True)
+        # Files were validated against the schema when downloaded
+        uploads_df = uploads_df.drop_duplicates(
+            subset='title').reset_index(drop=True)
 
         # Convert 'budget' and 'revenue' columns to integers if possible
         uploads_df['budget'] = pd.to_numeric(
@@ -155,41 +271,41 @@ class ETLProcessor:
         ]
 
     def merge_in_type_definitions(self):
+        type_data_frames = {}
+
         # Loop through the columns and corresponding data frames
         for column, type_df in (
                 ("director", self.unique_directors_data_frame),
                 ("genre", self.unique_genres_data_frame),
                 ("lead", self.unique_leads_data_frame)
         ):
-            # Create a modified copy of the type_df
-            type_df_mod = type_df.copy()
-
-            # Loop over rows using iterrows() of uploads_data_frames
-            for index, row in self.uploads_data_frames.iterrows():
-                value = row[column]
-                existing_record = type_df[type_df[column] == value]
-
-                # Check if the record already exists
-                if existing_record.empty:
-                    # Generate a new id if the record doesn't exist
-                    new_id = type_df_mod['id'].max(
-                    ) + 1 if not type_df_mod.empty else 1
-                    new_record = pd.DataFrame(
-                        {'id': [new_id], column: [value]})
-                    # Append the new record to the modified data frame
-                    type_df_mod = type_df_mod._append(
-                        new_record, ignore_index=True)
-
-            # Merge the uploads_data_frames with the modified type_df on the specified column
-            merged_df = pd.merge(self.uploads_data_frames,
-                                 type_df_mod, how='left')
-
-            # Replace the original column with the new "id" column
-            merged_df[column] = merged_df['id']
-            merged_df = merged_df.drop('id', axis=1)
-
-            # Update uploads_data_frames with the modified merged_df
-            self.uploads_data_frames = merged_df.copy()
+            values = self.uploads_data_frames[column]
+
+            # Find names missing from the type table in order of first appearance
+            new_values = values[
+                values.notna() & ~values.isin(type_df[column])
+            ].unique()
+
+            # Give the new names contiguous ids after the current maximum
+            first_id = type_df['id'].max() + 1 if not type_df.empty else 1
+            new_records = pd.DataFrame({
+                'id': range(first_id, first_id + len(new_values)),
+                column: new_values,
+            })
+            type_df = apply_schema(pd.concat([type_df, new_records], ignore_index=True),
+                                   TYPE_SCHEMAS[column])
+
+            # Replace the original column with its id using a single map
+            id_mapping = type_df.drop_duplicates(
+                subset=column).set_index(column)['id']
+            self.uploads_data_frames[column] = values.map(id_mapping)
+
+            type_data_frames[column] = type_df
+
+        # Keep the extended type tables so new ids are saved with the data
+        self.unique_directors_data_frame = type_data_frames["director"]
+        self.unique_genres_data_frame = type_data_frames["genre"]
+        self.unique_leads_data_frame = type_data_frames["lead"]
 
     def create_artificial_features(self):
         # Shortened name for self.uploads_data_frames
@@ -211,44 +327,68 @@ class ETLProcessor:
                 (uploads_df[col] <= upper_threshold)
             ]
 
-        # Calculate additional features
-        # Calculate the average profit ratio of a lead
-        uploads_df['lead_average_profit_ratio'] = uploads_df.groupby(
-            'lead')['profit_ratio'].transform('mean')
-        # Calculate the average profit ratio of a director
-        uploads_df['director_average_profit_ratio'] = uploads_df.groupby(
-            'director')['profit_ratio'].transform('mean')
-        # Calculate the count of times a lead has worked in a genre
-        uploads_df['lead_worked_in_genre_count'] = uploads_df.groupby(
-            ['lead', 'genre'])['title'].transform('count')
-        # Calculate the count of times a director has worked in a genre
-        uploads_df['director_worked_in_genre_count'] = uploads_df.groupby(
-            ['director', 'genre'])['title'].transform('count')
-        # Calculate the count of times a director has worked with a lead
-        uploads_df['director_worked_with_lead_count'] = uploads_df.groupby(
-            ['director', 'lead'])['title'].transform('count')
-
-        # Drop rows with missing values (NaN)
-        self.uploads_data_frames = uploads_df.dropna()
-
-    def run_etl_process(self):
-        self.download_processed_data()
-        self.download_uploads()
-
-        if (not isinstance(self.uploads_data_frames, pd.DataFrame)) or self.uploads_data_frames.empty:
-            print("Info: No uploads to process")
-            return
-
-        self.filter_uploads()
-        self.merge_in_type_definitions()
-        self.create_artificial_features()
-
+        # Drop rows with missing values (NaN) before they reach the aggregates
+        uploads_df = uploads_df.dropna().copy()
+        type_columns = ['lead', 'director', 'genre']
+        uploads_df[type_columns] = uploads_df[type_columns].astype(ID_DTYPE)
+
+        # Fold the new rows into the running aggregates
+        self.aggregate_state.update(uploads_df)
+
+        # Calculate additional features for the new rows from the aggregates
+        features = self.aggregate_state.lookup_batch(
+            uploads_df['lead'], uploads_df['director'], uploads_df['genre'])
+        for column in FEATURE_COLUMNS:
+            uploads_df[column] = features[column].to_numpy()
+
+        # Existing rows only change if they share a lead or director with the
+        # new rows, since every aggregate is keyed by one of the two
+        meta_df = self.meta_data_frame
+        changed_rows = meta_df['lead'].isin(uploads_df['lead']) | \
+            meta_df['director'].isin(uploads_df['director'])
+        changed_features = self.aggregate_state.lookup_batch(
+            meta_df.loc[changed_rows, 'lead'],
+            meta_df.loc[changed_rows, 'director'],
+            meta_df.loc[changed_rows, 'genre'])
+        for column in FEATURE_COLUMNS:
+            meta_df.loc[changed_rows, column] = changed_features[column].to_numpy(
+                dtype=meta_df[column].dtype)
+
+        print(f"Features refreshed for {changed_rows.sum()} existing rows")
+
+        # Match the dtypes of meta_data_frame, so concatenating keeps them
+        self.uploads_data_frames = apply_schema(uploads_df, INPUT_DATA_SCHEMA)
+
+    def concat_uploads(self):
         # Concatenate the processed uploads with the existing meta_data_frame
         self.meta_data_frame = pd.concat(
             [self.meta_data_frame, self.uploads_data_frames], ignore_index=True).reset_index(drop=True)
 
-        self.upload_processed_data_to_s3()
-        self.clear_upload_data()
+    def run_etl_process(self):
+        # Stages are timed and reported when JOB_PROFILE is set
+        profiler = JobProfiler('etl', self.storage)
+        meta_rows = lambda: count_rows(self.meta_data_frame)
+        upload_rows = lambda: count_rows(self.uploads_data_frames)
+
+        with profiler.job_run():
+            profiler.run('download_processed_data', self.download_processed_data, meta_rows)
+            profiler.run('download_uploads', self.download_uploads, upload_rows)
+
+            if (not isinstance(self.uploads_data_frames, pd.DataFrame)) or self.uploads_data_frames.empty:
+                print("Info: No uploads to process")
+
+                # Every file read was rejected, so remove them all the same
+                if self.upload_keys:
+                    profiler.run('clear_upload_data', self.clear_upload_data)
+                return
+
+            profiler.run('filter_uploads', self.filter_uploads, upload_rows)
+            profiler.run('merge_in_type_definitions', self.merge_in_type_definitions, upload_rows)
+            profiler.run('load_aggregate_state', self.load_aggregate_state, meta_rows)
+            profiler.run('create_artificial_features', self.create_artificial_features, upload_rows)
+            profiler.run('concat_uploads', self.concat_uploads, meta_rows)
+            profiler.run('upload_processed_data_to_s3', self.upload_processed_data_to_s3, meta_rows)
+            profiler.run('clear_upload_data', self.clear_upload_data)
 
 
 if __name__ == '__main__':
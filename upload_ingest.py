@@ -0,0 +1,231 @@
+import csv
+import io
+import json
+import os
+import uuid
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+
+from data_format import PARQUET_EXTENSION, write_data_frame
+from schema import UPLOAD_SCHEMA, apply_schema
+
+# Columns of template.csv, which every upload must have and nothing else
+UPLOAD_COLUMNS = list(UPLOAD_SCHEMA)
+NUMERIC_COLUMNS = ['revenue', 'budget']
+
+# Values read as missing, the strings pandas.read_csv treats as NaN
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+             '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+             'n/a', 'nan', 'null']
+
+# Bytes of CSV parsed at a time
+CSV_BLOCK_BYTES = 1024 * 1024
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+class UploadRejected(Exception):
+    pass
+
+
+def upload_settings():
+    # Upload limits, overridable through the environment
+    return {
+        'max_bytes': int(os.environ.get('UPLOAD_MAX_BYTES', 50 * 1024 * 1024)),
+        'max_rows': int(os.environ.get('UPLOAD_MAX_ROWS', 500000)),
+        'shard_rows': int(os.environ.get('UPLOAD_SHARD_ROWS', 50000)),
+    }
+
+
+def manifest_key(prefix):
+    return f"{prefix}/{MANIFEST_FILE}"
+
+
+def is_manifest_key(key):
+    return key.endswith('/' + MANIFEST_FILE)
+
+
+def shard_key(prefix, number):
+    return f"{prefix}/part-{number:05d}{PARQUET_EXTENSION}"
+
+
+class LimitedReader(io.RawIOBase):
+    # Reads from a stream, rejecting it once more than max_bytes arrive
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_bytes:
+            raise UploadRejected(
+                f"Error: File is larger than {self.max_bytes} bytes")
+
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def read_header(stream):
+    # Check the header line against the template before parsing any rows
+    try:
+        line = stream.readline().decode('utf-8-sig')
+        columns = next(csv.reader([line]), [])
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise UploadRejected(f"Error: Unreadable CSV: {e}")
+    columns = [column.strip() for column in columns]
+
+    missing_columns = [column for column in UPLOAD_COLUMNS if column not in columns]
+    unexpected_columns = [column for column in columns if column not in UPLOAD_COLUMNS]
+
+    reasons = []
+    if missing_columns:
+        reasons.append(f"missing columns: {', '.join(missing_columns)}")
+    if unexpected_columns:
+        reasons.append(f"unexpected columns: {', '.join(unexpected_columns)}")
+    if len(set(columns)) != len(columns):
+        reasons.append('duplicate columns')
+    if reasons:
+        raise UploadRejected(f"Error: Header does not match the template ({'; '.join(reasons)})")
+
+    return columns
+
+
+def csv_batches(stream, columns, block_size):
+    # The CSV body read by pyarrow as text, failing at the first row with
+    # more or fewer fields than the header
+    invalid_rows = []
+
+    def invalid_row(row):
+        invalid_rows.append(row)
+        return 'error'
+
+    try:
+        reader = pyarrow.csv.open_csv(
+            stream,
+            read_options=pyarrow.csv.ReadOptions(
+                column_names=columns, block_size=block_size, use_threads=False),
+            parse_options=pyarrow.csv.ParseOptions(
+                newlines_in_values=True, invalid_row_handler=invalid_row),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={column: pa.string() for column in columns},
+                null_values=NA_VALUES, strings_can_be_null=True,
+                quoted_strings_can_be_null=True))
+        # Closed even when the caller stops early, on a rejected shard
+        with reader:
+            yield from reader
+    except pa.ArrowInvalid as e:
+        # Parse and UTF-8 errors, anything else is the server's fault
+        if not invalid_rows:
+            raise UploadRejected(f"Error: Unreadable CSV: {e}")
+        # Row numbers count the header as row 1 and, like read_csv, skip blank lines
+        row = invalid_rows[0]
+        where = f"Row {row.number + 1}" if row.number is not None else f"Row {row.text!r}"
+        raise UploadRejected(
+            f"Error: {where} has {row.actual_columns} fields, expected {row.expected_columns}")
+
+
+def row_chunks(stream, columns, chunk_rows):
+    # The CSV body in DataFrames of chunk_rows rows, the last one shorter
+    pending = []
+    pending_rows = 0
+    for batch in csv_batches(stream, columns, CSV_BLOCK_BYTES):
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_rows:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunk_rows).to_pandas()
+            pending = table.slice(chunk_rows).to_batches()
+            pending_rows -= chunk_rows
+
+    if pending_rows:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+
+def typed_chunk(chunk, first_row):
+    # Numbers are checked here, anything else in a numeric column rejects the
+    # file, then every column is cast to the upload schema
+    chunk = chunk[UPLOAD_COLUMNS].copy()
+    for column in NUMERIC_COLUMNS:
+        values = pd.to_numeric(chunk[column], errors='coerce')
+        invalid = values.isna() & chunk[column].notna()
+        if invalid.any():
+            position = int(invalid.to_numpy().argmax())
+            raise UploadRejected(
+                f"Error: Row {first_row + position}: {column} is not a number "
+                f"({chunk[column].iloc[position]!r})")
+        chunk[column] = values
+
+    return apply_schema(chunk, UPLOAD_SCHEMA)
+
+
+class UploadIngester:
+    # Parses an uploaded CSV in chunks as it is read, writing each chunk to
+    # storage as a typed Parquet shard. The manifest is written last, so
+    # the ETL never sees an upload that is incomplete or was rejected.
+    def __init__(self, storage, bucket, settings=None):
+        self.storage = storage
+        self.bucket = bucket
+        self.settings = settings or upload_settings()
+
+    def ingest(self, stream, filename):
+        # Keys of one upload share a timestamped prefix, unique even for
+        # files of the same name uploaded in the same second
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        prefix = f"{timestamp}_{uuid.uuid4().hex}_{filename}"
+
+        shards = []
+        try:
+            reader = LimitedReader(stream, self.settings['max_bytes'])
+            buffered = io.BufferedReader(reader)
+            columns = read_header(buffered)
+
+            rows = 0
+            for chunk in row_chunks(buffered, columns, self.settings['shard_rows']):
+                # Row numbers in messages count the header as row 1
+                shard = typed_chunk(chunk, rows + 2)
+                rows += len(shard)
+                if rows > self.settings['max_rows']:
+                    raise UploadRejected(
+                        f"Error: File has more than {self.settings['max_rows']} rows")
+
+                key = shard_key(prefix, len(shards))
+                self.storage.put_object(self.bucket, key, write_data_frame(shard, key))
+                shards.append({'key': key, 'rows': len(shard)})
+
+            if not rows:
+                raise UploadRejected('Error: File has no rows')
+
+            manifest = {
+                'version': MANIFEST_VERSION,
+                'prefix': prefix,
+                'filename': filename,
+                'uploaded_at': datetime.now().isoformat(),
+                'columns': UPLOAD_COLUMNS,
+                'rows': rows,
+                'bytes': reader.bytes_read,
+                'shards': shards,
+            }
+            self.storage.put_object(self.bucket, manifest_key(prefix),
+                                    json.dumps(manifest).encode('utf-8'))
+        except Exception:
+            # Only parse errors were turned into UploadRejected, storage and
+            # other server errors propagate for the caller to report as such
+            self.delete_shards(shards)
+            raise
+
+        print(f"Upload staged: {manifest_key(prefix)} ({rows} rows, {len(shards)} shards)")
+
+        return manifest
+
+    def delete_shards(self, shards):
+        if shards:
+            self.storage.delete_keys(self.bucket, [shard['key'] for shard in shards])